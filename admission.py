@@ -0,0 +1,232 @@
+"""
+准入控制与限流
+
+- 按 API Key 和全局两个维度的令牌桶: 每分钟请求数(rpm) 和 每分钟 token 数(tpm, 按估算的 prompt 大小)
+- 超出配额的请求进入有界等待队列，按优先级(high/normal/low)排队，等待超时后返回 429
+- 队列已满时立即返回 429，并带 Retry-After 响应头
+- 令牌桶和等待队列保存在本机 SQLite 文件中，同一台机器上的所有工作进程共享
+"""
+import asyncio
+import json
+import math
+import os
+import sqlite3
+import tempfile
+import threading
+import time
+import uuid
+
+from tokens import estimate_prompt_tokens
+
+RATE_LIMIT_ENABLED = os.getenv("RATE_LIMIT_ENABLED", "False").lower() == "true"
+RATE_LIMIT_DB = os.getenv("RATE_LIMIT_DB", os.path.join(tempfile.gettempdir(), "llm-proxy-ratelimit.db"))
+# 单个 API Key 与全局的配额，0 表示不限制
+KEY_RPM = float(os.getenv("RATE_LIMIT_KEY_RPM", 0))
+KEY_TPM = float(os.getenv("RATE_LIMIT_KEY_TPM", 0))
+GLOBAL_RPM = float(os.getenv("RATE_LIMIT_GLOBAL_RPM", 0))
+GLOBAL_TPM = float(os.getenv("RATE_LIMIT_GLOBAL_TPM", 0))
+# 按 API Key 覆盖配额和优先级 (JSON): {"key": {"rpm": 60, "tpm": 100000, "priority": "high"}}
+KEY_OVERRIDES = json.loads(os.getenv("RATE_LIMIT_KEYS", "{}"))
+# 等待队列
+QUEUE_SIZE = int(os.getenv("RATE_LIMIT_QUEUE_SIZE", 100))
+QUEUE_TIMEOUT = float(os.getenv("RATE_LIMIT_QUEUE_TIMEOUT", 30))
+
+# 优先级 -> (可使用的队列比例, 等待超时倍数)
+PRIORITIES = {
+    "high": (1.0, 2.0),
+    "normal": (0.8, 1.0),
+    "low": (0.5, 0.5),
+}
+_PRIORITY_RANK = {"high": 0, "normal": 1, "low": 2}
+# 排队时重新检查配额的最大间隔(秒)
+_POLL_INTERVAL = 0.25
+
+_local = threading.local()
+_counters_lock = threading.Lock()
+_counters = {"admitted": 0, "queued": 0, "rejected_queue_full": 0, "rejected_timeout": 0}
+
+
+class RateLimited(Exception):
+    """请求被限流"""
+
+    code = 429
+
+    def __init__(self, message, retry_after):
+        super().__init__(message)
+        self.retry_after = max(1, math.ceil(retry_after))
+
+
+def _incr(name):
+    with _counters_lock:
+        _counters[name] += 1
+
+
+def stats():
+    """返回准入控制统计信息"""
+    with _counters_lock:
+        return {"enabled": RATE_LIMIT_ENABLED, **_counters}
+
+
+def _db():
+    """每个线程使用独立的 SQLite 连接"""
+    conn = getattr(_local, "conn", None)
+    if conn is None:
+        conn = sqlite3.connect(RATE_LIMIT_DB, timeout=5, isolation_level=None)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=OFF")
+        conn.execute("CREATE TABLE IF NOT EXISTS buckets (name TEXT PRIMARY KEY, tokens REAL, updated REAL)")
+        conn.execute("CREATE TABLE IF NOT EXISTS waiters (id TEXT PRIMARY KEY, priority INTEGER, expires REAL)")
+        _local.conn = conn
+    return conn
+
+
+def api_key_from_headers(headers):
+    """从 Authorization: Bearer <key> 或 X-API-Key 请求头中读取 API Key"""
+    auth = headers.get("Authorization", "")
+    if auth.lower().startswith("bearer "):
+        return auth[7:].strip()
+    return headers.get("X-API-Key") or "anonymous"
+
+
+def _limits_for(api_key):
+    """返回该 API Key 需要检查的令牌桶 [(名称, 每分钟配额, 消耗类型)]"""
+    override = KEY_OVERRIDES.get(api_key, {})
+    limits = [
+        (f"key:{api_key}:rpm", override.get("rpm", KEY_RPM), "requests"),
+        (f"key:{api_key}:tpm", override.get("tpm", KEY_TPM), "tokens"),
+        ("global:rpm", GLOBAL_RPM, "requests"),
+        ("global:tpm", GLOBAL_TPM, "tokens"),
+    ]
+    return [limit for limit in limits if limit[1] > 0]
+
+
+def _try_acquire(limits, tokens, priority_rank):
+    """原子地检查并扣减所有令牌桶，返回还需等待的秒数(0 表示成功)
+
+    队列中有优先级数值小于 priority_rank 的请求在等待时，不扣减配额。
+    """
+    conn = _db()
+    now = time.time()
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        # 有更靠前的请求在排队时，让它们先获取配额
+        higher = conn.execute("SELECT COUNT(*) FROM waiters WHERE priority < ? AND expires > ?",
+                              (priority_rank, now)).fetchone()[0]
+        states = []
+        wait = 0.0
+        for name, per_minute, kind in limits:
+            rate = per_minute / 60
+            cost = min(1 if kind == "requests" else tokens, per_minute)
+            row = conn.execute("SELECT tokens, updated FROM buckets WHERE name = ?", (name,)).fetchone()
+            available = per_minute if row is None else min(per_minute, row[0] + (now - row[1]) * rate)
+            states.append((name, available, cost))
+            if available < cost:
+                wait = max(wait, (cost - available) / rate)
+        if wait == 0 and higher:
+            wait = _POLL_INTERVAL
+        if wait == 0:
+            conn.executemany("INSERT OR REPLACE INTO buckets (name, tokens, updated) VALUES (?, ?, ?)",
+                             [(name, available - cost, now) for name, available, cost in states])
+        conn.execute("COMMIT")
+        return wait
+    except Exception:
+        conn.execute("ROLLBACK")
+        raise
+
+
+def _enqueue(priority_rank, expires):
+    """加入等待队列，队列已满时返回 None"""
+    conn = _db()
+    now = time.time()
+    capacity = QUEUE_SIZE * PRIORITIES[_rank_name(priority_rank)][0]
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        conn.execute("DELETE FROM waiters WHERE expires <= ?", (now,))
+        waiting = conn.execute("SELECT COUNT(*) FROM waiters").fetchone()[0]
+        if waiting >= capacity:
+            conn.execute("COMMIT")
+            return None
+        waiter_id = uuid.uuid4().hex
+        conn.execute("INSERT INTO waiters (id, priority, expires) VALUES (?, ?, ?)",
+                     (waiter_id, priority_rank, expires))
+        conn.execute("COMMIT")
+        return waiter_id
+    except Exception:
+        conn.execute("ROLLBACK")
+        raise
+
+
+def _dequeue(waiter_id):
+    _db().execute("DELETE FROM waiters WHERE id = ?", (waiter_id,))
+
+
+def _rank_name(rank):
+    return next(name for name, r in _PRIORITY_RANK.items() if r == rank)
+
+
+def _plan(data, headers):
+    """返回本次请求的 (令牌桶, token 估算, 优先级)"""
+    api_key = api_key_from_headers(headers)
+    priority = KEY_OVERRIDES.get(api_key, {}).get("priority") or headers.get("X-Priority", "normal")
+    if priority not in PRIORITIES:
+        priority = "normal"
+    limits = _limits_for(api_key)
+    tokens = estimate_prompt_tokens(data) if any(kind == "tokens" for _, _, kind in limits) else 0
+    return limits, tokens, priority
+
+
+def admit_steps(data, headers):
+    """准入流程，生成需要等待的秒数；配额足够时结束，被拒绝时抛出 RateLimited
+
+    以生成器形式实现，同步和异步版本共用同一套逻辑，只是等待方式不同。
+    """
+    if not RATE_LIMIT_ENABLED:
+        return
+    limits, tokens, priority = _plan(data, headers)
+    if not limits:
+        return
+    rank = _PRIORITY_RANK[priority]
+
+    # 新到的请求不插队: 有同等或更高优先级的请求在排队时先进入队列
+    wait = _try_acquire(limits, tokens, rank + 1)
+    if wait == 0:
+        _incr("admitted")
+        return
+
+    timeout = QUEUE_TIMEOUT * PRIORITIES[priority][1]
+    deadline = time.time() + timeout
+    waiter_id = _enqueue(rank, deadline)
+    if waiter_id is None:
+        _incr("rejected_queue_full")
+        raise RateLimited("请求过多，等待队列已满", retry_after=wait)
+
+    _incr("queued")
+    try:
+        while True:
+            remaining = deadline - time.time()
+            if remaining <= 0 or wait > remaining + _POLL_INTERVAL:
+                _incr("rejected_timeout")
+                raise RateLimited(f"请求过多，排队超过 {timeout:g} 秒", retry_after=wait)
+            yield min(wait, _POLL_INTERVAL, remaining)
+            wait = _try_acquire(limits, tokens, rank)
+            if wait == 0:
+                _incr("admitted")
+                return
+    finally:
+        _dequeue(waiter_id)
+
+
+def admit(data, headers):
+    """准入检查(同步)，必要时在队列中等待"""
+    for delay in admit_steps(data, headers):
+        time.sleep(delay)
+
+
+async def admit_async(data, headers):
+    """准入检查(异步)，SQLite 操作在线程中执行"""
+    steps = admit_steps(data, headers)
+    while True:
+        delay = await asyncio.to_thread(next, steps, None)
+        if delay is None:
+            return
+        await asyncio.sleep(delay)
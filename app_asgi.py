@@ -0,0 +1,418 @@
+"""
+ASGI 版本的代理服务 - 基于 asyncio，单进程可同时承载大量流式连接
+
+请求/响应协议与 app_vertex.py 中的 Flask 版本完全一致，
+OpenAI -> Vertex AI 的转换逻辑直接复用 app_vertex 中的函数。
+"""
+import asyncio
+import contextlib
+import os
+import time
+
+from starlette.applications import Starlette
+from starlette.concurrency import run_in_threadpool
+from starlette.middleware import Middleware
+from starlette.middleware.cors import CORSMiddleware
+from starlette.responses import FileResponse, JSONResponse, Response, StreamingResponse
+from starlette.routing import Route
+
+from cache import all_stats
+from request_stream import StreamingRequestParser
+import response_cache
+import singleflight
+from sse import StreamFrames, coalesce_texts_async, aclose_stream
+import metrics
+import tracing
+import admission
+import models
+import batches
+import embeddings
+import retry
+import startup
+from retry import call_with_retry_async, stream_with_retry_async, deadline_from_headers, error_status
+from app_vertex import (
+    should_stream_parse,
+    parse_chat_request,
+    backend_pool,
+    upstream_generate_async,
+    usage_from_metadata,
+    stream_usage,
+    streamed_tokens,
+    build_completion,
+    completion_payload,
+    replay_stream,
+    health_payload,
+)
+
+# 相同请求合并
+inflight = singleflight.AsyncSingleFlight()
+
+
+async def health_check(request):
+    """就绪检查接口，预热完成前返回 503"""
+    startup.begin()
+    return JSONResponse(health_payload(), status_code=200 if startup.ready() else 503)
+
+
+async def liveness_check(request):
+    """存活检查接口"""
+    return JSONResponse({"status": "alive"})
+
+
+@contextlib.asynccontextmanager
+async def lifespan(app):
+    """工作进程开始接收请求前启动预热(STARTUP_MODE=warmup)"""
+    startup.begin()
+    yield
+
+
+async def sse_stream(chat_req, response_stream, deadline=None):
+    """将上游流式响应转换为 SSE 帧（异步版本）
+
+    客户端断开时 Starlette 会取消响应任务，取消会一直传递到上游流；超过 deadline 时停止生成。
+    """
+    model_name = chat_req["model_name"]
+    frames = StreamFrames(tracing.completion_id(), int(time.time()), model_name)
+    state = {"usage_metadata": None, "texts": [], "finish_reason": "stop", "started": False}
+    timer = metrics.StreamTimer(model_name)
+
+    async def texts():
+        state["started"] = True
+        chunks = response_stream.__aiter__()
+        try:
+            while True:
+                try:
+                    if deadline is None:
+                        chunk = await chunks.__anext__()
+                    else:
+                        chunk = await asyncio.wait_for(chunks.__anext__(), max(0, deadline - time.monotonic()))
+                except StopAsyncIteration:
+                    return
+                except asyncio.TimeoutError:
+                    state["finish_reason"] = "length"
+                    return
+                if chunk.usage_metadata and chunk.usage_metadata.total_token_count:
+                    state["usage_metadata"] = chunk.usage_metadata
+                if chunk.text:
+                    timer.chunk()
+                    state["texts"].append(chunk.text)
+                    yield chunk.text
+        finally:
+            await aclose_stream(response_stream)
+
+    text_stream = coalesce_texts_async(texts())
+    try:
+        # 首个chunk包含角色信息
+        yield frames.role()
+
+        # 流式内容
+        async for text in text_stream:
+            yield frames.content(text)
+    except (asyncio.CancelledError, GeneratorExit):
+        metrics.record_cancelled(model_name, "client_disconnect", streamed_tokens(state))
+        raise
+    finally:
+        await aclose_stream(text_stream)
+        if not state["started"]:
+            await aclose_stream(response_stream)
+
+    timer.finish()
+    metrics.record_usage(model_name, usage_from_metadata(state["usage_metadata"]))
+    if state["finish_reason"] == "length":
+        tracing.event("deadline_exceeded", error=True, completion_tokens=streamed_tokens(state))
+        metrics.record_cancelled(model_name, "deadline", streamed_tokens(state))
+
+    # 结束标记
+    usage = None
+    if chat_req["include_usage"]:
+        usage = stream_usage(chat_req, state)
+    yield frames.final(usage, state["finish_reason"])
+    yield "data: [DONE]\n\n"
+
+
+async def stats(request):
+    """缓存统计信息"""
+    return JSONResponse({"caches": all_stats(), "retry": retry.stats(), "upstream": backend_pool.stats(),
+                         "response_cache": response_cache.stats(), "coalescing": singleflight.stats(),
+                         "admission": admission.stats(), "batches": batches.stats(),
+                         "embeddings": embeddings.stats(), "tracing": tracing.stats(),
+                         "startup": startup.stats()})
+
+
+async def list_models(request):
+    """可用模型列表"""
+    return JSONResponse(models.list_models())
+
+
+async def get_model_info(request):
+    """模型信息"""
+    try:
+        return JSONResponse(models.get_model_info(request.path_params["model"]))
+    except models.ModelNotFound as e:
+        return JSONResponse({"error": str(e)}, status_code=e.code)
+
+
+async def batch_api(fn, *args):
+    """在线程池中调用批处理接口，错误转换为 JSON 响应"""
+    try:
+        return JSONResponse(await run_in_threadpool(fn, *args))
+    except batches.BatchError as e:
+        return JSONResponse({"error": str(e)}, status_code=e.code)
+
+
+async def upload_file(request):
+    """上传批处理输入文件 (multipart/form-data: file, purpose)"""
+    form = await request.form()
+    upload = form.get("file")
+    if upload is None or isinstance(upload, str):
+        return JSONResponse({"error": "缺少 file 字段"}, status_code=400)
+    return await batch_api(batches.create_file, upload.file, upload.filename, form.get("purpose"))
+
+
+async def list_files(request):
+    """文件列表"""
+    return await batch_api(batches.list_files, request.query_params.get("purpose"))
+
+
+async def get_file(request):
+    """文件信息"""
+    return await batch_api(batches.get_file, request.path_params["file_id"])
+
+
+async def delete_file(request):
+    """删除文件"""
+    return await batch_api(batches.delete_file, request.path_params["file_id"])
+
+
+async def get_file_content(request):
+    """下载文件内容"""
+    try:
+        path = await run_in_threadpool(batches.file_content_path, request.path_params["file_id"])
+    except batches.BatchError as e:
+        return JSONResponse({"error": str(e)}, status_code=e.code)
+    return FileResponse(path, media_type="application/jsonl")
+
+
+async def create_batch(request):
+    """创建批处理任务"""
+    try:
+        params = await request.json()
+    except ValueError:
+        params = {}
+    return await batch_api(batches.create_batch, params or {})
+
+
+async def list_batches(request):
+    """批处理任务列表"""
+    limit = request.query_params.get("limit", "20")
+    return await batch_api(batches.list_batches, int(limit) if limit.isdigit() else 20,
+                           request.query_params.get("after"))
+
+
+async def get_batch(request):
+    """批处理任务状态和进度"""
+    return await batch_api(batches.get_batch, request.path_params["batch_id"])
+
+
+async def cancel_batch(request):
+    """取消批处理任务"""
+    return await batch_api(batches.cancel_batch, request.path_params["batch_id"])
+
+
+async def read_request_json(request):
+    """读取 ASGI 请求体，返回 (data, blobs)"""
+    content_length = request.headers.get('content-length')
+    if not should_stream_parse(int(content_length) if content_length and content_length.isdigit() else 0):
+        return await request.json(), None
+    parser = StreamingRequestParser()
+    async for chunk in request.stream():
+        parser.feed(chunk)
+    return parser.finish()
+
+
+async def prometheus_metrics(request):
+    """Prometheus 指标"""
+    body, content_type = await run_in_threadpool(metrics.render)
+    return Response(body, headers={"Content-Type": content_type})
+
+
+async def chat_completions(request):
+    """聊天接口 - 协议转换代理（异步版本）"""
+    metrics.IN_FLIGHT.inc()
+    trace = tracing.start(request.method, request.url.path, request.headers)
+    model_name = "unknown"
+    stream = False
+    streaming = False
+    status_code = 500
+    try:
+        with metrics.phase("parse"):
+            data, blobs = await read_request_json(request)
+        with metrics.phase("admission"):
+            await admission.admit_async(data, request.headers)
+        # 图片解码、读文件等操作是阻塞的，放到线程池中执行，避免阻塞事件循环
+        with metrics.phase("convert"):
+            chat_req = await run_in_threadpool(parse_chat_request, data, blobs)
+        model_name = chat_req["model_name"]
+        stream = chat_req["stream"]
+        trace.annotate(model=model_name, stream=stream)
+        deadline = deadline_from_headers(request.headers)
+
+        # 规范化请求摘要，用于响应缓存和相同请求合并
+        request_key = None
+        if response_cache.is_cacheable(data) or singleflight.COALESCE_ENABLED:
+            request_key = await run_in_threadpool(response_cache.cache_key, chat_req, data)
+
+        # temperature=0 的请求可以直接使用缓存的响应
+        cache_key = request_key if response_cache.is_cacheable(data) else None
+        cached = await run_in_threadpool(response_cache.get, cache_key)
+        cache_headers = {"X-Cache": "BYPASS" if cache_key is None else ("HIT" if cached else "MISS"),
+                         **trace.headers()}
+        trace.annotate(cache=cache_headers["X-Cache"], image_bytes_saved=chat_req["image_bytes_saved"])
+        if chat_req["image_bytes_saved"]:
+            cache_headers["X-Image-Bytes-Saved"] = str(chat_req["image_bytes_saved"])
+        status_code = 200
+        if cached:
+            if stream:
+                return StreamingResponse(replay_stream(cached, model_name, chat_req["include_usage"]),
+                                         media_type='text/event-stream', headers=cache_headers)
+            return JSONResponse(completion_payload(cached["content"], cached["usage"], model_name),
+                                headers=cache_headers)
+
+        if stream:
+            async def generate_stream():
+                # 流式响应在发送结束(或客户端断开)后才算完成
+                try:
+                    response_stream = await inflight.stream(request_key, lambda: stream_with_retry_async(
+                        lambda: upstream_generate_async(chat_req, stream=True), deadline))
+                    async for frame in sse_stream(chat_req, response_stream, deadline):
+                        yield frame
+                except Exception as e:
+                    # 响应头已经发出，错误只能记录在 trace 中
+                    trace.fail(e)
+                    raise
+                finally:
+                    metrics.IN_FLIGHT.dec()
+                    tracing.finish(trace, 200)
+
+            streaming = True
+            return StreamingResponse(generate_stream(), media_type='text/event-stream', headers=cache_headers)
+        else:
+            with metrics.phase("upstream"):
+                response = await inflight.call(request_key, lambda: call_with_retry_async(
+                    lambda: upstream_generate_async(chat_req), deadline, hedge=True))
+            response_data = build_completion(response, model_name)
+            await run_in_threadpool(response_cache.put, cache_key, response_data)
+            metrics.record_usage(model_name, response_data["usage"])
+            return JSONResponse(response_data, headers=cache_headers)
+
+    except Exception as e:
+        status_code = error_status(e)
+        headers = trace.headers()
+        if isinstance(e, admission.RateLimited):
+            headers["Retry-After"] = str(e.retry_after)
+        trace.fail(e)
+        return JSONResponse({"error": str(e)}, status_code=status_code, headers=headers)
+    finally:
+        metrics.REQUESTS.labels(model_name, str(stream).lower(), str(status_code)).inc()
+        if not streaming:
+            metrics.IN_FLIGHT.dec()
+            tracing.finish(trace, status_code)
+        metrics.sync_cache_stats()
+
+
+async def create_embeddings(request):
+    """Embedding 接口（异步版本），上游调用在 embeddings 的批处理线程中进行"""
+    metrics.IN_FLIGHT.inc()
+    trace = tracing.start(request.method, request.url.path, request.headers)
+    model_name = "unknown"
+    stream = False
+    streaming = False
+    status_code = 500
+    try:
+        try:
+            data = await request.json()
+        except ValueError:
+            data = {}
+        with metrics.phase("admission"):
+            await admission.admit_async(data, request.headers)
+        embed_req = embeddings.parse_request(data)
+        model_name = embed_req["model"]
+        stream = embed_req["stream"]
+        trace.annotate(model=model_name, stream=stream, inputs=len(embed_req["inputs"]))
+        timeout = deadline_from_headers(request.headers) - time.monotonic()
+        # 计算摘要和估算 token 数是 CPU 密集的，放到线程池中执行
+        futures = await run_in_threadpool(embeddings.submit, embed_req)
+        status_code = 200
+
+        if stream:
+            async def generate_stream():
+                usage = {}
+                try:
+                    async for frame in embeddings.stream_async(embed_req, futures, timeout, usage):
+                        yield frame
+                    metrics.record_usage(model_name, usage)
+                except Exception as e:
+                    trace.fail(e)
+                    raise
+                finally:
+                    metrics.IN_FLIGHT.dec()
+                    tracing.finish(trace, 200)
+
+            streaming = True
+            return StreamingResponse(generate_stream(), media_type='text/event-stream', headers=trace.headers())
+        with metrics.phase("embed"):
+            response_data = await embeddings.create_async(embed_req, futures, timeout)
+        metrics.record_usage(model_name, response_data["usage"])
+        return JSONResponse(response_data, headers=trace.headers())
+
+    except Exception as e:
+        status_code = error_status(e)
+        headers = trace.headers()
+        if isinstance(e, admission.RateLimited):
+            headers["Retry-After"] = str(e.retry_after)
+        trace.fail(e)
+        return JSONResponse({"error": str(e)}, status_code=status_code, headers=headers)
+    finally:
+        metrics.REQUESTS.labels(model_name, str(stream).lower(), str(status_code)).inc()
+        if not streaming:
+            metrics.IN_FLIGHT.dec()
+            tracing.finish(trace, status_code)
+        metrics.sync_cache_stats()
+
+
+app = Starlette(
+    routes=[
+        Route('/health', health_check, methods=['GET']),
+        Route('/health/ready', health_check, methods=['GET']),
+        Route('/health/live', liveness_check, methods=['GET']),
+        Route('/stats', stats, methods=['GET']),
+        Route('/metrics', prometheus_metrics, methods=['GET']),
+        Route('/v1/models', list_models, methods=['GET']),
+        Route('/models', list_models, methods=['GET']),
+        Route('/v1/models/{model:path}', get_model_info, methods=['GET']),
+        Route('/models/{model:path}', get_model_info, methods=['GET']),
+        Route('/v1/files', upload_file, methods=['POST']),
+        Route('/v1/files', list_files, methods=['GET']),
+        Route('/v1/files/{file_id}', get_file, methods=['GET']),
+        Route('/v1/files/{file_id}', delete_file, methods=['DELETE']),
+        Route('/v1/files/{file_id}/content', get_file_content, methods=['GET']),
+        Route('/v1/batches', create_batch, methods=['POST']),
+        Route('/v1/batches', list_batches, methods=['GET']),
+        Route('/v1/batches/{batch_id}', get_batch, methods=['GET']),
+        Route('/v1/batches/{batch_id}/cancel', cancel_batch, methods=['POST']),
+        Route('/v1/chat/completions', chat_completions, methods=['POST']),
+        Route('/chat/completions', chat_completions, methods=['POST']),
+        Route('/v1/embeddings', create_embeddings, methods=['POST']),
+        Route('/embeddings', create_embeddings, methods=['POST']),
+    ],
+    middleware=[Middleware(CORSMiddleware, allow_origins=['*'], allow_methods=['*'], allow_headers=['*'])],
+    lifespan=lifespan,
+)
+
+
+if __name__ == '__main__':
+    import uvicorn
+
+    port = int(os.getenv('PORT', 8080))
+    print(f"🚀 Gemini代理服务(ASGI)启动: http://localhost:{port}")
+    uvicorn.run(app, host='0.0.0.0', port=port)
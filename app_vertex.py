@@ -1,16 +1,32 @@
-from flask import Flask, request, jsonify, Response
+import time
+_import_start = time.perf_counter()
+
+from flask import Flask, request, jsonify, Response, send_file
 from flask_cors import CORS
-import vertexai
-from vertexai.generative_models import GenerativeModel, GenerationConfig, Content, Part
-import json
 import os
 from dotenv import load_dotenv
-import uuid
-import time
-import base64
 import mimetypes
-import requests
-import tempfile
+from cache import all_stats
+from image_fetch import fetch_images
+from data_uri import decode_data_uri
+from request_stream import StreamingRequestParser
+from tokens import count_text_tokens, usage_from_metadata, estimate_usage
+import retry
+from retry import call_with_retry, stream_with_retry, deadline_from_headers, error_status
+from backends import BackendPool, parse_backends
+import response_cache
+import singleflight
+from sse import StreamFrames, coalesce_texts, close_stream, read_until
+import metrics
+import tracing
+import admission
+import models
+import batches
+import context_cache
+import compaction
+import image_preprocess
+import embeddings
+import startup
 
 # 加载环境变量
 load_dotenv()
@@ -19,251 +35,707 @@ app = Flask(__name__)
 CORS(app)
 
 
-# 初始化Vertex AI
+# Vertex AI 配置
 project_id = os.getenv("GOOGLE_CLOUD_PROJECT", "vertex-testing")
 location = os.getenv("GOOGLE_CLOUD_LOCATION", "asia-east2")
-vertexai.init(project=project_id, location=location)
 
 
-import base64
-import requests
-import re
-from vertexai.generative_models import Content, Part, Image
+def _init_sdk():
+    with metrics.phase("sdk_init"):
+        import upstream
+    return upstream
+
+
+def sdk():
+    """导入 google-genai SDK，返回 upstream 模块(其中的 types 即 google.genai.types)
+
+    导入 SDK 需要约一秒，何时执行由 STARTUP_MODE 决定，见 startup.py。
+    """
+    return startup.run_once("sdk_init", _init_sdk)
+
+
+if startup.STARTUP_MODE == "eager":
+    sdk()
+
+
+# 相同请求合并
+inflight = singleflight.SingleFlight()
+
+# 上游后端池，可通过 VERTEX_BACKENDS 配置多个项目/区域
+backend_pool = BackendPool(parse_backends(os.getenv("VERTEX_BACKENDS"), project_id, location))
+
+# 请求体超过该大小时使用流式解析，0 表示禁用
+STREAMING_PARSE_MIN_BYTES = int(os.getenv("STREAMING_PARSE_MIN_BYTES", 1024 * 1024))
+READ_CHUNK_SIZE = 64 * 1024
+
+# 远程图片处理方式: passthrough - 直接把 URL 交给 Vertex AI; fetch - 由代理下载后内联上传(见 image_fetch.py 的地址限制)
+IMAGE_FETCH_MODE = os.getenv("IMAGE_FETCH_MODE", "passthrough").lower()
+
+
+def collect_remote_image_urls(messages):
+    """收集请求中所有 http(s) 图片 URL"""
+    urls = []
+    for msg in messages:
+        content = msg.get("content")
+        if not isinstance(content, list):
+            continue
+        for item in content:
+            if isinstance(item, dict) and item.get("type") == "image_url":
+                url = (item.get("image_url") or {}).get("url", "")
+                if url.lower().startswith(("http://", "https://")):
+                    urls.append(url)
+    return urls
 
-def process_message_content(content):
-    """处理消息内容，支持文本和图片的混合内容"""
+
+def load_inline_image(image_url, fetched_images=None, blobs=None):
+    """读取需要内联上传的图片，返回 (图片字节, MIME 类型)；gs:// 以及直接交给 Vertex AI 的 URL 返回 None
+
+    fetched_images: 预先下载好的远程图片 {url: (图片字节, MIME 类型) 或 Exception}
+    blobs: 流式解析请求体时已解码的 Data URI {占位符: (图片字节, MIME 类型)}
+    """
+    if blobs and image_url in blobs:
+        # 流式解析时已解码的 Data URI
+        return blobs[image_url]
+    if image_url.lower().startswith("gs://"):
+        return None
+    if image_url.lower().startswith(("http://", "https://")):
+        # 远程URL
+        if fetched_images is not None and image_url in fetched_images:
+            fetched = fetched_images[image_url]
+            if isinstance(fetched, Exception):
+                raise fetched
+            return fetched
+        return None
+    if image_url.strip().startswith("data:image"):
+        try:
+            # 解析 Data URI，相同内容只解码一次
+            return decode_data_uri(image_url.strip())
+        except (ValueError, IndexError) as e:
+            raise ValueError(f"无效的 Base64 Data URI 格式: {e}")
+    # 检查是否为本地文件
+    if os.path.isfile(image_url):
+        mime_type, _ = mimetypes.guess_type(image_url)
+        if not mime_type:
+            raise ValueError(f"无法确定文件 '{image_url}' 的 MIME 类型。")
+        with open(image_url, "rb") as f:
+            return f.read(), mime_type
+    # 如果以上都不是，则是无效输入
+    raise FileNotFoundError(
+        f"输入 '{image_url}' 不是一个有效的 GCS URI、HTTPS URL、Base64 Data URI 或存在的本地文件路径。"
+    )
+
+
+def prepare_images(messages, fetched_images=None, blobs=None):
+    """读取请求中所有内联图片并并发预处理，返回 ({url: (图片字节, MIME 类型) 或 Exception}, 节省的字节数)
+
+    gs:// 以及直接交给 Vertex AI 的 URL 不在结果中。
+    """
+    results = {}
+    loaded = {}
+    for msg in messages:
+        content = msg.get("content")
+        if not isinstance(content, list):
+            continue
+        for item in content:
+            if not isinstance(item, dict) or item.get("type") != "image_url":
+                continue
+            image_url = (item.get("image_url") or {}).get("url", "")
+            if not image_url or image_url in results or image_url in loaded:
+                continue
+            try:
+                image = load_inline_image(image_url, fetched_images, blobs)
+            except Exception as e:
+                results[image_url] = e
+                continue
+            if image is not None:
+                loaded[image_url] = image
+    saved = 0
+    for image_url, (data, mime_type, image_saved) in image_preprocess.preprocess_all(loaded).items():
+        results[image_url] = (data, mime_type)
+        saved += image_saved
+    return results, saved
+
+
+def process_message_content(content, images=None):
+    """处理消息内容，支持文本和图片的混合内容
+
+    images: prepare_images 返回的内联图片 {url: (图片字节, MIME 类型) 或 Exception}，
+    不在其中的 URL 直接交给 Vertex AI
+    """
+    Part = sdk().types.Part
     parts = []
     
     if isinstance(content, str):
         # 简单文本消息
-        parts.append(Part.from_text(content))
+        parts.append(Part.from_text(text=content))
     elif isinstance(content, list):
         # 结构化内容，可能包含文本和图片
         for item in content:
             if item.get("type") == "text":
-                parts.append(Part.from_text(item.get("text", "")))
+                parts.append(Part.from_text(text=item.get("text", "")))
             elif item.get("type") == "image_url":
                 image_url = item.get("image_url", {}).get("url", "")
                 if image_url:
                     try:
-                        if image_url.lower().startswith("gs://"):
-                            mime_type, _ = mimetypes.guess_type(image_url)
-                            parts.append(Part.from_uri(uri=image_url, mime_type=mime_type))
-                        elif image_url.lower().startswith(("http://", "https://")):
-                            # 远程URL
-                            mime_type, _ = mimetypes.guess_type(image_url)
-                            parts.append(Part.from_uri(uri=image_url, mime_type=mime_type))
-                        elif image_url.strip().startswith("data:image"):
-                            try:
-                                # 解析 Data URI: data:[<mime_type>];base64,[<data>]
-                                header, encoded_data = image_url.split(",", 1)
-                                mime_type = header.split(";")[0].split(":")[1]
-                                # 将 base64 字符串解码为字节
-                                decoded_data = base64.b64decode(encoded_data)
-                                parts.append(Part.from_data(data=decoded_data, mime_type=mime_type))
-                            except (ValueError, IndexError) as e:
-                                raise ValueError(f"无效的 Base64 Data URI 格式: {e}")
-                        # 4. 检查是否为本地文件
-                        elif os.path.isfile(image_url):
-                            mime_type, _ = mimetypes.guess_type(image_url)
-                            if not mime_type:
-                                raise ValueError(f"无法确定文件 '{image_url}' 的 MIME 类型。")
-                                
-                            with open(image_url, "rb") as f:
-                                image_data = f.read()
-                            return Part.from_data(data=image_data, mime_type=mime_type)
-
-                        # 5. 如果以上都不是，则是无效输入
+                        if images is None:
+                            image = load_inline_image(image_url)
                         else:
-                            raise FileNotFoundError(
-                                f"输入 '{image_url}' 不是一个有效的 GCS URI、HTTPS URL、Base64 Data URI 或存在的本地文件路径。"
-                            )
+                            image = images.get(image_url)
+                        if isinstance(image, Exception):
+                            raise image
+                        if image is not None:
+                            image_data, mime_type = image
+                            parts.append(Part.from_bytes(data=image_data, mime_type=mime_type))
+                        else:
+                            mime_type, _ = mimetypes.guess_type(image_url)
+                            parts.append(Part.from_uri(file_uri=image_url, mime_type=mime_type))
                     except Exception as e:
-                        print(f"错误: 处理图片时出错 - {str(e)}")
+                        tracing.event("image_error", error=True, url=image_url[:200], message=str(e))
                         continue
     else:
         # 其他格式，转为文本
-        parts.append(Part.from_text(str(content)))
+        parts.append(Part.from_text(text=str(content)))
     
     return parts
 
 
+def should_stream_parse(content_length):
+    """请求体较大时使用流式解析"""
+    return STREAMING_PARSE_MIN_BYTES > 0 and (content_length or 0) >= STREAMING_PARSE_MIN_BYTES
+
+
+def read_request_json():
+    """读取 Flask 请求体，返回 (data, blobs)"""
+    if not should_stream_parse(request.content_length):
+        return request.get_json(), None
+    parser = StreamingRequestParser()
+    while True:
+        chunk = request.stream.read(READ_CHUNK_SIZE)
+        if not chunk:
+            break
+        parser.feed(chunk)
+    return parser.finish()
+
+
+def parse_chat_request(data, blobs=None):
+    """将 OpenAI 格式的请求体转换为 Vertex AI 调用所需的参数"""
+    types = sdk().types
+    model = models.resolve(data)
+    # 超长的多轮对话先压缩历史，被丢弃的消息和图片不再转换或下载
+    messages = compaction.compact(data, model["model"], blobs)
+    # OpenAI到Vertex AI的基本转换
+    system_instruction = None
+    contents = []
+
+    # 并发下载请求中的所有远程图片
+    fetched_images = None
+    if IMAGE_FETCH_MODE == "fetch":
+        with metrics.phase("image_fetch"):
+            fetched_images = fetch_images(collect_remote_image_urls(messages))
+    # 内联图片在上传前缩小、重新编码，同一请求中的多张图片并发处理
+    images, image_bytes_saved = prepare_images(messages, fetched_images, blobs)
+
+    for msg in messages:
+        role = msg.get("role")
+        content = msg.get("content", "")
+
+        if role == "system":
+            system_instruction = content
+        elif role == "assistant":
+            # assistant -> model
+            contents.append(types.Content(role="model", parts=process_message_content(content, images)))
+        elif role == "user":
+            contents.append(types.Content(role="user", parts=process_message_content(content, images)))
+
+    # 基本生成配置
+    config_params = {}
+    if 'temperature' in data:
+        config_params['temperature'] = data['temperature']
+    if 'top_p' in data:
+        config_params['top_p'] = data['top_p']
+    if 'max_output_tokens' in data:
+        config_params['max_output_tokens'] = data['max_output_tokens']
+
+    return {
+        "model_name": model["model"],
+        "thinking_budget": model["thinking_budget"],
+        "system_instruction": system_instruction,
+        "contents": contents,
+        "context_prefixes": context_cache.find_prefixes(model["model"], system_instruction, contents),
+        "generation_config": config_params or None,
+        "safety_settings": sdk().safety_settings(data),
+        "stream": data.get('stream', False),
+        "include_usage": (data.get('stream_options') or {}).get('include_usage', False),
+        "image_bytes_saved": image_bytes_saved,
+    }
+
+
+def upstream_generate(chat_req, stream=False):
+    """在后端池中选择一个后端调用上游，stream=True 时返回流式迭代器"""
+    def call(backend):
+        tracing.annotate(backend=backend.name)
+        with metrics.phase("model"):
+            client = sdk().client_for(backend)
+        cached = context_cache.lookup(chat_req, backend)
+        if cached is not None:
+            try:
+                return sdk().generate(client, chat_req, stream, cached)
+            except Exception as e:
+                if not context_cache.is_missing(e):
+                    raise
+                context_cache.invalidate(backend, cached)
+        return sdk().generate(client, chat_req, stream)
+
+    return backend_pool.stream(call) if stream else backend_pool.call(call)
+
+
+async def upstream_generate_async(chat_req, stream=False):
+    """upstream_generate 的异步版本"""
+    async def call(backend):
+        tracing.annotate(backend=backend.name)
+        with metrics.phase("model"):
+            client = sdk().client_for(backend)
+        cached = context_cache.lookup(chat_req, backend)
+        if cached is not None:
+            try:
+                return await sdk().generate_async(client, chat_req, stream, cached)
+            except Exception as e:
+                if not context_cache.is_missing(e):
+                    raise
+                context_cache.invalidate(backend, cached)
+        return await sdk().generate_async(client, chat_req, stream)
+
+    if stream:
+        return await backend_pool.stream_async(call)
+    return await backend_pool.call_async(call)
+
+
+def stream_usage(chat_req, state):
+    """流式响应的usage信息: 优先使用上游返回的 usage_metadata，否则对已发送的文本估算一次"""
+    usage = usage_from_metadata(state["usage_metadata"])
+    if usage is None:
+        usage = estimate_usage(chat_req["contents"], count_text_tokens("".join(state["texts"])),
+                               chat_req["system_instruction"])
+    return usage
+
+
+def streamed_tokens(state):
+    """流式响应已生成的 completion token 数(提前结束时记录)"""
+    usage = usage_from_metadata(state["usage_metadata"])
+    if usage is not None:
+        return usage["completion_tokens"]
+    return count_text_tokens("".join(state["texts"]))
+
+
+def completion_payload(content, usage, model_name):
+    """构造 OpenAI 格式的非流式响应"""
+    return {
+        "id": tracing.completion_id(),
+        "object": "chat.completion",
+        "created": int(time.time()),
+        "model": model_name,
+        "choices": [{
+            "index": 0,
+            "message": {
+                "role": "assistant",
+                "content": content
+            },
+            "finish_reason": "stop"
+        }],
+        "usage": usage
+    }
+
+
+def build_completion(response, model_name):
+    """将上游的非流式响应转换为 OpenAI 格式"""
+    return completion_payload(response.text or "", usage_from_metadata(response.usage_metadata) or {
+        "prompt_tokens": 0,
+        "completion_tokens": 0,
+        "total_tokens": 0
+    }, model_name)
+
+
+def sse_stream(chat_req, response_stream, deadline=None):
+    """将上游流式响应转换为 SSE 帧
+
+    客户端断开后服务器会关闭本生成器，此时同时关闭上游流；超过 deadline 时停止生成，以 finish_reason=length 结束。
+    """
+    model_name = chat_req["model_name"]
+    frames = StreamFrames(tracing.completion_id(), int(time.time()), model_name)
+    state = {"usage_metadata": None, "texts": [], "finish_reason": "stop", "started": False}
+    timer = metrics.StreamTimer(model_name)
+
+    def texts():
+        state["started"] = True
+        # 有生成时限时由后台线程读取上游，上游卡住时也能按时结束
+        chunks = response_stream if deadline is None else read_until(response_stream, deadline)
+        try:
+            for chunk in chunks:
+                # 上游在(最后的)chunk中返回累计的usage信息
+                if chunk.usage_metadata and chunk.usage_metadata.total_token_count:
+                    state["usage_metadata"] = chunk.usage_metadata
+                if chunk.text:
+                    timer.chunk()
+                    state["texts"].append(chunk.text)
+                    yield chunk.text
+        except TimeoutError:
+            state["finish_reason"] = "length"
+        finally:
+            close_stream(chunks)
+
+    text_stream = coalesce_texts(texts())
+    try:
+        # 首个chunk包含角色信息
+        yield frames.role()
+
+        # 流式内容
+        for text in text_stream:
+            yield frames.content(text)
+    except GeneratorExit:
+        metrics.record_cancelled(model_name, "client_disconnect", streamed_tokens(state))
+        raise
+    finally:
+        close_stream(text_stream)
+        if not state["started"]:
+            close_stream(response_stream)
+
+    timer.finish()
+    metrics.record_usage(model_name, usage_from_metadata(state["usage_metadata"]))
+    if state["finish_reason"] == "length":
+        tracing.event("deadline_exceeded", error=True, completion_tokens=streamed_tokens(state))
+        metrics.record_cancelled(model_name, "deadline", streamed_tokens(state))
+
+    # 结束标记，如果需要包含usage信息，在最终chunk中添加
+    usage = None
+    if chat_req["include_usage"]:
+        usage = stream_usage(chat_req, state)
+    yield frames.final(usage, state["finish_reason"])
+    yield "data: [DONE]\n\n"
+
+
+def replay_stream(cached, model_name, include_usage):
+    """以 SSE 形式回放缓存的响应"""
+    frames = StreamFrames(tracing.completion_id(), int(time.time()), model_name)
+    yield frames.role()
+    yield frames.content(cached["content"])
+    yield frames.final(cached["usage"] if include_usage else None)
+    yield "data: [DONE]\n\n"
+
+
+def health_payload():
+    """健康检查响应内容"""
+    return {
+        "status": "healthy" if startup.ready() else "starting",
+        "service": "gemini-proxy-vertex",
+        "model": models.DEFAULT_MODEL,
+        "startup": startup.stats(),
+    }
+
+
+def _connect(backend):
+    """获取凭据，为后端创建 Client 并与上游建立连接(包括 TLS 握手)"""
+    startup.run_once("credentials", sdk().refresh_credentials)
+    sdk().connect(backend, startup.WARMUP_TIMEOUT)
+
+
+def warmup():
+    """预热: 导入 SDK，并为每个后端获取凭据、建立连接"""
+    sdk()
+    for backend in backend_pool.backends:
+        startup.run_once(f"connect:{backend.name}", lambda: _connect(backend))
+
+
+startup.on_warmup(warmup)
+
+
+def complete_chat(data):
+    """执行一次非流式补全(批处理使用)，同样使用响应缓存和重试"""
+    chat_req = parse_chat_request(dict(data, stream=False))
+    model_name = chat_req["model_name"]
+    cache_key = response_cache.cache_key(chat_req, data) if response_cache.is_cacheable(data) else None
+    cached = response_cache.get(cache_key)
+    if cached:
+        return completion_payload(cached["content"], cached["usage"], model_name)
+    result = call_with_retry(lambda: upstream_generate(chat_req), deadline_from_headers({}))
+    response_data = build_completion(result, model_name)
+    response_cache.put(cache_key, response_data)
+    metrics.record_usage(model_name, response_data["usage"])
+    return response_data
+
+
+# 注册批处理的请求处理函数；已退出进程遗留的批处理任务在工作进程启动后接管
+batches.start(complete_chat, parse_chat_request, build_completion)
+startup.on_start(batches.resume)
+# 对话历史的摘要同样通过 complete_chat 生成
+compaction.start(complete_chat)
+
+
+def upstream_embed(model_name, texts, dimensions=None, task_type=None):
+    """调用上游计算一批文本的 embedding，由 embeddings 的批处理线程调用"""
+    def call(backend):
+        return sdk().embed(sdk().client_for(backend), model_name, texts, dimensions, task_type)
+
+    return call_with_retry(lambda: backend_pool.call(call), deadline_from_headers({}))
+
+
+embeddings.start(upstream_embed)
+
+
 @app.route('/health', methods=['GET'])
+@app.route('/health/ready', methods=['GET'])
 def health_check():
-    """健康检查接口"""
-    return jsonify({
-        "status": "healthy",
-        "service": "gemini-proxy-vertex",
-        "model": "gemini-2.5-pro" 
-    })
+    """就绪检查接口，预热完成前返回 503"""
+    startup.begin()
+    response = jsonify(health_payload())
+    response.status_code = 200 if startup.ready() else 503
+    return response
+
+@app.route('/health/live', methods=['GET'])
+def liveness_check():
+    """存活检查接口"""
+    return jsonify({"status": "alive"})
+
+@app.route('/v1/models', methods=['GET'])
+@app.route('/models', methods=['GET'])
+def list_models():
+    """可用模型列表"""
+    return jsonify(models.list_models())
+
+@app.route('/v1/models/<path:model>', methods=['GET'])
+@app.route('/models/<path:model>', methods=['GET'])
+def get_model_info(model):
+    """模型信息"""
+    try:
+        return jsonify(models.get_model_info(model))
+    except models.ModelNotFound as e:
+        response = jsonify({"error": str(e)})
+        response.status_code = e.code
+        return response
+
+def batch_error(e):
+    """批处理接口的错误响应"""
+    response = jsonify({"error": str(e)})
+    response.status_code = e.code
+    return response
+
+def batch_api(fn, *args):
+    """调用批处理接口，错误转换为 JSON 响应"""
+    try:
+        return jsonify(fn(*args))
+    except batches.BatchError as e:
+        return batch_error(e)
+
+@app.route('/v1/files', methods=['POST'])
+def upload_file():
+    """上传批处理输入文件 (multipart/form-data: file, purpose)"""
+    upload = request.files.get('file')
+    if upload is None:
+        return batch_error(batches.BatchError("缺少 file 字段"))
+    return batch_api(batches.create_file, upload.stream, upload.filename, request.form.get('purpose'))
+
+@app.route('/v1/files', methods=['GET'])
+def list_files():
+    """文件列表"""
+    return batch_api(batches.list_files, request.args.get('purpose'))
+
+@app.route('/v1/files/<file_id>', methods=['GET'])
+def get_file(file_id):
+    """文件信息"""
+    return batch_api(batches.get_file, file_id)
+
+@app.route('/v1/files/<file_id>', methods=['DELETE'])
+def delete_file(file_id):
+    """删除文件"""
+    return batch_api(batches.delete_file, file_id)
+
+@app.route('/v1/files/<file_id>/content', methods=['GET'])
+def get_file_content(file_id):
+    """下载文件内容"""
+    try:
+        return send_file(batches.file_content_path(file_id), mimetype='application/jsonl')
+    except batches.BatchError as e:
+        return batch_error(e)
+
+@app.route('/v1/batches', methods=['POST'])
+def create_batch():
+    """创建批处理任务"""
+    return batch_api(batches.create_batch, request.get_json(silent=True) or {})
+
+@app.route('/v1/batches', methods=['GET'])
+def list_batches():
+    """批处理任务列表"""
+    return batch_api(batches.list_batches, request.args.get('limit', 20, type=int), request.args.get('after'))
+
+@app.route('/v1/batches/<batch_id>', methods=['GET'])
+def get_batch(batch_id):
+    """批处理任务状态和进度"""
+    return batch_api(batches.get_batch, batch_id)
+
+@app.route('/v1/batches/<batch_id>/cancel', methods=['POST'])
+def cancel_batch(batch_id):
+    """取消批处理任务"""
+    return batch_api(batches.cancel_batch, batch_id)
+
+@app.route('/stats', methods=['GET'])
+def stats():
+    """缓存统计信息"""
+    return jsonify({"caches": all_stats(), "retry": retry.stats(), "upstream": backend_pool.stats(),
+                    "response_cache": response_cache.stats(), "coalescing": singleflight.stats(), "admission": admission.stats(),
+                    "batches": batches.stats(), "embeddings": embeddings.stats(), "tracing": tracing.stats(),
+                    "startup": startup.stats()})
+
+@app.route('/metrics', methods=['GET'])
+def prometheus_metrics():
+    """Prometheus 指标"""
+    body, content_type = metrics.render()
+    return Response(body, content_type=content_type)
+
+def finish_request(response, model_name, stream, trace):
+    """记录请求指标，添加请求 ID 响应头；流式响应在发送结束(或客户端断开)后才算完成"""
+    status_code = response.status_code if response is not None else 500
+    metrics.REQUESTS.labels(model_name, str(stream).lower(), str(status_code)).inc()
+    if response is not None:
+        response.headers.update(trace.headers())
+    if response is not None and response.is_streamed:
+        response.call_on_close(metrics.IN_FLIGHT.dec)
+        response.call_on_close(lambda: tracing.finish(trace, status_code))
+    else:
+        metrics.IN_FLIGHT.dec()
+        tracing.finish(trace, status_code)
+    metrics.sync_cache_stats()
 
 @app.route('/v1/chat/completions', methods=['POST'])
 @app.route('/chat/completions', methods=['POST'])
 def chat_completions():
     """聊天接口 - 协议转换代理"""
+    metrics.IN_FLIGHT.inc()
+    trace = tracing.start(request.method, request.path, request.headers)
+    model_name = "unknown"
+    stream = False
+    response = None
     try:
-        data = request.get_json()
-        messages = data.get('messages', [])
-        stream = data.get('stream', False)
-        model_name = "gemini-2.5-pro"
-        # OpenAI到Vertex AI的基本转换
-        system_instruction = None
-        contents = []
-        
-        for msg in messages:
-            role = msg.get("role")
-            content = msg.get("content", "")
-            
-            if role == "system":
-                system_instruction = content
-            elif role == "assistant":
-                # assistant -> model
-                contents.append(Content(role="model", parts=process_message_content(content)))
-            elif role == "user":
-                contents.append(Content(role="user", parts=process_message_content(content)))
-        
-        # 创建模型
-        model_kwargs = {}
-        if system_instruction:
-            model_kwargs['system_instruction'] = system_instruction
-        model = GenerativeModel(model_name, **model_kwargs)
-
-        # 基本生成配置
-        config_params = {}
-        if 'temperature' in data:
-            config_params['temperature'] = data['temperature']
-        if 'top_p' in data:
-            config_params['top_p'] = data['top_p']
-        if 'max_output_tokens' in data:
-            config_params['max_output_tokens'] = data['max_output_tokens']
-        
-        generation_config = GenerationConfig(**config_params) if config_params else None
-        
+        with metrics.phase("parse"):
+            data, blobs = read_request_json()
+        with metrics.phase("admission"):
+            admission.admit(data, request.headers)
+        with metrics.phase("convert"):
+            chat_req = parse_chat_request(data, blobs)
+        model_name = chat_req["model_name"]
+        stream = chat_req["stream"]
+        trace.annotate(model=model_name, stream=stream)
+        deadline = deadline_from_headers(request.headers)
+
+        # 规范化请求摘要，用于响应缓存和相同请求合并
+        request_key = None
+        if response_cache.is_cacheable(data) or singleflight.COALESCE_ENABLED:
+            request_key = response_cache.cache_key(chat_req, data)
+
+        # temperature=0 的请求可以直接使用缓存的响应
+        cache_key = request_key if response_cache.is_cacheable(data) else None
+        cached = response_cache.get(cache_key)
+        cache_headers = {"X-Cache": "BYPASS" if cache_key is None else ("HIT" if cached else "MISS")}
+        trace.annotate(cache=cache_headers["X-Cache"], image_bytes_saved=chat_req["image_bytes_saved"])
+        if chat_req["image_bytes_saved"]:
+            cache_headers["X-Image-Bytes-Saved"] = str(chat_req["image_bytes_saved"])
+        if cached:
+            if stream:
+                response = Response(replay_stream(cached, model_name, chat_req["include_usage"]),
+                                    mimetype='text/event-stream', headers=cache_headers)
+            else:
+                response = jsonify(completion_payload(cached["content"], cached["usage"], model_name))
+                response.headers.update(cache_headers)
+            return response
+
         if stream:
             def generate_stream():
-                response_id = f"chatcmpl-{uuid.uuid4()}"
-                created_time = int(time.time())
-                
-                # 检查是否需要包含usage信息
-                include_usage = data.get('stream_options', {}).get('include_usage', False)
-                
-                generate_params = {'contents': contents, 'stream': True}
-                if generation_config:
-                    generate_params['generation_config'] = generation_config
-                
-                response_stream = model.generate_content(**generate_params)
-                
-                # 初始化token计数变量
-                prompt_tokens = 0
-                completion_tokens = 0
-                total_tokens = 0
-                full_response_text = ""
-                
-                # 首个chunk包含角色信息
-                first_chunk = {
-                    "id": response_id,
-                    "object": "chat.completion.chunk",
-                    "created": created_time,
-                    "model": model_name,
-                    "choices": [{
-                        "index": 0,
-                        "delta": {"role": "assistant", "content": ""},
-                        "finish_reason": None
-                    }]
-                }
-                yield f"data: {json.dumps(first_chunk)}\n\n"
-
-                # 流式内容
-                for chunk in response_stream:
-                    if chunk.text:
-                        # 累积完整响应文本用于后续计算
-                        full_response_text += chunk.text
-                        
-                        chunk_data = {
-                            "id": response_id,
-                            "object": "chat.completion.chunk",
-                            "created": created_time,
-                            "model": model_name,
-                            "choices": [{
-                                "index": 0,
-                                "delta": {"content": chunk.text},
-                                "finish_reason": None
-                            }]
-                        }
-                        yield f"data: {json.dumps(chunk_data)}\n\n"
-
-                # 结束标记
-                final_chunk = {
-                    "id": response_id,
-                    "object": "chat.completion.chunk",
-                    "created": created_time,
-                    "model": model_name,
-                    "choices": [{
-                        "index": 0,
-                        "delta": {},
-                        "finish_reason": "stop"
-                    }]
-                }
-                
-                # 如果需要包含usage信息，在最终chunk中添加
-                if include_usage:
-                    # 手动计算usage信息
-                    # 计算输入token数量（粗略估算）
-                    input_text = ""
-                    for content in contents:
-                        for part in content.parts:
-                            if hasattr(part, 'text') and part.text:
-                                input_text += part.text + " "
-                    
-                    # 使用简单的token估算方法（按空格分割）
-                    prompt_tokens = len(input_text.split())
-                    completion_tokens = len(full_response_text.split())
-                    total_tokens = prompt_tokens + completion_tokens
-                    
-                    final_chunk["usage"] = {
-                        "prompt_tokens": prompt_tokens,
-                        "completion_tokens": completion_tokens,
-                        "total_tokens": total_tokens
-                    }
-                
-                yield f"data: {json.dumps(final_chunk)}\n\n"
-                yield "data: [DONE]\n\n"
-            
-            return Response(generate_stream(), mimetype='text/event-stream')
+                try:
+                    response_stream = inflight.stream(request_key, lambda: stream_with_retry(
+                        lambda: upstream_generate(chat_req, stream=True), deadline))
+                    yield from sse_stream(chat_req, response_stream, deadline)
+                except Exception as e:
+                    # 响应头已经发出，错误只能记录在 trace 中
+                    trace.fail(e)
+                    raise
+
+            response = Response(generate_stream(), mimetype='text/event-stream', headers=cache_headers)
+            return response
         else:
-            generate_params = {'contents': contents}
-            if generation_config:
-                generate_params['generation_config'] = generation_config
-            
-            response = model.generate_content(**generate_params)
-
-            response_data = {
-                "id": f"chatcmpl-{uuid.uuid4()}",
-                "object": "chat.completion",
-                "created": int(time.time()),
-                "model": model_name,
-                "choices": [{
-                    "index": 0,
-                    "message": {
-                        "role": "assistant",
-                        "content": response.text
-                    },
-                    "finish_reason": "stop"
-                }],
-                "usage": {
-                    "prompt_tokens": response.usage_metadata.prompt_token_count if response.usage_metadata else 0,
-                    "completion_tokens": response.usage_metadata.candidates_token_count if response.usage_metadata else 0,
-                    "total_tokens": response.usage_metadata.total_token_count if response.usage_metadata else 0
-                }
-            }
-            return jsonify(response_data)
-            
+            with metrics.phase("upstream"):
+                result = inflight.call(
+                    request_key, lambda: call_with_retry(lambda: upstream_generate(chat_req), deadline, hedge=True))
+            response_data = build_completion(result, model_name)
+            response_cache.put(cache_key, response_data)
+            metrics.record_usage(model_name, response_data["usage"])
+            response = jsonify(response_data)
+            response.headers.update(cache_headers)
+            return response
+
     except Exception as e:
-        return jsonify({"error": str(e)}), 500
+        response = jsonify({"error": str(e)})
+        response.status_code = error_status(e)
+        if isinstance(e, admission.RateLimited):
+            response.headers["Retry-After"] = str(e.retry_after)
+        trace.fail(e)
+        return response
+    finally:
+        finish_request(response, model_name, stream, trace)
+
+@app.route('/v1/embeddings', methods=['POST'])
+@app.route('/embeddings', methods=['POST'])
+def create_embeddings():
+    """Embedding 接口 - 并发的小请求在服务端合并成批调用上游"""
+    metrics.IN_FLIGHT.inc()
+    trace = tracing.start(request.method, request.path, request.headers)
+    model_name = "unknown"
+    stream = False
+    response = None
+    try:
+        data = request.get_json(silent=True) or {}
+        with metrics.phase("admission"):
+            admission.admit(data, request.headers)
+        embed_req = embeddings.parse_request(data)
+        model_name = embed_req["model"]
+        stream = embed_req["stream"]
+        trace.annotate(model=model_name, stream=stream, inputs=len(embed_req["inputs"]))
+        timeout = deadline_from_headers(request.headers) - time.monotonic()
+        futures = embeddings.submit(embed_req)
+
+        if stream:
+            def generate_stream():
+                usage = {}
+                try:
+                    yield from embeddings.stream(embed_req, futures, timeout, usage)
+                except Exception as e:
+                    trace.fail(e)
+                    raise
+                metrics.record_usage(model_name, usage)
+
+            response = Response(generate_stream(), mimetype='text/event-stream')
+            return response
+        with metrics.phase("embed"):
+            response_data = embeddings.create(embed_req, futures, timeout)
+        metrics.record_usage(model_name, response_data["usage"])
+        response = jsonify(response_data)
+        return response
+
+    except Exception as e:
+        response = jsonify({"error": str(e)})
+        response.status_code = error_status(e)
+        if isinstance(e, admission.RateLimited):
+            response.headers["Retry-After"] = str(e.retry_after)
+        trace.fail(e)
+        return response
+    finally:
+        finish_request(response, model_name, stream, trace)
+
+startup.record("import", time.perf_counter() - _import_start)
 
 if __name__ == '__main__':
     port = int(os.getenv('PORT', 8080))
     debug = os.getenv('DEBUG', 'True').lower() == 'true'
-    
+    # debug 模式下 Werkzeug 的重载器在子进程中运行应用，监视文件的父进程不执行启动步骤
+    if not debug or os.getenv('WERKZEUG_RUN_MAIN') == 'true':
+        startup.begin()
+
     print(f"🚀 Gemini代理服务启动: http://localhost:{port}")
     app.run(host='0.0.0.0', port=port, debug=debug) 
\ No newline at end of file
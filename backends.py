@@ -0,0 +1,234 @@
+"""
+多区域 / 多项目的 Vertex AI 后端池
+
+VERTEX_BACKENDS 配置多个 (project, location, 权重)，格式:
+    project-a:us-central1:3,project-b:europe-west4:1
+未配置时只使用 GOOGLE_CLOUD_PROJECT / GOOGLE_CLOUD_LOCATION 一个后端。
+
+- 选择策略: 加权轮询(round_robin) 或 最少进行中请求(least_outstanding)
+- 每个后端独立统计健康状况，连续失败达到阈值后熔断一段时间，之后放行一个试探请求
+- 后端返回限流/不可用错误时，在同一次调用中立即切换到其他后端
+"""
+import os
+import threading
+import time
+
+import metrics
+import tracing
+from retry import classify_error, error_status
+
+BACKEND_STRATEGY = os.getenv("BACKEND_STRATEGY", "round_robin").lower()
+CIRCUIT_FAILURE_THRESHOLD = int(os.getenv("CIRCUIT_FAILURE_THRESHOLD", 5))
+CIRCUIT_OPEN_SECONDS = float(os.getenv("CIRCUIT_OPEN_SECONDS", 30))
+
+
+class Backend:
+    """一个 (project, location) 后端"""
+
+    def __init__(self, project, location, weight=1):
+        self.project = project
+        self.location = location
+        self.weight = weight
+        self.name = f"{project}/{location}"
+        self.outstanding = 0
+        self.current_weight = 0
+        self.consecutive_failures = 0
+        self.open_until = 0.0
+        self.trial_in_flight = False
+        self.requests = 0
+        self.failures = 0
+
+    def available(self, now):
+        """熔断关闭，或熔断时间已过且没有试探请求在进行"""
+        if self.open_until <= 0:
+            return True
+        return now >= self.open_until and not self.trial_in_flight
+
+    def stats(self):
+        return {
+            "project": self.project,
+            "location": self.location,
+            "weight": self.weight,
+            "outstanding": self.outstanding,
+            "requests": self.requests,
+            "failures": self.failures,
+            "circuit_open": self.open_until > 0,
+        }
+
+
+def parse_backends(spec, default_project, default_location):
+    """解析 VERTEX_BACKENDS 配置"""
+    backends = []
+    for item in (spec or "").split(","):
+        item = item.strip()
+        if not item:
+            continue
+        fields = item.split(":")
+        if len(fields) < 2:
+            raise ValueError(f"无效的后端配置 '{item}'，格式应为 project:location[:weight]")
+        weight = int(fields[2]) if len(fields) > 2 else 1
+        backends.append(Backend(fields[0], fields[1], weight))
+    if not backends:
+        backends.append(Backend(default_project, default_location))
+    return backends
+
+
+class BackendPool:
+    """后端池，负责选择后端、统计进行中请求、熔断与故障切换"""
+
+    def __init__(self, backends, strategy=BACKEND_STRATEGY):
+        self.backends = backends
+        self.strategy = strategy
+        self._lock = threading.Lock()
+        self.failovers = 0
+
+    def acquire(self, exclude=()):
+        """选择一个后端并计入进行中请求"""
+        now = time.monotonic()
+        with self._lock:
+            candidates = [b for b in self.backends if b not in exclude and b.available(now)]
+            if not candidates:
+                # 全部熔断时选择最早恢复的后端，而不是直接拒绝请求
+                candidates = [b for b in self.backends if b not in exclude] or self.backends
+                candidates = [min(candidates, key=lambda b: b.open_until)]
+
+            if self.strategy == "least_outstanding":
+                backend = min(candidates, key=lambda b: b.outstanding / b.weight)
+            else:
+                # 平滑加权轮询
+                total = sum(b.weight for b in candidates)
+                for b in candidates:
+                    b.current_weight += b.weight
+                backend = max(candidates, key=lambda b: b.current_weight)
+                backend.current_weight -= total
+
+            if backend.open_until > 0:
+                backend.trial_in_flight = True
+            backend.outstanding += 1
+            backend.requests += 1
+            return backend
+
+    def release(self, backend, error=None):
+        """请求结束，记录后端健康状况"""
+        metrics.UPSTREAM_RESPONSES.labels(backend.name, str(200 if error is None else error_status(error))).inc()
+        with self._lock:
+            backend.outstanding -= 1
+            backend.trial_in_flight = False
+            if error is not None and classify_error(error) is not None:
+                backend.failures += 1
+                backend.consecutive_failures += 1
+                if backend.open_until > 0 or backend.consecutive_failures >= CIRCUIT_FAILURE_THRESHOLD:
+                    backend.open_until = time.monotonic() + CIRCUIT_OPEN_SECONDS
+                    print(f"警告: 后端 {backend.name} 熔断 {CIRCUIT_OPEN_SECONDS} 秒 - {str(error)}")
+            else:
+                backend.consecutive_failures = 0
+                backend.open_until = 0.0
+
+    def _should_failover(self, error, tried):
+        if classify_error(error) is None or len(tried) >= len(self.backends):
+            return False
+        with self._lock:
+            self.failovers += 1
+        tracing.event("failover", backend=tried[-1].name, error=str(error))
+        return True
+
+    def call(self, fn):
+        """调用 fn(backend)，限流/不可用时切换到其他后端"""
+        tried = []
+        while True:
+            backend = self.acquire(exclude=tried)
+            tried.append(backend)
+            try:
+                result = fn(backend)
+            except Exception as e:
+                self.release(backend, e)
+                if self._should_failover(e, tried):
+                    continue
+                raise
+            self.release(backend)
+            return result
+
+    def stream(self, fn):
+        """调用 fn(backend) 得到流式迭代器，首个 chunk 之前出错时切换后端；流结束后才释放后端"""
+        tried = []
+        while True:
+            backend = self.acquire(exclude=tried)
+            tried.append(backend)
+            try:
+                stream = iter(fn(backend))
+                first = next(stream, None)
+            except Exception as e:
+                self.release(backend, e)
+                if self._should_failover(e, tried):
+                    continue
+                raise
+            return self._stream_until_done(backend, first, stream)
+
+    def _stream_until_done(self, backend, first, stream):
+        error = None
+        try:
+            if first is not None:
+                yield first
+                yield from stream
+        except Exception as e:
+            error = e
+            raise
+        finally:
+            self.release(backend, error)
+
+    async def call_async(self, fn):
+        """call 的异步版本，fn(backend) 返回协程"""
+        tried = []
+        while True:
+            backend = self.acquire(exclude=tried)
+            tried.append(backend)
+            try:
+                result = await fn(backend)
+            except Exception as e:
+                self.release(backend, e)
+                if self._should_failover(e, tried):
+                    continue
+                raise
+            self.release(backend)
+            return result
+
+    async def stream_async(self, fn):
+        """stream 的异步版本，fn(backend) 返回(可等待的)异步迭代器"""
+        tried = []
+        while True:
+            backend = self.acquire(exclude=tried)
+            tried.append(backend)
+            try:
+                stream = (await fn(backend)).__aiter__()
+                try:
+                    first = await stream.__anext__()
+                except StopAsyncIteration:
+                    first = None
+            except Exception as e:
+                self.release(backend, e)
+                if self._should_failover(e, tried):
+                    continue
+                raise
+            return self._astream_until_done(backend, first, stream)
+
+    async def _astream_until_done(self, backend, first, stream):
+        error = None
+        try:
+            if first is not None:
+                yield first
+                async for item in stream:
+                    yield item
+        except Exception as e:
+            error = e
+            raise
+        finally:
+            self.release(backend, error)
+
+    def stats(self):
+        """返回后端池统计信息"""
+        with self._lock:
+            return {
+                "strategy": self.strategy,
+                "failovers": self.failovers,
+                "backends": [b.stats() for b in self.backends],
+            }
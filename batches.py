@@ -0,0 +1,584 @@
+"""
+批处理 (OpenAI 兼容的 /v1/files 和 /v1/batches)
+
+- 上传 JSONL 文件(purpose=batch)，每行一个请求:
+    {"custom_id": "req-1", "method": "POST", "url": "/v1/chat/completions", "body": {...}}
+- 创建批处理任务后在后台执行，并发数由 BATCH_CONCURRENCY 限制，复用聊天接口的请求转换和上游调用(含重试、缓存)
+- BATCH_BACKEND=vertex 时把请求转换后上传到 BATCH_GCS_URI，提交 Vertex AI 批量预测任务，结束后下载结果
+- 文件和任务状态保存在 BATCH_DIR 下(SQLite + 文件)，同一台机器上的所有工作进程共享；
+  执行任务的进程退出后，新启动的进程会接管任务，已有结果的请求不会重复执行
+"""
+import contextlib
+import json
+import os
+import socket
+import sqlite3
+import tempfile
+import threading
+import time
+import uuid
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+from retry import error_status
+
+BATCH_DIR = os.getenv("BATCH_DIR", os.path.join(tempfile.gettempdir(), "llm-proxy-batches"))
+BATCH_CONCURRENCY = int(os.getenv("BATCH_CONCURRENCY", 8))
+BATCH_BACKEND = os.getenv("BATCH_BACKEND", "local").lower()
+# Vertex AI 批量预测的输入/输出位置，如 gs://my-bucket/llm-proxy-batches
+BATCH_GCS_URI = os.getenv("BATCH_GCS_URI", "").rstrip("/")
+BATCH_POLL_SECONDS = float(os.getenv("BATCH_POLL_SECONDS", 30))
+BATCH_MAX_FILE_BYTES = int(os.getenv("BATCH_MAX_FILE_BYTES", 200 * 1024 * 1024))
+BATCH_MAX_REQUESTS = int(os.getenv("BATCH_MAX_REQUESTS", 50000))
+
+SUPPORTED_ENDPOINTS = ("/v1/chat/completions",)
+_ACTIVE_STATES = ("validating", "in_progress", "finalizing", "cancelling")
+_COMPLETION_WINDOW = 24 * 3600
+# 任务进度写回数据库的最小间隔(秒)
+_PROGRESS_INTERVAL = 1.0
+_READ_CHUNK_SIZE = 64 * 1024
+
+_local = threading.local()
+# 由应用在启动时注册: complete(body) -> 补全结果, parse(body) -> chat_req, build(response, model_name) -> 补全结果
+_handlers = {}
+_running = set()
+_running_lock = threading.Lock()
+
+
+class BatchError(Exception):
+    """批处理请求无效"""
+
+    code = 400
+
+
+class NotFound(BatchError):
+    """文件或任务不存在"""
+
+    code = 404
+
+
+def _worker_id():
+    return f"{socket.gethostname()}:{os.getpid()}"
+
+
+def _db():
+    """每个线程使用独立的 SQLite 连接"""
+    conn = getattr(_local, "conn", None)
+    if conn is None:
+        os.makedirs(os.path.join(BATCH_DIR, "files"), exist_ok=True)
+        conn = sqlite3.connect(os.path.join(BATCH_DIR, "batches.db"), timeout=10, isolation_level=None)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("CREATE TABLE IF NOT EXISTS files "
+                     "(id TEXT PRIMARY KEY, filename TEXT, purpose TEXT, bytes INTEGER, created_at INTEGER)")
+        conn.execute("CREATE TABLE IF NOT EXISTS batches "
+                     "(id TEXT PRIMARY KEY, status TEXT, worker TEXT, created_at INTEGER, data TEXT)")
+        _local.conn = conn
+    return conn
+
+
+# ---------------------------------------------------------------- 文件
+
+def _file_path(file_id):
+    return os.path.join(BATCH_DIR, "files", file_id)
+
+
+def _file_object(row):
+    file_id, filename, purpose, size, created_at = row
+    return {"id": file_id, "object": "file", "bytes": size, "created_at": created_at,
+            "filename": filename, "purpose": purpose}
+
+
+def _register_file(file_id, filename, purpose, size):
+    _db().execute("INSERT OR REPLACE INTO files (id, filename, purpose, bytes, created_at) VALUES (?, ?, ?, ?, ?)",
+                  (file_id, filename, purpose, size, int(time.time())))
+
+
+def create_file(stream, filename, purpose):
+    """保存上传的文件，stream 为可按块读取的文件对象"""
+    if purpose != "batch":
+        raise BatchError(f"不支持的文件用途 '{purpose}'，仅支持 batch")
+    file_id = f"file-{uuid.uuid4().hex}"
+    path = _file_path(file_id)
+    _db()
+    size = 0
+    try:
+        with open(path, "wb") as f:
+            while True:
+                chunk = stream.read(_READ_CHUNK_SIZE)
+                if not chunk:
+                    break
+                size += len(chunk)
+                if size > BATCH_MAX_FILE_BYTES:
+                    raise BatchError(f"文件超过 {BATCH_MAX_FILE_BYTES} 字节")
+                f.write(chunk)
+    except BaseException:
+        with contextlib.suppress(OSError):
+            os.remove(path)
+        raise
+    _register_file(file_id, filename or "upload.jsonl", purpose, size)
+    return get_file(file_id)
+
+
+def get_file(file_id):
+    row = _db().execute("SELECT id, filename, purpose, bytes, created_at FROM files WHERE id = ?",
+                        (file_id,)).fetchone()
+    if row is None:
+        raise NotFound(f"文件 '{file_id}' 不存在")
+    return _file_object(row)
+
+
+def list_files(purpose=None):
+    sql = "SELECT id, filename, purpose, bytes, created_at FROM files"
+    args = ()
+    if purpose:
+        sql += " WHERE purpose = ?"
+        args = (purpose,)
+    rows = _db().execute(sql + " ORDER BY created_at DESC", args).fetchall()
+    return {"object": "list", "data": [_file_object(row) for row in rows]}
+
+
+def file_content_path(file_id):
+    """返回文件内容在本地的路径"""
+    get_file(file_id)
+    return _file_path(file_id)
+
+
+def delete_file(file_id):
+    get_file(file_id)
+    _db().execute("DELETE FROM files WHERE id = ?", (file_id,))
+    try:
+        os.remove(_file_path(file_id))
+    except FileNotFoundError:
+        pass
+    return {"id": file_id, "object": "file", "deleted": True}
+
+
+# ---------------------------------------------------------------- 任务
+
+def _output_file_id(batch_id):
+    return f"file-{batch_id}-output"
+
+
+def _error_file_id(batch_id):
+    return f"file-{batch_id}-errors"
+
+
+def _public(batch):
+    """去掉内部字段"""
+    return {key: value for key, value in batch.items() if not key.startswith("_")}
+
+
+def _load_batch(batch_id):
+    row = _db().execute("SELECT data FROM batches WHERE id = ?", (batch_id,)).fetchone()
+    if row is None:
+        raise NotFound(f"批处理任务 '{batch_id}' 不存在")
+    return json.loads(row[0])
+
+
+def _update_batch(batch_id, **changes):
+    """原子地更新任务字段，request_counts 按键合并"""
+    conn = _db()
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        batch = json.loads(conn.execute("SELECT data FROM batches WHERE id = ?", (batch_id,)).fetchone()[0])
+        counts = changes.pop("request_counts", None)
+        if counts:
+            batch["request_counts"].update(counts)
+        batch.update(changes)
+        conn.execute("UPDATE batches SET status = ?, data = ? WHERE id = ?",
+                     (batch["status"], json.dumps(batch), batch_id))
+        conn.execute("COMMIT")
+        return batch
+    except Exception:
+        conn.execute("ROLLBACK")
+        raise
+
+
+def _read_requests(file_id):
+    """逐行读取批处理输入文件"""
+    with open(file_content_path(file_id), "r", encoding="utf-8") as f:
+        for line_no, line in enumerate(f, 1):
+            if not line.strip():
+                continue
+            try:
+                item = json.loads(line)
+            except ValueError:
+                raise BatchError(f"第 {line_no} 行不是有效的 JSON")
+            yield line_no, item
+
+
+def _validate_input(file_id, endpoint):
+    """检查输入文件，返回请求数"""
+    if get_file(file_id)["purpose"] != "batch":
+        raise BatchError(f"文件 '{file_id}' 的用途不是 batch")
+    custom_ids = set()
+    for line_no, item in _read_requests(file_id):
+        custom_id = item.get("custom_id")
+        if not custom_id or custom_id in custom_ids:
+            raise BatchError(f"第 {line_no} 行缺少 custom_id 或 custom_id 重复")
+        if item.get("url", endpoint) != endpoint or not isinstance(item.get("body"), dict):
+            raise BatchError(f"第 {line_no} 行的 url 必须为 {endpoint}，body 必须为对象")
+        custom_ids.add(custom_id)
+        if len(custom_ids) > BATCH_MAX_REQUESTS:
+            raise BatchError(f"请求数超过 {BATCH_MAX_REQUESTS}")
+    if not custom_ids:
+        raise BatchError("输入文件为空")
+    return len(custom_ids)
+
+
+def create_batch(params):
+    """创建批处理任务并在后台开始执行"""
+    input_file_id = params.get("input_file_id")
+    endpoint = params.get("endpoint", "/v1/chat/completions")
+    if endpoint not in SUPPORTED_ENDPOINTS:
+        raise BatchError(f"不支持的 endpoint '{endpoint}'")
+    if params.get("completion_window", "24h") != "24h":
+        raise BatchError("completion_window 仅支持 24h")
+    total = _validate_input(input_file_id, endpoint)
+
+    now = int(time.time())
+    batch_id = f"batch_{uuid.uuid4().hex}"
+    batch = {
+        "id": batch_id,
+        "object": "batch",
+        "endpoint": endpoint,
+        "errors": None,
+        "input_file_id": input_file_id,
+        "completion_window": "24h",
+        "status": "in_progress",
+        "output_file_id": None,
+        "error_file_id": None,
+        "created_at": now,
+        "in_progress_at": now,
+        "expires_at": now + _COMPLETION_WINDOW,
+        "finalizing_at": None,
+        "completed_at": None,
+        "failed_at": None,
+        "expired_at": None,
+        "cancelling_at": None,
+        "cancelled_at": None,
+        "request_counts": {"total": total, "completed": 0, "failed": 0},
+        "metadata": params.get("metadata"),
+        "_backend": BATCH_BACKEND,
+    }
+    _db().execute("INSERT INTO batches (id, status, worker, created_at, data) VALUES (?, ?, ?, ?, ?)",
+                  (batch_id, batch["status"], _worker_id(), now, json.dumps(batch)))
+    _spawn(batch_id)
+    return _public(batch)
+
+
+def get_batch(batch_id):
+    return _public(_load_batch(batch_id))
+
+
+def list_batches(limit=20, after=None):
+    conn = _db()
+    if after:
+        row = conn.execute("SELECT created_at FROM batches WHERE id = ?", (after,)).fetchone()
+        rows = conn.execute("SELECT data FROM batches WHERE created_at < ? OR (created_at = ? AND id < ?) "
+                            "ORDER BY created_at DESC, id DESC LIMIT ?",
+                            (row[0], row[0], after, limit + 1)).fetchall() if row else []
+    else:
+        rows = conn.execute("SELECT data FROM batches ORDER BY created_at DESC, id DESC LIMIT ?",
+                            (limit + 1,)).fetchall()
+    data = [_public(json.loads(row[0])) for row in rows[:limit]]
+    return {
+        "object": "list",
+        "data": data,
+        "first_id": data[0]["id"] if data else None,
+        "last_id": data[-1]["id"] if data else None,
+        "has_more": len(rows) > limit,
+    }
+
+
+def cancel_batch(batch_id):
+    """请求取消任务，执行中的请求完成后停止"""
+    batch = _load_batch(batch_id)
+    if batch["status"] not in _ACTIVE_STATES:
+        raise BatchError(f"任务状态为 {batch['status']}，无法取消")
+    if batch["status"] == "cancelling":
+        return _public(batch)
+    return _public(_update_batch(batch_id, status="cancelling", cancelling_at=int(time.time())))
+
+
+def _cancel_requested(batch_id):
+    row = _db().execute("SELECT status FROM batches WHERE id = ?", (batch_id,)).fetchone()
+    return row is not None and row[0] == "cancelling"
+
+
+# ---------------------------------------------------------------- 执行
+
+def _spawn(batch_id):
+    with _running_lock:
+        if batch_id in _running:
+            return
+        _running.add(batch_id)
+    threading.Thread(target=_run, args=(batch_id,), daemon=True).start()
+
+
+def _run(batch_id):
+    try:
+        batch = _load_batch(batch_id)
+        if batch.get("_backend") == "vertex":
+            _run_vertex(batch)
+        else:
+            _run_local(batch)
+    except Exception as e:
+        print(f"警告: 批处理任务 {batch_id} 失败 - {str(e)}")
+        _update_batch(batch_id, status="failed", failed_at=int(time.time()),
+                      errors={"object": "list", "data": [{"code": "internal_error", "message": str(e)}]})
+    finally:
+        with _running_lock:
+            _running.discard(batch_id)
+
+
+def _load_results(path):
+    """读取已写入的结果，返回 custom_id 集合；去掉进程中断时写了一半的最后一行"""
+    custom_ids = set()
+    if not os.path.exists(path):
+        return custom_ids
+    valid_bytes = 0
+    with open(path, "rb") as f:
+        for line in f:
+            try:
+                custom_ids.add(json.loads(line)["custom_id"])
+            except (ValueError, KeyError):
+                break
+            valid_bytes += len(line)
+    with open(path, "r+b") as f:
+        f.truncate(valid_bytes)
+    return custom_ids
+
+
+def _execute(item):
+    """执行一条请求，返回 (是否成功, 结果行)"""
+    result = {"id": f"batch_req_{uuid.uuid4().hex}", "custom_id": item["custom_id"], "error": None}
+    try:
+        body = _handlers["complete"](item["body"])
+        result["response"] = {"status_code": 200, "request_id": body["id"], "body": body}
+        return True, result
+    except Exception as e:
+        result["response"] = {"status_code": error_status(e), "request_id": None,
+                              "body": {"error": {"message": str(e)}}}
+        return False, result
+
+
+def _finalize(batch_id, completed, failed):
+    """登记结果文件并把任务标记为完成"""
+    now = int(time.time())
+    changes = {"status": "completed", "finalizing_at": now, "completed_at": now,
+               "request_counts": {"completed": completed, "failed": failed}}
+    for file_id, count, field, suffix in ((_output_file_id(batch_id), completed, "output_file_id", "output"),
+                                          (_error_file_id(batch_id), failed, "error_file_id", "errors")):
+        if count:
+            _register_file(file_id, f"{batch_id}_{suffix}.jsonl", "batch_output",
+                           os.path.getsize(_file_path(file_id)))
+            changes[field] = file_id
+    _update_batch(batch_id, **changes)
+
+
+def _run_local(batch):
+    """在本进程中按有界并发执行所有请求"""
+    batch_id = batch["id"]
+    output_path = _file_path(_output_file_id(batch_id))
+    error_path = _file_path(_error_file_id(batch_id))
+    completed_ids = _load_results(output_path)
+    failed_ids = _load_results(error_path)
+    counts = {"completed": len(completed_ids), "failed": len(failed_ids)}
+    last_update = 0.0
+    cancelled = False
+
+    with open(output_path, "a", encoding="utf-8") as output, \
+            open(error_path, "a", encoding="utf-8") as errors, \
+            ThreadPoolExecutor(BATCH_CONCURRENCY, thread_name_prefix=f"batch-{batch_id[-8:]}") as pool:
+
+        def collect(finished):
+            for future in finished:
+                ok, result = future.result()
+                (output if ok else errors).write(json.dumps(result, ensure_ascii=False) + "\n")
+                counts["completed" if ok else "failed"] += 1
+            output.flush()
+            errors.flush()
+
+        pending = set()
+        for _, item in _read_requests(batch["input_file_id"]):
+            if item["custom_id"] in completed_ids or item["custom_id"] in failed_ids:
+                continue
+            if len(pending) >= BATCH_CONCURRENCY:
+                finished, pending = wait(pending, return_when=FIRST_COMPLETED)
+                collect(finished)
+            if time.monotonic() - last_update >= _PROGRESS_INTERVAL:
+                last_update = time.monotonic()
+                if _cancel_requested(batch_id):
+                    cancelled = True
+                    break
+                _update_batch(batch_id, request_counts=counts)
+            pending.add(pool.submit(_execute, item))
+        collect(wait(pending).done)
+
+    # 最后一次检查之后到来的取消请求不能被"completed"覆盖
+    if cancelled or _cancel_requested(batch_id):
+        _update_batch(batch_id, status="cancelled", cancelled_at=int(time.time()), request_counts=counts)
+    else:
+        _finalize(batch_id, counts["completed"], counts["failed"])
+
+
+def _split_gcs_uri(uri):
+    bucket, _, path = uri[len("gs://"):].partition("/")
+    return bucket, path
+
+
+def _vertex_request(chat_req):
+    """把 chat_req 转换为 Vertex AI 批量预测的请求格式(与 generateContent 的 REST 请求体相同)"""
+    import upstream
+
+    config = upstream.generate_config(chat_req)
+    request = {"contents": [upstream.to_json(content) for content in chat_req["contents"]]}
+    system_instruction = chat_req["system_instruction"]
+    if system_instruction:
+        if not isinstance(system_instruction, str):
+            system_instruction = "".join(item.get("text", "") for item in system_instruction
+                                         if isinstance(item, dict))
+        request["systemInstruction"] = {"parts": [{"text": system_instruction}]}
+    generation_config = upstream.to_json(upstream.types.GenerationConfig(
+        **(chat_req["generation_config"] or {}), thinking_config=config.thinking_config))
+    if generation_config:
+        request["generationConfig"] = generation_config
+    if config.safety_settings:
+        request["safetySettings"] = [upstream.to_json(setting) for setting in config.safety_settings]
+    return request
+
+
+def _submit_vertex_job(batch, storage_client, client):
+    """转换请求、上传到 GCS 并提交 Vertex AI 批量预测任务"""
+    import upstream
+
+    batch_id = batch["id"]
+    bucket_name, prefix = _split_gcs_uri(BATCH_GCS_URI)
+    model_name = None
+    lines = []
+    for _, item in _read_requests(batch["input_file_id"]):
+        chat_req = _handlers["parse"](dict(item["body"], stream=False))
+        if model_name not in (None, chat_req["model_name"]):
+            raise BatchError("Vertex AI 批量预测要求所有请求使用同一个模型")
+        model_name = chat_req["model_name"]
+        lines.append(json.dumps({"custom_id": item["custom_id"], "request": _vertex_request(chat_req)}))
+
+    base_path = "/".join(part for part in (prefix, batch_id) if part)
+    storage_client.bucket(bucket_name).blob(f"{base_path}/input.jsonl").upload_from_string(
+        "\n".join(lines) + "\n", content_type="application/jsonl")
+    job = client.batches.create(model=model_name, src=f"gs://{bucket_name}/{base_path}/input.jsonl",
+                                config=upstream.types.CreateBatchJobConfig(
+                                    dest=f"gs://{bucket_name}/{base_path}/output"))
+    _update_batch(batch_id, _vertex_job=job.name, _model=model_name)
+    return job
+
+
+def _run_vertex(batch):
+    """提交(或接管)Vertex AI 批量预测任务，等待结束后下载结果"""
+    from google.cloud import storage
+    import upstream
+
+    if not BATCH_GCS_URI.startswith("gs://"):
+        raise BatchError("BATCH_BACKEND=vertex 需要配置 BATCH_GCS_URI=gs://bucket/prefix")
+    JobState = upstream.types.JobState
+    ended = (JobState.JOB_STATE_SUCCEEDED, JobState.JOB_STATE_PARTIALLY_SUCCEEDED, JobState.JOB_STATE_FAILED,
+             JobState.JOB_STATE_CANCELLED, JobState.JOB_STATE_EXPIRED)
+    batch_id = batch["id"]
+    storage_client = storage.Client()
+    client = upstream.default_client()
+    if batch.get("_vertex_job"):
+        job = client.batches.get(name=batch["_vertex_job"])
+    else:
+        job = _submit_vertex_job(batch, storage_client, client)
+        batch = _load_batch(batch_id)
+
+    cancel_sent = False
+    while job.state not in ended:
+        if not cancel_sent and _cancel_requested(batch_id):
+            client.batches.cancel(name=job.name)
+            cancel_sent = True
+        time.sleep(BATCH_POLL_SECONDS)
+        job = client.batches.get(name=job.name)
+
+    if cancel_sent:
+        _update_batch(batch_id, status="cancelled", cancelled_at=int(time.time()))
+        return
+    if job.state not in (JobState.JOB_STATE_SUCCEEDED, JobState.JOB_STATE_PARTIALLY_SUCCEEDED):
+        raise RuntimeError(f"Vertex AI 批量预测任务失败: {job.error.message if job.error else job.state}")
+
+    bucket_name, prefix = _split_gcs_uri(job.dest.gcs_uri)
+    counts = {"completed": 0, "failed": 0}
+    with open(_file_path(_output_file_id(batch_id)), "w", encoding="utf-8") as output, \
+            open(_file_path(_error_file_id(batch_id)), "w", encoding="utf-8") as errors:
+        for blob in storage_client.list_blobs(bucket_name, prefix=prefix):
+            if not blob.name.endswith(".jsonl"):
+                continue
+            for line in blob.download_as_text().splitlines():
+                if not line.strip():
+                    continue
+                item = json.loads(line)
+                result = {"id": f"batch_req_{uuid.uuid4().hex}", "custom_id": item.get("custom_id"), "error": None}
+                try:
+                    if item.get("status"):
+                        raise RuntimeError(item["status"])
+                    response = upstream.types.GenerateContentResponse.model_validate(item["response"])
+                    body = _handlers["build"](response, batch["_model"])
+                    result["response"] = {"status_code": 200, "request_id": body["id"], "body": body}
+                    output.write(json.dumps(result, ensure_ascii=False) + "\n")
+                    counts["completed"] += 1
+                except Exception as e:
+                    result["response"] = {"status_code": error_status(e), "request_id": None,
+                                          "body": {"error": {"message": str(e)}}}
+                    errors.write(json.dumps(result, ensure_ascii=False) + "\n")
+                    counts["failed"] += 1
+    _finalize(batch_id, counts["completed"], counts["failed"])
+
+
+def _process_alive(worker):
+    """判断任务所属的工作进程是否仍在运行(只能判断本机进程)"""
+    host, _, pid = worker.rpartition(":")
+    if host != socket.gethostname():
+        return True
+    try:
+        os.kill(int(pid), 0)
+    except ProcessLookupError:
+        return False
+    except (PermissionError, ValueError):
+        return True
+    return True
+
+
+def _claim_orphans():
+    """接管本机上已退出进程遗留的进行中任务"""
+    conn = _db()
+    placeholders = ",".join("?" * len(_ACTIVE_STATES))
+    rows = conn.execute(f"SELECT id, worker FROM batches WHERE status IN ({placeholders})",
+                        _ACTIVE_STATES).fetchall()
+    for batch_id, worker in rows:
+        if worker == _worker_id() or _process_alive(worker):
+            continue
+        claimed = conn.execute("UPDATE batches SET worker = ? WHERE id = ? AND worker = ?",
+                               (_worker_id(), batch_id, worker)).rowcount
+        if claimed:
+            print(f"接管批处理任务 {batch_id} (原工作进程 {worker} 已退出)")
+            _spawn(batch_id)
+
+
+def start(complete, parse, build):
+    """注册请求处理函数，由应用导入时调用"""
+    _handlers.update(complete=complete, parse=parse, build=build)
+
+
+def resume():
+    """接管遗留任务；在工作进程中调用(startup.on_start)，gunicorn --preload 的主进程不执行任务"""
+    try:
+        _claim_orphans()
+    except Exception as e:
+        print(f"警告: 检查遗留批处理任务失败 - {str(e)}")
+
+
+def stats():
+    """返回批处理统计信息"""
+    with _running_lock:
+        running = len(_running)
+    return {"backend": BATCH_BACKEND, "concurrency": BATCH_CONCURRENCY, "running": running}
@@ -0,0 +1,680 @@
+#!/usr/bin/env python3
+"""
+离线压测 - 用本地模拟的 Vertex AI (Gemini) 服务测试代理的吞吐和延迟
+
+- 本进程内启动一个模拟的 Gemini HTTPS 服务(REST 接口 generateContent / streamGenerateContent，
+  以及 embedding 模型的 predict，HTTP/1.1)，
+  首 token 延迟、chunk 数量与大小、chunk 间隔和错误率都可配置
+- 按 start.py 的 dev / prod / async 模式分别启动代理，代理通过 VERTEX_API_ENDPOINT 连接模拟服务
+- 并发发送流式和非流式请求，请求内容混合纯文本、base64 图片和长对话历史，以及 /v1/embeddings 请求(--mix embedding)
+- 报告吞吐、p50/p99 延迟、流式请求的首 token 时间(TTFT)以及每个工作进程的内存占用(RSS)
+- 请求内容由 --seed 决定，同样的参数可以重复得到同样的负载
+
+用法:
+    python benchmark.py                                   # 依次测试 dev、prod、async 三种模式
+    python benchmark.py --modes async --concurrency 64 --requests 1000
+    python benchmark.py --env RESPONSE_CACHE_ENABLED=True --env SSE_COALESCE_MS=20
+    python benchmark.py --json baseline.json              # 保存结果
+    python benchmark.py --baseline baseline.json          # 与保存的结果比较，退化超过 --tolerance 时退出码为 1
+"""
+import argparse
+import base64
+import datetime
+import http.server
+import json
+import os
+import random
+import shutil
+import signal
+import socket
+import ssl
+import struct
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+
+_WORDS = "the quick brown fox jumps over a lazy dog while gemini streams tokens back ".split()
+_ERROR_STATUS = {429: "RESOURCE_EXHAUSTED", 500: "INTERNAL", 503: "UNAVAILABLE"}
+
+
+def _free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def make_certificate(directory):
+    """生成 localhost 的自签名证书，返回 (证书路径, 私钥路径)"""
+    from cryptography import x509
+    from cryptography.hazmat.primitives import hashes, serialization
+    from cryptography.hazmat.primitives.asymmetric import ec
+    from cryptography.x509.oid import NameOID
+    import ipaddress
+
+    key = ec.generate_private_key(ec.SECP256R1())
+    name = x509.Name([x509.NameAttribute(NameOID.COMMON_NAME, "localhost")])
+    now = datetime.datetime.now(datetime.timezone.utc)
+    cert = (
+        x509.CertificateBuilder()
+        .subject_name(name)
+        .issuer_name(name)
+        .public_key(key.public_key())
+        .serial_number(x509.random_serial_number())
+        .not_valid_before(now - datetime.timedelta(minutes=5))
+        .not_valid_after(now + datetime.timedelta(days=1))
+        .add_extension(x509.SubjectAlternativeName(
+            [x509.DNSName("localhost"), x509.IPAddress(ipaddress.ip_address("127.0.0.1"))]), critical=False)
+        .add_extension(x509.BasicConstraints(ca=True, path_length=None), critical=True)
+        .sign(key, hashes.SHA256())
+    )
+    key_pem = key.private_bytes(
+        serialization.Encoding.PEM, serialization.PrivateFormat.PKCS8, serialization.NoEncryption())
+    cert_pem = cert.public_bytes(serialization.Encoding.PEM)
+    cert_path = os.path.join(directory, "fake-vertex.pem")
+    key_path = os.path.join(directory, "fake-vertex.key")
+    with open(cert_path, "wb") as f:
+        f.write(cert_pem)
+    with open(key_path, "wb") as f:
+        f.write(key_pem)
+    return cert_path, key_path
+
+
+class _FakeHandler(http.server.BaseHTTPRequestHandler):
+    """模拟服务的 HTTP 处理器，请求交给 server.fake (FakeGemini) 处理"""
+
+    protocol_version = "HTTP/1.1"
+    # 响应头和响应体分两次写入，不关闭 Nagle 算法时会与客户端的延迟 ACK 叠加，每个响应多等约 40ms
+    disable_nagle_algorithm = True
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_HEAD(self):
+        # 代理预热时用 HEAD 请求建立连接
+        self.send_response(200)
+        self.send_header("Content-Length", "0")
+        self.end_headers()
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        self.server.fake.received(len(body))
+        path = self.path.partition("?")[0]
+        if path.endswith(":generateContent"):
+            self.server.fake.generate(self, json.loads(body))
+        elif path.endswith(":streamGenerateContent"):
+            self.server.fake.stream(self, json.loads(body))
+        elif path.endswith(":predict"):
+            self.server.fake.predict(self, json.loads(body))
+        else:
+            self.send_json(404, {"error": {"code": 404, "message": f"未知路径 {path}", "status": "NOT_FOUND"}})
+
+    def send_json(self, status, payload):
+        data = json.dumps(payload).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def start_events(self):
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Transfer-Encoding", "chunked")
+        self.end_headers()
+
+    def send_event(self, payload):
+        data = f"data: {json.dumps(payload)}\r\n\r\n".encode()
+        self.wfile.write(b"%x\r\n%s\r\n" % (len(data), data))
+        self.wfile.flush()
+
+    def end_events(self):
+        self.wfile.write(b"0\r\n\r\n")
+        self.wfile.flush()
+
+
+class FakeGemini:
+    """模拟的 Vertex AI Gemini 服务"""
+
+    def __init__(self, latency=0.05, chunks=8, chunk_chars=40, chunk_delay=0.01, error_rate=0.0,
+                 error_code=503, seed=0):
+        self.latency = latency
+        self.chunks = max(1, chunks)
+        self.chunk_chars = chunk_chars
+        self.chunk_delay = chunk_delay
+        self.error_rate = error_rate
+        self.error_code = error_code if error_code in _ERROR_STATUS else 503
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+        self.counters = {"generate": 0, "stream": 0, "embed": 0, "embed_inputs": 0, "errors": 0, "request_bytes": 0}
+        self._server = None
+        self._vectors = {}
+
+    def start(self, directory):
+        """启动 HTTPS 服务并生成凭据文件，返回代理需要的环境变量"""
+        cert_path, key_path = make_certificate(directory)
+        self._server = http.server.ThreadingHTTPServer(("127.0.0.1", _free_port()), _FakeHandler)
+        self._server.daemon_threads = True
+        self._server.request_queue_size = 1024
+        self._server.fake = self
+        context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+        context.load_cert_chain(cert_path, key_path)
+        self._server.socket = context.wrap_socket(self._server.socket, server_side=True)
+        threading.Thread(target=self._server.serve_forever, name="fake-gemini", daemon=True).start()
+
+        # 带有效 access token 的凭据文件，代理不需要连接 Google 刷新 token
+        credentials_path = os.path.join(directory, "fake-credentials.json")
+        expiry = datetime.datetime.now(datetime.timezone.utc) + datetime.timedelta(days=1)
+        with open(credentials_path, "w") as f:
+            json.dump({
+                "type": "authorized_user",
+                "client_id": "benchmark",
+                "client_secret": "benchmark",
+                "refresh_token": "benchmark",
+                "token": "benchmark",
+                "expiry": expiry.strftime("%Y-%m-%dT%H:%M:%SZ"),
+            }, f)
+
+        return {
+            "VERTEX_API_ENDPOINT": f"localhost:{self._server.server_address[1]}",
+            "GOOGLE_APPLICATION_CREDENTIALS": credentials_path,
+            "SSL_CERT_FILE": cert_path,
+        }
+
+    def stop(self):
+        if self._server is not None:
+            self._server.shutdown()
+            self._server.server_close()
+
+    def snapshot(self):
+        with self._lock:
+            return dict(self.counters)
+
+    def received(self, size):
+        """累计代理发来的请求体字节数(图片预处理的效果)"""
+        with self._lock:
+            self.counters["request_bytes"] += size
+
+    def _count(self, name, error):
+        with self._lock:
+            self.counters[name] += 1
+            if error:
+                self.counters["errors"] += 1
+
+    def _maybe_fail(self, name, handler):
+        """按错误率返回模拟的上游错误，返回是否已经出错"""
+        with self._lock:
+            failed = self._random.random() < self.error_rate
+        self._count(name, failed)
+        if failed:
+            time.sleep(self.latency)
+            handler.send_json(self.error_code, {"error": {
+                "code": self.error_code, "message": "benchmark: 模拟的上游错误",
+                "status": _ERROR_STATUS[self.error_code]}})
+        return failed
+
+    def _text(self):
+        words = []
+        length = 0
+        while length < self.chunk_chars:
+            word = _WORDS[(len(words) * 7 + length) % len(_WORDS)]
+            words.append(word)
+            length += len(word) + 1
+        return " ".join(words)[:self.chunk_chars]
+
+    def _response(self, request, text, final):
+        candidate = {"index": 0, "content": {"role": "model", "parts": [{"text": text}]}}
+        response = {"candidates": [candidate]}
+        if final:
+            candidate["finishReason"] = "STOP"
+            prompt_tokens = sum(len(part.get("text", "")) // 4 + (258 if "inlineData" in part else 0)
+                                for content in request.get("contents", []) for part in content.get("parts", []))
+            completion_tokens = self.chunks * self.chunk_chars // 4
+            response["usageMetadata"] = {
+                "promptTokenCount": prompt_tokens,
+                "candidatesTokenCount": completion_tokens,
+                "totalTokenCount": prompt_tokens + completion_tokens,
+            }
+        return response
+
+    def generate(self, handler, request):
+        if self._maybe_fail("generate", handler):
+            return
+        time.sleep(self.latency + self.chunk_delay * (self.chunks - 1))
+        handler.send_json(200, self._response(request, self._text() * self.chunks, final=True))
+
+    def predict(self, handler, request):
+        """embedding 模型: 所有输入返回同一个向量(序列化大量浮点数很慢，按维度缓存 JSON)"""
+        if self._maybe_fail("embed", handler):
+            return
+        instances = request.get("instances", [])
+        with self._lock:
+            self.counters["embed_inputs"] += len(instances)
+        dimensions = (request.get("parameters") or {}).get("outputDimensionality") or 768
+        values = self._vectors.get(dimensions)
+        if values is None:
+            rng = random.Random(dimensions)
+            values = self._vectors[dimensions] = json.dumps([round(rng.uniform(-1, 1), 6) for _ in range(dimensions)])
+        time.sleep(self.latency)
+        predictions = ",".join(
+            '{"embeddings": {"values": %s, "statistics": {"token_count": %d, "truncated": false}}}'
+            % (values, len(instance.get("content", "")) // 4 + 1) for instance in instances)
+        data = f'{{"predictions": [{predictions}]}}'.encode()
+        handler.send_response(200)
+        handler.send_header("Content-Type", "application/json")
+        handler.send_header("Content-Length", str(len(data)))
+        handler.end_headers()
+        handler.wfile.write(data)
+
+    def stream(self, handler, request):
+        if self._maybe_fail("stream", handler):
+            return
+        time.sleep(self.latency)
+        handler.start_events()
+        try:
+            for index in range(self.chunks):
+                if index:
+                    time.sleep(self.chunk_delay)
+                handler.send_event(self._response(request, self._text(), final=index == self.chunks - 1))
+            handler.end_events()
+        except (BrokenPipeError, ConnectionResetError, ssl.SSLError):
+            # 代理提前关闭了流
+            handler.close_connection = True
+
+
+def make_png(width, height, seed=0):
+    """生成随机像素的 PNG 图片(随机像素压缩不了，图片大小约为 width * height * 3 字节)"""
+    rng = random.Random(seed)
+    rows = b"".join(b"\x00" + rng.randbytes(width * 3) for _ in range(height))
+
+    def chunk(kind, data):
+        return struct.pack(">I", len(data)) + kind + data + struct.pack(">I", zlib.crc32(kind + data))
+
+    return (b"\x89PNG\r\n\x1a\n"
+            + chunk(b"IHDR", struct.pack(">IIBBBBB", width, height, 8, 2, 0, 0, 0))
+            + chunk(b"IDAT", zlib.compress(rows, 1))
+            + chunk(b"IEND", b""))
+
+
+class Workload:
+    """按种子生成可重复的请求序列"""
+
+    def __init__(self, args):
+        self.args = args
+        self.kinds = [kind.strip() for kind in args.mix.split(",") if kind.strip()]
+        side = max(1, int((args.image_kb * 1024 / 3) ** 0.5))
+        image = base64.b64encode(make_png(side, side, args.seed)).decode()
+        self.image_url = f"data:image/png;base64,{image}"
+
+    def requests(self, count, offset=0):
+        rng = random.Random(f"{self.args.seed}:{offset}")
+        return [self._request(rng, offset + index) for index in range(count)]
+
+    def _request(self, rng, index):
+        kind = rng.choice(self.kinds)
+        stream = rng.random() < self.args.stream_ratio
+        # 每个请求带上不同的编号，避免被响应缓存或相同请求合并掉；--repeat 时故意重复
+        nonce = index % self.args.repeat if self.args.repeat else index
+        question = f"[{nonce}] 请用一句话介绍一下 Google Gemini"
+        if kind == "embedding":
+            inputs = [f"{question} ({item})" for item in range(self.args.embed_inputs)]
+            return kind, {"model": "text-embedding-005", "input": inputs, "stream": stream}
+        messages = [{"role": "system", "content": "你是一个乐于助人的助手。"}]
+        if kind == "image":
+            messages.append({"role": "user", "content": [
+                {"type": "text", "text": question},
+                {"type": "image_url", "image_url": {"url": self.image_url}},
+            ]})
+        elif kind == "history":
+            filler = " ".join(rng.choice(_WORDS) for _ in range(self.args.history_chars // 5))
+            for turn in range(self.args.history_turns):
+                messages.append({"role": "user", "content": f"第 {turn} 轮: {filler}"})
+                messages.append({"role": "assistant", "content": f"回答 {turn}: {filler}"})
+            messages.append({"role": "user", "content": question})
+        else:
+            messages.append({"role": "user", "content": question})
+        payload = {"model": self.args.model, "messages": messages, "stream": stream}
+        return kind, payload
+
+
+def percentile(values, pct):
+    """最近秩法计算百分位数"""
+    if not values:
+        return None
+    values = sorted(values)
+    index = max(0, min(len(values) - 1, int(round(pct / 100 * len(values) + 0.5)) - 1))
+    return values[index]
+
+
+def _read_rss(pid):
+    """读取进程的 RSS(MB)，进程已退出时返回 None"""
+    try:
+        with open(f"/proc/{pid}/status") as f:
+            for line in f:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        return None
+    return None
+
+
+def _process_tree(root):
+    """返回 root 及其所有子孙进程 {pid: 父进程 pid}"""
+    parents = {}
+    for name in os.listdir("/proc"):
+        if not name.isdigit():
+            continue
+        try:
+            with open(f"/proc/{name}/stat") as f:
+                stat = f.read()
+        except OSError:
+            continue
+        # comm 字段可能包含空格，从最后一个右括号之后开始解析
+        parents[int(name)] = int(stat.rsplit(")", 1)[1].split()[1])
+    tree = {root: None}
+    changed = True
+    while changed:
+        changed = False
+        for pid, ppid in parents.items():
+            if ppid in tree and pid not in tree:
+                tree[pid] = ppid
+                changed = True
+    return tree
+
+
+class RssSampler:
+    """定期采样代理各工作进程的 RSS，记录峰值"""
+
+    def __init__(self, root, interval=0.2):
+        self.root = root
+        self.interval = interval
+        self.peak = {}
+        self.workers = set()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def start(self):
+        self._sample()
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+        self._sample()
+        return [{"pid": pid, "peak_rss_mb": round(self.peak[pid], 1),
+                 "rss_mb": round(_read_rss(pid) or 0, 1)}
+                for pid in sorted(self.workers) if pid in self.peak]
+
+    def _sample(self):
+        tree = _process_tree(self.root)
+        parents = set(tree.values())
+        # 没有子进程的是实际处理请求的进程(dev 模式下就是代理进程本身)
+        for pid in tree:
+            if pid in parents:
+                continue
+            rss = _read_rss(pid)
+            if rss is not None:
+                self.workers.add(pid)
+                self.peak[pid] = max(self.peak.get(pid, 0), rss)
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            self._sample()
+
+
+class Proxy:
+    """用 start.py 启动的代理进程"""
+
+    def __init__(self, mode, workers, env, log_path):
+        self.mode = mode
+        self.port = _free_port()
+        self.base_url = f"http://127.0.0.1:{self.port}"
+        self.env = {**os.environ, **env, "PORT": str(self.port), "GUNICORN_WORKERS": str(workers), "DEBUG": "False"}
+        self.log_path = log_path
+        self.process = None
+
+    def start(self, timeout=60):
+        here = os.path.dirname(os.path.abspath(__file__))
+        self._log = open(self.log_path, "w")
+        self.process = subprocess.Popen(
+            [sys.executable, os.path.join(here, "start.py"), self.mode],
+            cwd=here, env=self.env, stdout=self._log, stderr=subprocess.STDOUT, start_new_session=True)
+        deadline = time.time() + timeout
+        while time.time() < deadline:
+            if self.process.poll() is not None:
+                break
+            try:
+                if requests.get(f"{self.base_url}/health", timeout=1).status_code == 200:
+                    return
+            except requests.RequestException:
+                pass
+            time.sleep(0.2)
+        self.stop()
+        with open(self.log_path) as f:
+            raise RuntimeError(f"代理({self.mode})启动失败:\n{f.read()[-4000:]}")
+
+    def stop(self):
+        if self.process is not None and self.process.poll() is None:
+            os.killpg(self.process.pid, signal.SIGTERM)
+            try:
+                self.process.wait(timeout=15)
+            except subprocess.TimeoutExpired:
+                os.killpg(self.process.pid, signal.SIGKILL)
+                self.process.wait()
+        self._log.close()
+
+
+_sessions = threading.local()
+
+
+def send(base_url, kind, payload, timeout):
+    """发送一个请求，返回测量结果"""
+    session = getattr(_sessions, "session", None)
+    if session is None:
+        session = _sessions.session = requests.Session()
+    result = {"kind": kind, "stream": payload["stream"], "status": None, "latency": None, "ttft": None}
+    start = time.perf_counter()
+    try:
+        path = "/v1/embeddings" if kind == "embedding" else "/v1/chat/completions"
+        with session.post(f"{base_url}{path}", json=payload,
+                          stream=payload["stream"], timeout=timeout) as resp:
+            result["status"] = resp.status_code
+            if payload["stream"]:
+                for line in resp.iter_lines():
+                    if result["ttft"] is None and line.startswith(b"data: {"):
+                        event = json.loads(line[6:])
+                        choices = event.get("choices") or [{}]
+                        if choices[0].get("delta", {}).get("content") or event.get("object") == "embedding":
+                            result["ttft"] = time.perf_counter() - start
+            else:
+                resp.content
+    except requests.RequestException as e:
+        result["error"] = type(e).__name__
+    result["latency"] = time.perf_counter() - start
+    return result
+
+
+def run_load(base_url, items, concurrency, timeout):
+    """以固定并发发送请求，返回 (结果列表, 总耗时)"""
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        results = list(executor.map(lambda item: send(base_url, item[0], item[1], timeout), items))
+    return results, time.perf_counter() - start
+
+
+def _ms(seconds):
+    return None if seconds is None else round(seconds * 1000, 1)
+
+
+def summarize(label, results, duration, upstream, processes):
+    ok = [r for r in results if r["status"] == 200]
+    streams = [r["ttft"] for r in ok if r["ttft"] is not None]
+    latencies = [r["latency"] for r in ok]
+    by_kind = {}
+    for kind in sorted({r["kind"] for r in results}):
+        kind_latencies = [r["latency"] for r in ok if r["kind"] == kind]
+        by_kind[kind] = {"requests": sum(1 for r in results if r["kind"] == kind),
+                         "p50_ms": _ms(percentile(kind_latencies, 50)),
+                         "p99_ms": _ms(percentile(kind_latencies, 99))}
+    statuses = {}
+    for r in results:
+        key = str(r["status"] or r.get("error"))
+        statuses[key] = statuses.get(key, 0) + 1
+    return {
+        "label": label,
+        "requests": len(results),
+        "errors": len(results) - len(ok),
+        "statuses": statuses,
+        "duration_s": round(duration, 2),
+        "throughput_rps": round(len(ok) / duration, 1) if duration else 0,
+        "latency_p50_ms": _ms(percentile(latencies, 50)),
+        "latency_p99_ms": _ms(percentile(latencies, 99)),
+        "ttft_p50_ms": _ms(percentile(streams, 50)),
+        "ttft_p99_ms": _ms(percentile(streams, 99)),
+        "by_kind": by_kind,
+        "upstream_calls": upstream,
+        "workers": processes,
+    }
+
+
+def print_summary(summary):
+    print(f"\n📊 {summary['label']}")
+    print(f"  请求: {summary['requests']}  失败: {summary['errors']}  状态码: {summary['statuses']}")
+    print(f"  吞吐: {summary['throughput_rps']} req/s  耗时: {summary['duration_s']} s")
+    print(f"  延迟: p50 {summary['latency_p50_ms']} ms  p99 {summary['latency_p99_ms']} ms")
+    print(f"  TTFT: p50 {summary['ttft_p50_ms']} ms  p99 {summary['ttft_p99_ms']} ms")
+    for kind, stats in summary["by_kind"].items():
+        print(f"  {kind:8s} {stats['requests']:5d} 个  p50 {stats['p50_ms']} ms  p99 {stats['p99_ms']} ms")
+    print(f"  上游调用: {summary['upstream_calls']}")
+    for worker in summary["workers"]:
+        print(f"  进程 {worker['pid']}: RSS {worker['rss_mb']} MB (峰值 {worker['peak_rss_mb']} MB)")
+
+
+def compare(results, baseline, tolerance):
+    """与基准结果比较，返回退化项列表"""
+    regressions = []
+    previous = {item["label"]: item for item in baseline}
+    for summary in results:
+        base = previous.get(summary["label"])
+        if base is None:
+            continue
+        if base["throughput_rps"] and summary["throughput_rps"] < base["throughput_rps"] * (1 - tolerance):
+            regressions.append(f"{summary['label']}: 吞吐 {base['throughput_rps']} -> {summary['throughput_rps']} req/s")
+        for key in ("latency_p50_ms", "latency_p99_ms", "ttft_p50_ms", "ttft_p99_ms"):
+            if base.get(key) and summary.get(key) and summary[key] > base[key] * (1 + tolerance):
+                regressions.append(f"{summary['label']}: {key} {base[key]} -> {summary[key]}")
+        if summary["errors"] > base["errors"]:
+            regressions.append(f"{summary['label']}: 失败数 {base['errors']} -> {summary['errors']}")
+    return regressions
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="用模拟的 Gemini 服务离线压测代理")
+    parser.add_argument("--modes", default="dev,prod,async", help="start.py 的启动模式，逗号分隔")
+    parser.add_argument("--workers", type=int, default=2, help="prod/async 模式的工作进程数")
+    parser.add_argument("--env", action="append", default=[], metavar="KEY=VALUE", help="传给代理的环境变量，可重复")
+    parser.add_argument("--requests", type=int, default=200, help="每种模式发送的请求数")
+    parser.add_argument("--warmup", type=int, default=10, help="正式计时前的预热请求数")
+    parser.add_argument("--concurrency", type=int, default=16, help="并发客户端数")
+    parser.add_argument("--stream-ratio", type=float, default=0.5, help="流式请求比例")
+    parser.add_argument("--mix", default="text,image,history", help="请求类型: text,image,history,embedding")
+    parser.add_argument("--image-kb", type=int, default=256, help="base64 图片的大小(KB)")
+    parser.add_argument("--history-turns", type=int, default=20, help="长对话的轮数")
+    parser.add_argument("--history-chars", type=int, default=2000, help="长对话中每条消息的字符数")
+    parser.add_argument("--embed-inputs", type=int, default=4, help="每个 embedding 请求的输入条数")
+    parser.add_argument("--repeat", type=int, default=0, help="只使用 N 种不同的问题，用于测试响应缓存和请求合并")
+    parser.add_argument("--model", default="gemini-2.5-flash")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--timeout", type=float, default=120, help="单个请求的超时时间(秒)")
+    parser.add_argument("--latency", type=float, default=0.05, help="模拟服务的首 token 延迟(秒)")
+    parser.add_argument("--chunks", type=int, default=8, help="模拟服务每个响应的 chunk 数")
+    parser.add_argument("--chunk-chars", type=int, default=40, help="每个 chunk 的字符数")
+    parser.add_argument("--chunk-delay", type=float, default=0.01, help="chunk 间隔(秒)")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="模拟服务返回错误的比例")
+    parser.add_argument("--error-code", type=int, default=503, choices=sorted(_ERROR_STATUS), help="模拟错误的状态码")
+    parser.add_argument("--json", help="把结果保存为 JSON 文件")
+    parser.add_argument("--baseline", help="与之前保存的 JSON 结果比较")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="允许的退化比例")
+    parser.add_argument("--keep-logs", action="store_true", help="保留代理日志和临时文件")
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    workdir = tempfile.mkdtemp(prefix="llm-proxy-bench-")
+    fake = FakeGemini(latency=args.latency, chunks=args.chunks, chunk_chars=args.chunk_chars,
+                      chunk_delay=args.chunk_delay, error_rate=args.error_rate, error_code=args.error_code,
+                      seed=args.seed)
+    proxy_env = {
+        "GOOGLE_CLOUD_PROJECT": "benchmark",
+        "GOOGLE_CLOUD_LOCATION": "us-central1",
+        "VERTEX_BACKENDS": "",
+        **fake.start(workdir),
+        "PROMETHEUS_MULTIPROC_DIR": os.path.join(workdir, "metrics"),
+        "RATE_LIMIT_DB": os.path.join(workdir, "ratelimit.db"),
+        "BATCH_DIR": os.path.join(workdir, "batches"),
+    }
+    for item in args.env:
+        key, _, value = item.partition("=")
+        proxy_env[key] = value
+    # dev 模式不会创建指标目录
+    os.makedirs(proxy_env["PROMETHEUS_MULTIPROC_DIR"], exist_ok=True)
+
+    workload = Workload(args)
+    warmup = workload.requests(args.warmup, offset=-args.warmup - 1) if args.warmup else []
+    items = workload.requests(args.requests)
+    print(f"🧪 模拟服务: {proxy_env['VERTEX_API_ENDPOINT']}  工作目录: {workdir}")
+    print(f"🔧 {args.requests} 个请求，并发 {args.concurrency}，流式比例 {args.stream_ratio}，类型 {args.mix}")
+
+    results = []
+    try:
+        for mode in [m.strip() for m in args.modes.split(",") if m.strip()]:
+            # 每种模式使用独立的共享缓存目录，避免后一种模式命中前一种模式留下的缓存
+            mode_env = {"SHARED_CACHE_DIR": os.path.join(workdir, f"shared-cache-{mode}"), **proxy_env}
+            proxy = Proxy(mode, args.workers, mode_env, os.path.join(workdir, f"proxy-{mode}.log"))
+            print(f"\n🚀 启动代理: {mode}")
+            proxy.start()
+            try:
+                if warmup:
+                    run_load(proxy.base_url, warmup, args.concurrency, args.timeout)
+                before = fake.snapshot()
+                sampler = RssSampler(proxy.process.pid)
+                sampler.start()
+                load, duration = run_load(proxy.base_url, items, args.concurrency, args.timeout)
+                processes = sampler.stop()
+                after = fake.snapshot()
+                upstream = {key: after[key] - before[key] for key in after}
+            finally:
+                proxy.stop()
+            summary = summarize(mode, load, duration, upstream, processes)
+            print_summary(summary)
+            results.append(summary)
+    finally:
+        fake.stop()
+        if not args.keep_logs:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(results, f, indent=2, ensure_ascii=False)
+        print(f"\n💾 结果已保存到 {args.json}")
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = compare(results, json.load(f), args.tolerance)
+        if regressions:
+            print("\n❌ 性能退化:")
+            for line in regressions:
+                print(f"  {line}")
+            return 1
+        print("\n✅ 与基准相比没有超过允许范围的退化")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,156 @@
+"""
+进程内缓存工具 - 线程安全的 LRU 缓存，带命中/未命中统计
+
+create_cache 按 SHARED_CACHES 的配置返回进程内的 LRUCache 或跨进程共享的 SharedCache (见 shared_cache.py)，
+两者接口相同。
+"""
+import hashlib
+import json
+import os
+import threading
+import time
+from collections import OrderedDict
+
+# 保存在跨进程共享文件中的缓存名，逗号分隔，all 表示全部；start.py 的 prod/async 模式未设置时使用默认列表
+SHARED_CACHES = {name.strip() for name in os.getenv("SHARED_CACHES", "").split(",") if name.strip()}
+
+# 所有已创建的缓存，用于统一输出统计信息
+_registry = {}
+
+
+def digest(obj):
+    """计算任意 JSON 兼容对象的稳定摘要，用作缓存键"""
+    if isinstance(obj, bytes):
+        data = obj
+    else:
+        data = json.dumps(obj, sort_keys=True, ensure_ascii=False, default=str).encode("utf-8")
+    return hashlib.sha256(data).hexdigest()
+
+
+class LRUCache:
+    """线程安全的 LRU 缓存，按条目数以及(可选的)总字节数限制容量，条目可设置过期时间"""
+
+    def __init__(self, name, max_entries=128, max_bytes=None):
+        self.name = name
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self._data = OrderedDict()
+        self._sizes = {}
+        self._expires = {}
+        self._lock = threading.Lock()
+        self.current_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+        # 调用方自定义的计数器，随统计信息一起输出
+        self.counters = {}
+        _registry[name] = self
+
+    def get(self, key, default=None):
+        """读取缓存，命中时将条目移到最近使用的位置"""
+        with self._lock:
+            if key in self._data:
+                expires_at = self._expires.get(key)
+                if expires_at is not None and expires_at <= time.monotonic():
+                    # 已过期
+                    self._remove(key)
+                    self.expirations += 1
+                else:
+                    self._data.move_to_end(key)
+                    self.hits += 1
+                    return self._data[key]
+            self.misses += 1
+            return default
+
+    def set(self, key, value, size=0, ttl=None):
+        """写入缓存，超出容量时淘汰最久未使用的条目
+
+        size: 条目占用的字节数
+        ttl: 过期时间(秒)，None 表示不过期
+        """
+        if self.max_entries <= 0:
+            return
+        if self.max_bytes is not None and size > self.max_bytes:
+            return
+        with self._lock:
+            if key in self._data:
+                self._remove(key)
+            self._data[key] = value
+            self._sizes[key] = size
+            self.current_bytes += size
+            if ttl is not None:
+                self._expires[key] = time.monotonic() + ttl
+            while len(self._data) > self.max_entries or (
+                self.max_bytes is not None and self.current_bytes > self.max_bytes
+            ):
+                self._remove(next(iter(self._data)))
+                self.evictions += 1
+
+    def _remove(self, key):
+        del self._data[key]
+        self.current_bytes -= self._sizes.pop(key, 0)
+        self._expires.pop(key, None)
+
+    def delete(self, key):
+        """删除一个条目"""
+        with self._lock:
+            if key in self._data:
+                self._remove(key)
+
+    def incr(self, counter, amount=1):
+        """累加自定义计数器"""
+        with self._lock:
+            self.counters[counter] = self.counters.get(counter, 0) + amount
+
+    def clear(self):
+        """清空缓存"""
+        with self._lock:
+            self._data.clear()
+            self._sizes.clear()
+            self._expires.clear()
+            self.current_bytes = 0
+
+    def __contains__(self, key):
+        """判断条目是否存在且未过期，不计入命中/未命中统计"""
+        with self._lock:
+            expires_at = self._expires.get(key)
+            return key in self._data and (expires_at is None or expires_at > time.monotonic())
+
+    def __len__(self):
+        return len(self._data)
+
+    def stats(self):
+        """返回缓存统计信息"""
+        total = self.hits + self.misses
+        return {
+            "entries": len(self._data),
+            "max_entries": self.max_entries,
+            "bytes": self.current_bytes,
+            "max_bytes": self.max_bytes,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "expirations": self.expirations,
+            "hit_rate": round(self.hits / total, 4) if total else 0.0,
+            **self.counters,
+        }
+
+
+def create_cache(name, max_entries=128, max_bytes=None):
+    """创建缓存；名字在 SHARED_CACHES 中时所有工作进程共享同一份"""
+    if name in SHARED_CACHES or "all" in SHARED_CACHES:
+        from shared_cache import SharedCache
+        cache = SharedCache(name, max_entries=max_entries, max_bytes=max_bytes)
+        try:
+            # 在当前进程中打开一次，尽早发现目录不可写或空间不足
+            cache.stats()
+            return cache
+        except OSError as e:
+            print(f"警告: 无法创建共享缓存 {name}，改用进程内缓存 - {str(e)}")
+    return LRUCache(name, max_entries=max_entries, max_bytes=max_bytes)
+
+
+def all_stats():
+    """返回所有缓存的统计信息"""
+    return {name: c.stats() for name, c in _registry.items()}
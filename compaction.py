@@ -0,0 +1,211 @@
+"""
+多轮对话历史压缩
+
+客户端每轮都会重发完整历史，prompt 的 token 数和延迟随对话长度线性增长。开启后，估算的 prompt token 数
+超过 HISTORY_MAX_TOKENS 的请求在转换为 Content 之前按以下顺序压缩(system 消息和最近的
+HISTORY_KEEP_MESSAGES 条消息始终保留):
+- 只保留最近 HISTORY_IMAGE_MESSAGES 条含图片消息中的图片，更早的图片替换为文字占位符(也不再下载)
+- 用摘要替换较早的对话: 按消息计算累计摘要，使用已缓存的最长前缀摘要
+- 仍然超出预算时从最早的对话开始截断，并在后台用 HISTORY_SUMMARY_MODEL 为截断掉的前缀生成摘要
+  (在上一段摘要的基础上增量生成)，之后的请求即可用摘要代替这些消息
+
+摘要合并到保留部分的第一条 user 消息开头，截断位置总是落在 user 消息上，保证对话角色交替。
+请求中的扩展字段 history_compaction (true/false) 可以覆盖 HISTORY_COMPACTION。
+摘要缓存在进程内，/stats 的 caches.history_summaries 中统计压缩次数、丢弃的消息/图片数和节省的 token 数(估算)，
+/metrics 中记为 llm_proxy_tokens_total{type="compacted"}。
+"""
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import metrics
+from cache import create_cache, digest
+from tokens import count_message_tokens, count_text_tokens
+
+HISTORY_COMPACTION = os.getenv("HISTORY_COMPACTION", "False").lower() == "true"
+# 压缩后 prompt 的目标 token 数(估算)
+HISTORY_MAX_TOKENS = int(os.getenv("HISTORY_MAX_TOKENS", 32000))
+# 始终原样保留的最近消息数
+HISTORY_KEEP_MESSAGES = int(os.getenv("HISTORY_KEEP_MESSAGES", 4))
+# 保留图片的最近含图片消息数
+HISTORY_IMAGE_MESSAGES = int(os.getenv("HISTORY_IMAGE_MESSAGES", 2))
+# 生成摘要的模型，留空表示只截断不生成摘要
+HISTORY_SUMMARY_MODEL = os.getenv("HISTORY_SUMMARY_MODEL", "gemini-2.5-flash-lite")
+HISTORY_SUMMARY_MAX_TOKENS = int(os.getenv("HISTORY_SUMMARY_MAX_TOKENS", 1024))
+
+_IMAGE_PLACEHOLDER = {"type": "text", "text": "[image omitted]"}
+_SUMMARY_PROMPT = (
+    "You compress chat history. Summarize the conversation below so it can replace the original messages: "
+    "keep facts, decisions, names, numbers, code identifiers, open questions and user preferences; drop "
+    "pleasantries. If a previous summary is given, merge it with the new messages into one summary. "
+    "Write in the language of the conversation and output only the summary."
+)
+_SUMMARY_HEADER = "Summary of the earlier conversation:\n"
+
+# 前缀摘要 -> {"text": 摘要, "tokens": 摘要的估算 token 数}
+summaries = create_cache("history_summaries", max_entries=int(os.getenv("HISTORY_SUMMARY_CACHE_SIZE", 1024)))
+
+# 由应用在启动时注册: complete(data) -> OpenAI 格式的非流式补全结果
+_handlers = {}
+
+_executor = ThreadPoolExecutor(max_workers=2, thread_name_prefix="history-summary")
+_pending = set()
+_pending_lock = threading.Lock()
+
+
+def start(complete):
+    """注册生成摘要使用的补全函数"""
+    _handlers["complete"] = complete
+
+
+def compact(data, model_name, blobs=None):
+    """返回压缩后的消息列表；未开启或未超出预算时原样返回 data["messages"]
+
+    blobs: 流式解析请求体时已解码的 Data URI {占位符: (图片字节, MIME 类型)}，占位符每个请求都不同，
+    计算前缀摘要时换成图片内容的摘要
+    """
+    messages = data.get("messages", [])
+    if not data.get("history_compaction", HISTORY_COMPACTION) or not messages:
+        return messages
+    system = [msg for msg in messages if msg.get("role") == "system"]
+    turns = [msg for msg in messages if msg.get("role") != "system"]
+    budget = HISTORY_MAX_TOKENS - sum(count_message_tokens(msg.get("content", "")) for msg in system)
+    tokens = [count_message_tokens(msg.get("content", "")) for msg in turns]
+    before = sum(tokens)
+    if before <= budget:
+        return messages
+
+    summaries.incr("compacted")
+    original = turns
+    turns, tokens = _drop_old_images(turns, tokens)
+
+    # 可以截断的位置: 保留部分以 user 消息开头，且至少保留最近 HISTORY_KEEP_MESSAGES 条
+    limit = min(len(turns) - HISTORY_KEEP_MESSAGES, len(turns) - 1)
+    cuts = [i for i in range(1, limit + 1) if turns[i].get("role") == "user"]
+    keys = _prefix_keys(original, limit, blobs)
+
+    # 已缓存的最长前缀摘要
+    base = next((i for i in reversed(cuts) if keys[i] in summaries), 0)
+    summary = summaries.get(keys[base]) if base else None
+    if summary is not None:
+        summaries.incr("summaries_used")
+    summary_tokens = summary["tokens"] if summary is not None else 0
+
+    # 仍然超出预算时继续截断，截断位置之前没有被摘要覆盖的消息在后台生成摘要
+    cut = base
+    if summary_tokens + sum(tokens[cut:]) > budget:
+        candidates = [i for i in cuts if i > base]
+        cut = next((i for i in candidates if summary_tokens + sum(tokens[i:]) <= budget),
+                   candidates[-1] if candidates else base)
+        if cut > base and HISTORY_SUMMARY_MODEL and "complete" in _handlers:
+            _submit(keys[cut], summary, original[base:cut])
+    if cut:
+        summaries.incr("messages_dropped", cut)
+
+    kept = list(turns[cut:])
+    if summary is not None and kept:
+        kept[0] = _with_summary(kept[0], summary["text"])
+    after = summary_tokens + sum(tokens[cut:])
+    saved = max(before - after, 0)
+    summaries.incr("tokens_saved", saved)
+    metrics.TOKENS.labels(model_name, "compacted").inc(saved)
+    return system + kept
+
+
+def _drop_old_images(turns, tokens):
+    """把较早消息中的图片替换为占位符，返回新的 (消息列表, token 数列表)"""
+    with_images = [i for i, msg in enumerate(turns) if _image_count(msg)]
+    old = with_images[:-HISTORY_IMAGE_MESSAGES] if HISTORY_IMAGE_MESSAGES > 0 else with_images
+    if not old:
+        return turns, tokens
+    turns, tokens = list(turns), list(tokens)
+    for i in old:
+        summaries.incr("images_dropped", _image_count(turns[i]))
+        content = [_IMAGE_PLACEHOLDER if isinstance(item, dict) and item.get("type") == "image_url" else item
+                   for item in turns[i]["content"]]
+        turns[i] = dict(turns[i], content=content)
+        tokens[i] = count_message_tokens(content)
+    return turns, tokens
+
+
+def _image_count(msg):
+    content = msg.get("content")
+    if not isinstance(content, list):
+        return 0
+    return sum(1 for item in content if isinstance(item, dict) and item.get("type") == "image_url")
+
+
+def _prefix_keys(turns, limit, blobs=None):
+    """前 i 条消息的累计摘要 (i = 0..limit)，基于原始消息计算，与图片是否被替换无关"""
+    keys = [digest("history")]
+    for msg in turns[:max(limit, 0)]:
+        content = msg.get("content")
+        if blobs and isinstance(content, list):
+            content = [_stable_item(item, blobs) for item in content]
+        keys.append(digest([keys[-1], msg.get("role"), content]))
+    return keys
+
+
+def _stable_item(item, blobs):
+    url = (item.get("image_url") or {}).get("url") if isinstance(item, dict) else None
+    if url in blobs:
+        return {"type": "image_url", "image_url": {"url": digest(blobs[url][0])}}
+    return item
+
+
+def _with_summary(msg, text):
+    """把摘要放到 user 消息的开头"""
+    header = f"{_SUMMARY_HEADER}{text}\n\n"
+    content = msg.get("content", "")
+    if isinstance(content, list):
+        return dict(msg, content=[{"type": "text", "text": header}] + content)
+    return dict(msg, content=header + str(content))
+
+
+def _transcript(messages):
+    lines = []
+    for msg in messages:
+        content = msg.get("content", "")
+        if isinstance(content, list):
+            content = " ".join(item.get("text", "") if item.get("type") == "text" else "[image]"
+                               for item in content if isinstance(item, dict))
+        lines.append(f"{msg.get('role')}: {content}")
+    return "\n\n".join(lines)
+
+
+def _submit(key, previous, messages):
+    """在后台生成摘要；同一前缀同时只生成一次"""
+    with _pending_lock:
+        if key in _pending:
+            return
+        _pending.add(key)
+
+    def run():
+        try:
+            _summarize(key, previous, messages)
+        except Exception as e:
+            summaries.incr("errors")
+            print(f"警告: 生成对话摘要失败 - {str(e)}")
+        finally:
+            with _pending_lock:
+                _pending.discard(key)
+
+    _executor.submit(run)
+
+
+def _summarize(key, previous, messages):
+    """在上一段摘要(可能为 None)的基础上为 messages 生成摘要并缓存"""
+    text = _transcript(messages)
+    if previous is not None:
+        text = f"Previous summary:\n{previous['text']}\n\nNew messages:\n{text}"
+    result = _handlers["complete"]({
+        "model": HISTORY_SUMMARY_MODEL,
+        "messages": [{"role": "system", "content": _SUMMARY_PROMPT}, {"role": "user", "content": text}],
+        "temperature": 0,
+        "max_output_tokens": HISTORY_SUMMARY_MAX_TOKENS,
+        "history_compaction": False,
+    })
+    summary = (result["choices"][0]["message"]["content"] or "").strip()
+    if summary:
+        summaries.set(key, {"text": summary, "tokens": count_text_tokens(_SUMMARY_HEADER + summary)})
+        summaries.incr("summaries_created")
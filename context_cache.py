@@ -0,0 +1,141 @@
+"""
+Vertex AI 上下文缓存 (Context Caching)
+
+不少应用每次请求都携带相同的超长 system prompt 或文档前缀。开启后:
+- 按消息计算累计摘要，请求的前缀 = system_instruction + 开头的若干条 contents
+- 同一前缀出现 CONTEXT_CACHE_MIN_HITS 次且估算 token 数不少于 CONTEXT_CACHE_MIN_TOKENS 时，
+  在后台为所用后端创建 CachedContent；创建完成后的请求只发送前缀之后的内容
+- 剩余有效期不足一半时在后台续期；上游报告缓存不存在时丢弃本地记录并按完整请求重发
+- /stats 的 caches.context_caches 中统计使用次数和节省的输入 token 数(估算)，
+  /metrics 中记为 llm_proxy_tokens_total{type="cached"}
+
+缓存记录保存在进程内，每个工作进程各自创建；本地记录被淘汰后，上游的缓存在 TTL 到期后自动删除。
+"""
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import metrics
+from cache import create_cache, digest
+from response_cache import part_key
+from tokens import count_content_tokens, count_text_tokens
+
+CONTEXT_CACHE_ENABLED = os.getenv("CONTEXT_CACHE_ENABLED", "False").lower() == "true"
+# 前缀达到该 token 数才创建缓存(Vertex AI 对可缓存内容有最小 token 数要求)
+CONTEXT_CACHE_MIN_TOKENS = int(os.getenv("CONTEXT_CACHE_MIN_TOKENS", 32768))
+# 前缀出现多少次后才创建缓存，避免为一次性的 prompt 支付缓存存储费用
+CONTEXT_CACHE_MIN_HITS = int(os.getenv("CONTEXT_CACHE_MIN_HITS", 2))
+CONTEXT_CACHE_TTL = int(os.getenv("CONTEXT_CACHE_TTL", 3600))
+CONTEXT_CACHE_SIZE = int(os.getenv("CONTEXT_CACHE_SIZE", 64))
+# 剩余有效期少于该秒数的缓存不再使用，避免请求到达上游时缓存恰好过期
+_EXPIRY_MARGIN = 60
+
+# 前缀摘要 -> 出现次数
+prefix_counts = create_cache("context_prefixes", max_entries=4096)
+# (后端, 前缀摘要) -> {"name": CachedContent 资源名, "expires": 过期时间, "length": 前缀消息数, "tokens": 估算 token 数}
+cached_contents = create_cache("context_caches", max_entries=CONTEXT_CACHE_SIZE)
+
+_executor = ThreadPoolExecutor(max_workers=2, thread_name_prefix="context-cache")
+_pending = set()
+_pending_lock = threading.Lock()
+
+
+def find_prefixes(model_name, system_instruction, contents):
+    """返回请求中可以缓存的前缀 [{"key", "length", "tokens", "create"}]，按长度从长到短排列
+
+    至少保留最后一条消息不放入缓存，因为 generate_content 的 contents 不能为空。
+    """
+    if not CONTEXT_CACHE_ENABLED:
+        return None
+    key = digest([model_name, system_instruction])
+    tokens = count_text_tokens(system_instruction) if isinstance(system_instruction, str) else 0
+    prefixes = []
+    for length in range(len(contents)):
+        if length:
+            content = contents[length - 1]
+            key = digest([key, content.role, [part_key(part) for part in content.parts]])
+            tokens += count_content_tokens([content])
+        if tokens < CONTEXT_CACHE_MIN_TOKENS:
+            continue
+        seen = prefix_counts.get(key, 0) + 1
+        prefix_counts.set(key, seen)
+        prefixes.append({"key": key, "length": length, "tokens": tokens, "create": seen >= CONTEXT_CACHE_MIN_HITS})
+    return prefixes[::-1] or None
+
+
+def lookup(chat_req, backend):
+    """返回该后端上可用的缓存记录；没有时为最长的热门前缀在后台创建缓存"""
+    prefixes = chat_req.get("context_prefixes")
+    if not prefixes:
+        return None
+    now = time.time()
+    for prefix in prefixes:
+        entry = cached_contents.get((backend.name, prefix["key"]))
+        if entry is not None and entry["expires"] - now > _EXPIRY_MARGIN:
+            if entry["expires"] - now < CONTEXT_CACHE_TTL / 2:
+                _submit(("refresh", backend.name, prefix["key"]), _refresh, backend, prefix["key"], entry)
+            cached_contents.incr("used")
+            cached_contents.incr("tokens_saved", entry["tokens"])
+            metrics.TOKENS.labels(chat_req["model_name"], "cached").inc(entry["tokens"])
+            return entry
+    candidate = next((prefix for prefix in prefixes if prefix["create"]), None)
+    if candidate is not None:
+        _submit(("create", backend.name, candidate["key"]), _create, backend, chat_req, candidate)
+    return None
+
+
+def invalidate(backend, entry):
+    """上游缓存已不存在时丢弃本地记录"""
+    cached_contents.delete((backend.name, entry["key"]))
+    cached_contents.incr("invalidated")
+
+
+def is_missing(error):
+    """判断错误是否表示引用的缓存不存在或已过期"""
+    code = getattr(error, "code", None)
+    return code in (400, 404) and "cache" in str(error).lower()
+
+
+def _submit(task_key, fn, *args):
+    """同一个创建/续期任务同时只执行一个"""
+    with _pending_lock:
+        if task_key in _pending:
+            return
+        _pending.add(task_key)
+
+    def run():
+        try:
+            fn(*args)
+        except Exception as e:
+            cached_contents.incr("errors")
+            print(f"警告: 上下文缓存操作失败 - {str(e)}")
+        finally:
+            with _pending_lock:
+                _pending.discard(task_key)
+
+    _executor.submit(run)
+
+
+def _create(backend, chat_req, prefix):
+    """在指定后端创建 CachedContent"""
+    import upstream
+    name = upstream.create_cache(upstream.client_for(backend), chat_req, prefix["length"], CONTEXT_CACHE_TTL)
+    entry = {
+        "name": name,
+        "expires": time.time() + CONTEXT_CACHE_TTL,
+        "key": prefix["key"],
+        "length": prefix["length"],
+        "tokens": prefix["tokens"],
+    }
+    cached_contents.set((backend.name, prefix["key"]), entry, ttl=CONTEXT_CACHE_TTL)
+    cached_contents.incr("created")
+
+
+def _refresh(backend, key, entry):
+    """延长缓存有效期"""
+    import upstream
+    upstream.update_cache(upstream.client_for(backend), entry["name"], CONTEXT_CACHE_TTL)
+    entry["expires"] = time.time() + CONTEXT_CACHE_TTL
+    cached_contents.set((backend.name, key), entry, ttl=CONTEXT_CACHE_TTL)
+    cached_contents.incr("refreshed")
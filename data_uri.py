@@ -0,0 +1,78 @@
+"""
+Base64 Data URI 解码 - 按摘要缓存解码结果
+
+客户端每一轮都会重发完整的历史消息，同一张几 MB 的 data:image/...;base64, 图片
+会在每次请求中被重复解码。这里按编码内容的摘要缓存解码后的字节，
+并使用分块解码，避免额外生成一份完整的 ASCII 副本。
+"""
+import base64
+import binascii
+import hashlib
+import os
+
+from cache import create_cache
+
+CACHE_MAX_BYTES = int(os.getenv("DATA_URI_CACHE_MAX_BYTES", 256 * 1024 * 1024))
+# 分块大小(字符数)，必须是 4 的倍数
+DECODE_CHUNK_CHARS = 1024 * 1024
+
+# 编码内容摘要 -> 解码后的图片字节
+decoded_cache = create_cache("data_uris", max_entries=1024, max_bytes=CACHE_MAX_BYTES)
+
+
+def _digest(encoded_data):
+    """分块计算 base64 字符串的摘要，避免一次性生成完整的字节副本"""
+    h = hashlib.sha256()
+    for i in range(0, len(encoded_data), DECODE_CHUNK_CHARS):
+        h.update(encoded_data[i:i + DECODE_CHUNK_CHARS].encode("ascii"))
+    return h.hexdigest()
+
+
+def b64decode_chunked(encoded_data):
+    """分块解码 base64 字符串
+
+    base64.b64decode 会先把整个字符串转换为 ASCII 字节副本(约为结果的 1.33 倍)再解码；
+    分块解码时每次只转换一个块，不再产生完整的 ASCII 副本。
+    """
+    # 含有换行等空白字符或长度不规整时，分块边界无法对齐，回退到整体解码
+    if len(encoded_data) % 4 or any(c in encoded_data for c in "\r\n \t"):
+        return base64.b64decode(encoded_data)
+
+    out = bytearray()
+    for i in range(0, len(encoded_data), DECODE_CHUNK_CHARS):
+        out += binascii.a2b_base64(encoded_data[i:i + DECODE_CHUNK_CHARS].encode("ascii"))
+    return bytes(out)
+
+
+def get_decoded(key):
+    """按编码内容摘要读取已解码的数据"""
+    data = decoded_cache.get(key)
+    if data is not None:
+        # 命中缓存时节省了一次解码及对应大小的内存分配
+        decoded_cache.incr("bytes_saved", len(data))
+    return data
+
+
+def store_decoded(key, data):
+    """缓存解码结果"""
+    decoded_cache.incr("bytes_decoded", len(data))
+    decoded_cache.set(key, data, size=len(data))
+
+
+def decode_data_uri(data_uri):
+    """解析 Data URI: data:[<mime_type>];base64,[<data>]，返回 (图片字节, MIME 类型)"""
+    header, encoded_data = data_uri.split(",", 1)
+    mime_type = header.split(";")[0].split(":")[1]
+
+    key = _digest(encoded_data)
+    data = get_decoded(key)
+    if data is not None:
+        return data, mime_type
+
+    # 将 base64 字符串解码为字节
+    try:
+        data = b64decode_chunked(encoded_data)
+    except (binascii.Error, UnicodeEncodeError) as e:
+        raise ValueError(f"base64 数据解码失败: {e}")
+    store_decoded(key, data)
+    return data, mime_type
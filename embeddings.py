@@ -0,0 +1,372 @@
+"""
+Embeddings (OpenAI 兼容的 /v1/embeddings)
+
+- input 为字符串或字符串列表；dimensions 对应上游的 output_dimensionality，encoding_format 支持 float / base64，
+  扩展字段 task_type (如 RETRIEVAL_DOCUMENT / RETRIEVAL_QUERY) 原样传给上游
+- 微批处理: EMBEDDING_BATCH_WINDOW_MS 时间窗口内到达的输入按 (模型, 维度, task_type) 合并成一次上游调用，
+  每批不超过 EMBEDDING_MAX_BATCH 条、估算 token 数不超过 EMBEDDING_MAX_BATCH_TOKENS，结果再分发给各个请求；
+  窗口内重复的文本只发送一次
+- 按 (模型, 维度, task_type, 文本) 的摘要缓存向量(float32)，相同文本不再请求上游
+- stream=true 时以 SSE 返回，每个输入的结果一到达就发送，适合一次提交大量文本的索引任务:
+    data: {"object": "embedding", "index": 0, "embedding": [...]}
+    ...
+    data: {"object": "list", "model": "...", "usage": {...}}
+    data: [DONE]
+
+批处理在每个工作进程内进行，Gunicorn 同步工作进程一次只处理一个请求，合并只在多线程或异步(ASGI)模式下生效；
+单个请求中的多条输入在任何模式下都会按上述限制分批。
+"""
+import asyncio
+import base64
+import json
+import os
+import struct
+import threading
+import time
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
+
+from cache import create_cache, digest
+from tokens import count_text_tokens
+
+# 未指定或使用 OpenAI 模型名时调用的模型
+EMBEDDING_MODEL = os.getenv("EMBEDDING_MODEL", "text-embedding-005")
+EMBEDDING_BATCH_WINDOW_MS = float(os.getenv("EMBEDDING_BATCH_WINDOW_MS", 10))
+# 每次上游调用的输入条数和估算 token 数上限 (Vertex AI 文本 embedding 模型: 250 条、20000 token)
+EMBEDDING_MAX_BATCH = int(os.getenv("EMBEDDING_MAX_BATCH", 250))
+EMBEDDING_MAX_BATCH_TOKENS = int(os.getenv("EMBEDDING_MAX_BATCH_TOKENS", 20000))
+# 每个进程同时进行的上游调用数
+EMBEDDING_CONCURRENCY = int(os.getenv("EMBEDDING_CONCURRENCY", 8))
+# 单个请求的最大输入条数(与 OpenAI 一致)
+EMBEDDING_MAX_INPUTS = int(os.getenv("EMBEDDING_MAX_INPUTS", 2048))
+EMBEDDING_CACHE_SIZE = int(os.getenv("EMBEDDING_CACHE_SIZE", 100000))
+EMBEDDING_CACHE_MAX_BYTES = int(os.getenv("EMBEDDING_CACHE_MAX_BYTES", 256 * 1024 * 1024))
+
+# 映射到 EMBEDDING_MODEL 的 OpenAI 模型名
+OPENAI_MODELS = ("text-embedding-3-small", "text-embedding-3-large", "text-embedding-ada-002")
+# 每次调用只接受一条输入的模型
+_SINGLE_INPUT_MODELS = ("gemini-embedding-001",)
+
+# 摘要 -> (float32 向量, token 数)
+embedding_cache = create_cache("embeddings", max_entries=EMBEDDING_CACHE_SIZE, max_bytes=EMBEDDING_CACHE_MAX_BYTES)
+
+# 由应用在启动时注册: embed(model, texts, dimensions, task_type) -> [(向量, token 数或 None)]
+_handlers = {}
+
+_counters_lock = threading.Lock()
+_counters = {
+    "requests": 0,
+    "inputs": 0,
+    "cache_hits": 0,
+    "deduplicated": 0,
+    "upstream_calls": 0,
+    "upstream_inputs": 0,
+}
+
+
+class EmbeddingError(Exception):
+    """embedding 请求无效"""
+
+    code = 400
+
+
+def _incr(name, amount=1):
+    with _counters_lock:
+        _counters[name] += amount
+
+
+def stats():
+    """返回 embedding 统计信息，avg_batch_size 为平均每次上游调用的输入条数"""
+    with _counters_lock:
+        calls = _counters["upstream_calls"]
+        return {**_counters, "avg_batch_size": round(_counters["upstream_inputs"] / calls, 2) if calls else 0,
+                "window_ms": EMBEDDING_BATCH_WINDOW_MS}
+
+
+def start(embed):
+    """注册上游调用函数，由应用启动时调用"""
+    _handlers["embed"] = embed
+
+
+def resolve_model(name):
+    """OpenAI 模型名和未指定的模型使用 EMBEDDING_MODEL，其他模型名直接透传"""
+    if not name or name in OPENAI_MODELS:
+        return EMBEDDING_MODEL
+    return name
+
+
+def _pack(vector):
+    return struct.pack(f"<{len(vector)}f", *vector)
+
+
+def _unpack(data):
+    return list(struct.unpack(f"<{len(data) // 4}f", data))
+
+
+class _Item:
+    """等待批处理的一条输入"""
+
+    __slots__ = ("key", "text", "tokens", "future")
+
+    def __init__(self, key, text, tokens):
+        self.key = key
+        self.text = text
+        self.tokens = tokens
+        self.future = Future()
+
+
+class MicroBatcher:
+    """把时间窗口内的输入按组合并成批，交给线程池调用上游"""
+
+    def __init__(self, window, max_batch, max_tokens, concurrency):
+        self.window = window
+        self.max_batch = max_batch
+        self.max_tokens = max_tokens
+        self._concurrency = concurrency
+        self._cond = threading.Condition()
+        # 组 -> {"items": [...], "deadline": 最晚发送时间}
+        self._groups = {}
+        # 缓存键 -> 等待中的 _Item，用于合并窗口内的重复文本
+        self._pending = {}
+        self._pid = None
+        self._executor = None
+        self._inflight = 0
+
+    def _ensure_started(self):
+        """在本进程中启动调度线程(gunicorn --preload 时 fork 之前创建的线程不会被继承)"""
+        pid = os.getpid()
+        if self._pid != pid:
+            self._pid = pid
+            self._groups = {}
+            self._pending = {}
+            self._inflight = 0
+            self._executor = ThreadPoolExecutor(max_workers=self._concurrency, thread_name_prefix="embed")
+            threading.Thread(target=self._run, name="embed-batcher", daemon=True).start()
+
+    def submit(self, group, key, text, tokens):
+        """提交一条输入，返回 Future，结果为 (float32 向量, token 数)"""
+        with self._cond:
+            self._ensure_started()
+            item = self._pending.get(key)
+            if item is not None:
+                _incr("deduplicated")
+                return item.future
+            item = self._pending[key] = _Item(key, text, tokens)
+            entry = self._groups.get(group)
+            if entry is None:
+                entry = self._groups[group] = {"items": [], "tokens": 0,
+                                               "deadline": time.monotonic() + self.window}
+            entry["items"].append(item)
+            entry["tokens"] += tokens
+            if len(entry["items"]) >= self._max_batch(group) or entry["tokens"] >= self.max_tokens:
+                # 已经够一批，不必等到窗口结束
+                entry["deadline"] = 0
+            self._cond.notify()
+        return item.future
+
+    def _max_batch(self, group):
+        return 1 if group[0] in _SINGLE_INPUT_MODELS else self.max_batch
+
+    def _take(self, group, entry):
+        """从组中取出一批，剩余的输入立即在下一轮发送"""
+        limit = self._max_batch(group)
+        batch, tokens = [], 0
+        for item in entry["items"]:
+            if batch and (len(batch) >= limit or tokens + item.tokens > self.max_tokens):
+                break
+            batch.append(item)
+            tokens += item.tokens
+        entry["items"] = entry["items"][len(batch):]
+        entry["tokens"] -= tokens
+        entry["deadline"] = 0
+        if not entry["items"]:
+            del self._groups[group]
+        return batch
+
+    def _run(self):
+        """调度线程: 窗口到期(或已够一批)时取出一批发送
+
+        上游调用数达到并发上限时先不取，输入继续在组中累积，负载越高每批越大。
+        """
+        while True:
+            ready = []
+            with self._cond:
+                while True:
+                    now = time.monotonic()
+                    if self._inflight < self._concurrency:
+                        due = [group for group, entry in self._groups.items() if entry["deadline"] <= now]
+                        if due:
+                            break
+                        timeout = min((entry["deadline"] for entry in self._groups.values()), default=now + 60) - now
+                    else:
+                        timeout = None
+                    self._cond.wait(timeout)
+                for group in due[:self._concurrency - self._inflight]:
+                    ready.append((group, self._take(group, self._groups[group])))
+                self._inflight += len(ready)
+            for group, batch in ready:
+                self._executor.submit(self._send, group, batch)
+
+    def _send(self, group, batch):
+        try:
+            self._embed(group, batch)
+        finally:
+            with self._cond:
+                self._inflight -= 1
+                self._cond.notify()
+
+    def _embed(self, group, batch):
+        model, dimensions, task_type = group
+        try:
+            _incr("upstream_calls")
+            _incr("upstream_inputs", len(batch))
+            results = _handlers["embed"](model, [item.text for item in batch], dimensions, task_type)
+            if len(results) != len(batch):
+                raise RuntimeError(f"上游返回了 {len(results)} 个 embedding，请求了 {len(batch)} 个")
+        except Exception as e:
+            with self._cond:
+                for item in batch:
+                    self._pending.pop(item.key, None)
+            for item in batch:
+                item.future.set_exception(e)
+            return
+        values = [(_pack(vector), tokens if tokens is not None else item.tokens)
+                  for item, (vector, tokens) in zip(batch, results)]
+        for item, value in zip(batch, values):
+            embedding_cache.set(item.key, value, size=len(value[0]))
+        with self._cond:
+            for item in batch:
+                self._pending.pop(item.key, None)
+        for item, value in zip(batch, values):
+            item.future.set_result(value)
+
+
+batcher = MicroBatcher(EMBEDDING_BATCH_WINDOW_MS / 1000, EMBEDDING_MAX_BATCH, EMBEDDING_MAX_BATCH_TOKENS,
+                       EMBEDDING_CONCURRENCY)
+
+
+def parse_request(data):
+    """校验请求，返回 {"model", "inputs", "dimensions", "task_type", "encoding_format", "stream"}"""
+    inputs = data.get("input")
+    if isinstance(inputs, str):
+        inputs = [inputs]
+    if not isinstance(inputs, list) or not inputs:
+        raise EmbeddingError("input 必须是非空字符串或字符串列表")
+    if not all(isinstance(text, str) and text for text in inputs):
+        raise EmbeddingError("input 只支持非空字符串，不支持 token 数组")
+    if len(inputs) > EMBEDDING_MAX_INPUTS:
+        raise EmbeddingError(f"单个请求最多 {EMBEDDING_MAX_INPUTS} 条输入")
+    encoding_format = data.get("encoding_format") or "float"
+    if encoding_format not in ("float", "base64"):
+        raise EmbeddingError("encoding_format 只支持 float 或 base64")
+    dimensions = data.get("dimensions")
+    if dimensions is not None and (not isinstance(dimensions, int) or dimensions <= 0):
+        raise EmbeddingError("dimensions 必须是正整数")
+    return {
+        "model": resolve_model(data.get("model")),
+        "inputs": inputs,
+        "dimensions": dimensions,
+        "task_type": data.get("task_type"),
+        "encoding_format": encoding_format,
+        "stream": bool(data.get("stream")),
+    }
+
+
+def submit(embed_req):
+    """为请求中的每条输入返回一个 Future；缓存命中的输入直接返回已完成的 Future"""
+    _incr("requests")
+    _incr("inputs", len(embed_req["inputs"]))
+    group = (embed_req["model"], embed_req["dimensions"], embed_req["task_type"])
+    futures = []
+    for text in embed_req["inputs"]:
+        key = digest([*group, text])
+        cached = embedding_cache.get(key)
+        if cached is not None:
+            _incr("cache_hits")
+            future = Future()
+            future.set_result(cached)
+        else:
+            future = batcher.submit(group, key, text, count_text_tokens(text))
+        futures.append(future)
+    return futures
+
+
+def embedding_object(index, value, encoding_format):
+    """单条输入的 OpenAI embedding 对象"""
+    data = value[0]
+    embedding = base64.b64encode(data).decode() if encoding_format == "base64" else _unpack(data)
+    return {"object": "embedding", "index": index, "embedding": embedding}
+
+
+def _usage(values):
+    tokens = sum(value[1] for value in values)
+    return {"prompt_tokens": tokens, "total_tokens": tokens}
+
+
+def build_response(embed_req, values):
+    """非流式响应"""
+    return {
+        "object": "list",
+        "data": [embedding_object(index, value, embed_req["encoding_format"]) for index, value in enumerate(values)],
+        "model": embed_req["model"],
+        "usage": _usage(values),
+    }
+
+
+def create(embed_req, futures, timeout=None):
+    """等待所有输入的结果(同步)，返回 OpenAI 格式的响应；futures 为 submit 的返回值"""
+    deadline = time.monotonic() + timeout if timeout is not None else None
+    values = [future.result(None if deadline is None else max(0, deadline - time.monotonic())) for future in futures]
+    return build_response(embed_req, values)
+
+
+def _final_frames(embed_req, values, usage_out):
+    usage = _usage(values)
+    if usage_out is not None:
+        usage_out.update(usage)
+    yield f"data: {json.dumps({'object': 'list', 'model': embed_req['model'], 'usage': usage})}\n\n"
+    yield "data: [DONE]\n\n"
+
+
+def stream(embed_req, futures, timeout=None, usage_out=None):
+    """按完成顺序以 SSE 发送每条输入的结果(同步)"""
+    index_of = {future: index for index, future in enumerate(futures)}
+    pending = set(futures)
+    values = []
+    deadline = time.monotonic() + timeout if timeout is not None else None
+    while pending:
+        remaining = None if deadline is None else max(0, deadline - time.monotonic())
+        done, pending = wait(pending, timeout=remaining, return_when=FIRST_COMPLETED)
+        if not done:
+            raise TimeoutError("embedding 请求超时")
+        for future in done:
+            value = future.result()
+            values.append(value)
+            yield f"data: {json.dumps(embedding_object(index_of[future], value, embed_req['encoding_format']))}\n\n"
+    yield from _final_frames(embed_req, values, usage_out)
+
+
+async def create_async(embed_req, futures, timeout=None):
+    """create 的异步版本"""
+    # Future 可能由多个请求共享，超时或取消时不能取消它(shield)
+    values = await asyncio.wait_for(
+        asyncio.gather(*(asyncio.shield(asyncio.wrap_future(future)) for future in futures)), timeout)
+    return build_response(embed_req, values)
+
+
+async def stream_async(embed_req, futures, timeout=None, usage_out=None):
+    """stream 的异步版本"""
+    wrapped = {asyncio.shield(asyncio.wrap_future(future)): index for index, future in enumerate(futures)}
+    pending = set(wrapped)
+    values = []
+    deadline = time.monotonic() + timeout if timeout is not None else None
+    while pending:
+        remaining = None if deadline is None else max(0, deadline - time.monotonic())
+        done, pending = await asyncio.wait(pending, timeout=remaining, return_when=asyncio.FIRST_COMPLETED)
+        if not done:
+            raise TimeoutError("embedding 请求超时")
+        for future in done:
+            value = future.result()
+            values.append(value)
+            yield f"data: {json.dumps(embedding_object(wrapped[future], value, embed_req['encoding_format']))}\n\n"
+    for frame in _final_frames(embed_req, values, usage_out):
+        yield frame
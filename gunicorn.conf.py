@@ -0,0 +1,17 @@
+"""
+Gunicorn 配置 - 由 gunicorn 在启动目录中自动加载
+
+命令行参数由 start.py 传入，这里只放需要以 Python 代码形式提供的钩子。
+"""
+
+
+def child_exit(server, worker):
+    """工作进程退出时清理其 Prometheus 多进程指标"""
+    from metrics import mark_process_dead
+    mark_process_dead(worker.pid)
+
+
+def post_worker_init(worker):
+    """工作进程启动后开始预热(STARTUP_MODE=warmup)；--preload 时应用在主进程导入，预热必须在 fork 之后进行"""
+    from startup import begin
+    begin()
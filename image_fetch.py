@@ -0,0 +1,311 @@
+"""
+远程图片抓取 - 由代理自己下载 http(s) 图片，而不是把 URL 直接交给 Vertex AI
+
+- 同一请求中的所有图片 URL 通过共享连接池并发下载
+- 限制单张图片的字节数和下载时间
+- 根据文件头识别真实的 MIME 类型
+- 按内容摘要(sha256)缓存到内存 LRU 和(可选的)磁盘目录，多轮对话重复发送的图片只下载一次
+- 防止 SSRF: 只允许 http(s)，可用 IMAGE_FETCH_ALLOWED_HOSTS 限定域名；默认拒绝解析到内网、回环、链路本地
+  (如 169.254.169.254 元数据服务)等非公网地址的 URL，建立连接后再按实际连接的地址检查一次(防止 DNS 重绑定)；
+  重定向不自动跟随，每一跳都重新检查；不使用 HTTP(S)_PROXY 环境变量
+"""
+import hashlib
+import ipaddress
+import os
+import socket
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urljoin, urlsplit
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.connection import HTTPConnection, HTTPSConnection
+from urllib3.connectionpool import HTTPConnectionPool, HTTPSConnectionPool
+
+from cache import create_cache
+
+FETCH_MAX_BYTES = int(os.getenv("IMAGE_FETCH_MAX_BYTES", 20 * 1024 * 1024))
+FETCH_TIMEOUT = float(os.getenv("IMAGE_FETCH_TIMEOUT", 10))
+FETCH_CONCURRENCY = int(os.getenv("IMAGE_FETCH_CONCURRENCY", 8))
+CACHE_MAX_BYTES = int(os.getenv("IMAGE_CACHE_MAX_BYTES", 256 * 1024 * 1024))
+CACHE_DIR = os.getenv("IMAGE_CACHE_DIR", "")
+CACHE_DIR_MAX_BYTES = int(os.getenv("IMAGE_CACHE_DIR_MAX_BYTES", 1024 * 1024 * 1024))
+# 允许下载的域名，逗号分隔，".example.com" 表示包括子域名；留空表示不限制
+ALLOWED_HOSTS = [host.strip().lower() for host in os.getenv("IMAGE_FETCH_ALLOWED_HOSTS", "").split(",") if host.strip()]
+# 是否允许下载内网、回环等非公网地址上的图片(只应在受信任的内网部署中开启)
+ALLOW_PRIVATE = os.getenv("IMAGE_FETCH_ALLOW_PRIVATE", "False").lower() == "true"
+MAX_REDIRECTS = 3
+
+# URL -> 内容摘要
+url_index = create_cache("image_urls", max_entries=4096)
+# 内容摘要 -> (图片字节, MIME 类型)
+image_cache = create_cache("images", max_entries=1024, max_bytes=CACHE_MAX_BYTES)
+
+
+
+class BlockedURL(ValueError):
+    """URL 不允许由代理下载"""
+
+
+def _is_public(address):
+    """地址是否为公网地址"""
+    ip = ipaddress.ip_address(address.split("%")[0])
+    if ip.version == 6 and ip.ipv4_mapped is not None:
+        ip = ip.ipv4_mapped
+    return ip.is_global and not ip.is_multicast
+
+
+def check_url(url):
+    """检查 URL 是否允许下载，不允许时抛出 BlockedURL"""
+    parts = urlsplit(url)
+    if parts.scheme not in ("http", "https") or not parts.hostname:
+        raise BlockedURL(f"不支持的图片 URL '{url}'")
+    host = parts.hostname.lower()
+    if ALLOWED_HOSTS and not any(host == allowed or (allowed.startswith(".") and host.endswith(allowed))
+                                 for allowed in ALLOWED_HOSTS):
+        raise BlockedURL(f"图片 URL 的域名 '{host}' 不在 IMAGE_FETCH_ALLOWED_HOSTS 中")
+    if ALLOW_PRIVATE:
+        return
+    try:
+        infos = socket.getaddrinfo(host, parts.port or (443 if parts.scheme == "https" else 80),
+                                   type=socket.SOCK_STREAM)
+    except (socket.gaierror, UnicodeError) as e:
+        raise BlockedURL(f"无法解析图片 URL 的域名 '{host}' - {str(e)}") from e
+    for info in infos:
+        if not _is_public(info[4][0]):
+            raise BlockedURL(f"图片 URL '{url}' 指向非公网地址 {info[4][0]}")
+
+
+class _PublicOnly:
+    """建立连接后检查实际连接的地址，防止 check_url 之后 DNS 解析结果发生变化"""
+
+    def _new_conn(self):
+        sock = super()._new_conn()
+        address = sock.getpeername()[0]
+        if not ALLOW_PRIVATE and not _is_public(address):
+            sock.close()
+            raise BlockedURL(f"图片地址 '{self.host}' 解析到非公网地址 {address}")
+        return sock
+
+
+class _HTTPConnection(_PublicOnly, HTTPConnection):
+    pass
+
+
+class _HTTPSConnection(_PublicOnly, HTTPSConnection):
+    pass
+
+
+class _HTTPPool(HTTPConnectionPool):
+    ConnectionCls = _HTTPConnection
+
+
+class _HTTPSPool(HTTPSConnectionPool):
+    ConnectionCls = _HTTPSConnection
+
+
+class _Adapter(HTTPAdapter):
+    """只连接公网地址的连接池"""
+
+    def init_poolmanager(self, *args, **kwargs):
+        super().init_poolmanager(*args, **kwargs)
+        self.poolmanager.pool_classes_by_scheme = {"http": _HTTPPool, "https": _HTTPSPool}
+
+
+_session = requests.Session()
+# 通过代理下载时无法检查实际访问的地址
+_session.trust_env = False
+_adapter = _Adapter(pool_connections=FETCH_CONCURRENCY, pool_maxsize=FETCH_CONCURRENCY)
+_session.mount("http://", _adapter)
+_session.mount("https://", _adapter)
+_executor = ThreadPoolExecutor(max_workers=FETCH_CONCURRENCY, thread_name_prefix="image-fetch")
+
+# 文件头签名 -> MIME 类型
+_SIGNATURES = [
+    (b"\x89PNG\r\n\x1a\n", "image/png"),
+    (b"\xff\xd8\xff", "image/jpeg"),
+    (b"GIF87a", "image/gif"),
+    (b"GIF89a", "image/gif"),
+    (b"BM", "image/bmp"),
+]
+
+
+def sniff_mime_type(data):
+    """根据文件头识别图片的 MIME 类型，无法识别时返回 None"""
+    for signature, mime_type in _SIGNATURES:
+        if data.startswith(signature):
+            return mime_type
+    if data[:4] == b"RIFF" and data[8:12] == b"WEBP":
+        return "image/webp"
+    if data[4:8] == b"ftyp":
+        brand = data[8:12]
+        if brand in (b"heic", b"heix", b"hevc", b"hevx"):
+            return "image/heic"
+        if brand in (b"mif1", b"msf1", b"heif"):
+            return "image/heif"
+        if brand in (b"avif", b"avis"):
+            return "image/avif"
+    return None
+
+
+def _disk_path(key):
+    return os.path.join(CACHE_DIR, key[:2], key)
+
+
+def _disk_get(key):
+    """从磁盘缓存读取图片"""
+    path = _disk_path(key)
+    try:
+        with open(path, "rb") as f:
+            data = f.read()
+    except OSError:
+        return None
+    # 更新修改时间，磁盘淘汰时按修改时间从旧到新删除
+    os.utime(path)
+    return data
+
+
+# 磁盘缓存占用的估计值: 扫描一次目录后累加本进程写入的字节数，超出容量或距上次扫描超过
+# _DISK_RESCAN_INTERVAL 秒(期间其他 worker 进程的写入没有计入)时才重新扫描
+_DISK_RESCAN_INTERVAL = 60
+_disk_usage = {"pid": None, "bytes": 0, "scanned_at": 0.0}
+_disk_lock = threading.Lock()
+
+
+def _disk_set(key, data):
+    """写入磁盘缓存，超出容量时删除最久未使用的文件"""
+    path = _disk_path(key)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_path, "wb") as f:
+        f.write(data)
+    os.replace(tmp_path, path)
+
+    with _disk_lock:
+        if _disk_usage["pid"] == os.getpid():
+            _disk_usage["bytes"] += len(data)
+            if (_disk_usage["bytes"] <= CACHE_DIR_MAX_BYTES
+                    and time.monotonic() - _disk_usage["scanned_at"] < _DISK_RESCAN_INTERVAL):
+                return
+        _disk_usage.update(pid=os.getpid(), bytes=_disk_prune(), scanned_at=time.monotonic())
+
+
+def _disk_prune():
+    """扫描磁盘缓存目录，超出容量时按修改时间删除最旧的文件，返回剩余的总字节数
+
+    删除到容量的 90%，避免缓存写满后每次写入都重新扫描
+    """
+    files = []
+    total = 0
+    for root, _, names in os.walk(CACHE_DIR):
+        for name in names:
+            file_path = os.path.join(root, name)
+            try:
+                st = os.stat(file_path)
+            except OSError:
+                continue
+            files.append((st.st_mtime, st.st_size, file_path))
+            total += st.st_size
+    if total <= CACHE_DIR_MAX_BYTES:
+        return total
+    files.sort()
+    for _, size, file_path in files:
+        if total <= CACHE_DIR_MAX_BYTES * 0.9:
+            break
+        try:
+            os.remove(file_path)
+            total -= size
+        except OSError:
+            pass
+    return total
+
+
+def _cache_lookup(key):
+    """按内容摘要查找图片，先查内存再查磁盘"""
+    entry = image_cache.get(key)
+    if entry is None and CACHE_DIR:
+        data = _disk_get(key)
+        if data is not None:
+            entry = (data, sniff_mime_type(data))
+            image_cache.set(key, entry, size=len(data))
+    return entry
+
+
+def _open(url):
+    """发起请求，逐跳检查并跟随重定向"""
+    for _ in range(MAX_REDIRECTS + 1):
+        check_url(url)
+        resp = _session.get(url, stream=True, timeout=FETCH_TIMEOUT, allow_redirects=False)
+        if not resp.is_redirect:
+            return resp
+        resp.close()
+        url = urljoin(url, resp.headers["Location"])
+    raise ValueError(f"图片 URL 重定向超过 {MAX_REDIRECTS} 次")
+
+
+def _download(url):
+    """下载单张图片，返回 (图片字节, MIME 类型)"""
+    deadline = time.monotonic() + FETCH_TIMEOUT
+    with _open(url) as resp:
+        resp.raise_for_status()
+        content_length = resp.headers.get("Content-Length")
+        if content_length and content_length.isdigit() and int(content_length) > FETCH_MAX_BYTES:
+            raise ValueError(f"图片 '{url}' 大小 {content_length} 字节，超过限制 {FETCH_MAX_BYTES} 字节")
+
+        buf = bytearray()
+        for chunk in resp.iter_content(chunk_size=64 * 1024):
+            buf.extend(chunk)
+            if len(buf) > FETCH_MAX_BYTES:
+                raise ValueError(f"图片 '{url}' 超过大小限制 {FETCH_MAX_BYTES} 字节")
+            if time.monotonic() > deadline:
+                raise TimeoutError(f"下载图片 '{url}' 超时 ({FETCH_TIMEOUT}秒)")
+        data = bytes(buf)
+
+    mime_type = sniff_mime_type(data)
+    if not mime_type:
+        header_type = resp.headers.get("Content-Type", "").split(";")[0].strip().lower()
+        if not header_type.startswith("image/"):
+            raise ValueError(f"URL '{url}' 返回的内容不是图片 (Content-Type: {header_type or '未知'})")
+        mime_type = header_type
+    return data, mime_type
+
+
+def fetch_image(url):
+    """获取单张远程图片，返回 (图片字节, MIME 类型)，优先使用缓存"""
+    key = url_index.get(url)
+    if key is not None:
+        entry = _cache_lookup(key)
+        if entry is not None:
+            return entry
+
+    data, mime_type = _download(url)
+    key = hashlib.sha256(data).hexdigest()
+    url_index.set(url, key)
+    if _cache_lookup(key) is None:
+        image_cache.set(key, (data, mime_type), size=len(data))
+        if CACHE_DIR:
+            try:
+                _disk_set(key, data)
+            except OSError as e:
+                print(f"警告: 写入图片磁盘缓存失败 - {str(e)}")
+    return data, mime_type
+
+
+def fetch_images(urls):
+    """并发获取多张远程图片，返回 {url: (图片字节, MIME 类型) 或 Exception}"""
+    unique_urls = list(dict.fromkeys(urls))
+    if not unique_urls:
+        return {}
+    if len(unique_urls) == 1:
+        futures = None
+    else:
+        futures = {url: _executor.submit(fetch_image, url) for url in unique_urls}
+
+    results = {}
+    for url in unique_urls:
+        try:
+            results[url] = futures[url].result() if futures else fetch_image(url)
+        except Exception as e:
+            results[url] = e
+    return results
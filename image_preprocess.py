@@ -0,0 +1,135 @@
+"""
+内联图片预处理 - 上传前缩小、重新编码超大图片并去除 EXIF
+
+手机照片动辄 1200 万像素、数 MB，原样内联上传会增加请求体大小、上传时间和图片 token 数
+(Gemini 按 768x768 的图块计费)。设置 IMAGE_PREPROCESS=True 开启后(默认关闭，需要安装 Pillow)，内联上传的图片(Base64、远程下载和本地文件)满足以下
+任一条件时重新编码:
+- 长边超过 IMAGE_MAX_DIMENSION: 按比例缩小(JPEG 解码时直接按比例降采样)
+- 文件大于 IMAGE_REENCODE_MIN_BYTES
+- 带有 EXIF 且 IMAGE_STRIP_EXIF=True: 先按 EXIF 方向旋转，再去除 EXIF(包括拍摄位置等信息)
+
+输出格式由 IMAGE_FORMAT 指定，auto 表示不透明图片使用 JPEG、带透明通道的图片使用 PNG；
+只因文件较大而重新编码、结果反而更大时保留原图。动图和 Pillow 无法解码的格式(如 HEIC)原样上传。
+
+同一请求中的多张图片在有界线程池中并发处理(Pillow 的解码、缩放和编码会释放 GIL)，
+结果按原图内容摘要缓存，多轮对话中重复发送的图片只处理一次。
+/stats 的 caches.preprocessed_images 中统计处理张数和节省的字节数，响应头 X-Image-Bytes-Saved 为本次请求节省的字节数。
+"""
+import contextvars
+import hashlib
+import io
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+import metrics
+from cache import create_cache
+
+IMAGE_PREPROCESS = os.getenv("IMAGE_PREPROCESS", "False").lower() == "true"
+# 长边上限(像素)，1536 时图片最多占 2x2 个图块
+IMAGE_MAX_DIMENSION = int(os.getenv("IMAGE_MAX_DIMENSION", 1536))
+# 输出格式: auto / jpeg / webp / png
+IMAGE_FORMAT = os.getenv("IMAGE_FORMAT", "auto").lower()
+IMAGE_QUALITY = int(os.getenv("IMAGE_QUALITY", 85))
+IMAGE_STRIP_EXIF = os.getenv("IMAGE_STRIP_EXIF", "True").lower() == "true"
+# 尺寸未超限的图片大于该字节数时也重新编码
+IMAGE_REENCODE_MIN_BYTES = int(os.getenv("IMAGE_REENCODE_MIN_BYTES", 1024 * 1024))
+IMAGE_PREPROCESS_WORKERS = int(os.getenv("IMAGE_PREPROCESS_WORKERS", min(4, os.cpu_count() or 1)))
+
+_FORMATS = {"jpeg": ("JPEG", "image/jpeg"), "webp": ("WEBP", "image/webp"), "png": ("PNG", "image/png")}
+# 重新编码后无需替换原图
+_UNCHANGED = ()
+
+# 原图摘要 -> (处理后的图片字节, MIME 类型)，无需处理的图片记为 _UNCHANGED
+processed_cache = create_cache("preprocessed_images", max_entries=1024,
+                           max_bytes=int(os.getenv("IMAGE_PREPROCESS_CACHE_MAX_BYTES", 128 * 1024 * 1024)))
+
+_executor = ThreadPoolExecutor(max_workers=IMAGE_PREPROCESS_WORKERS, thread_name_prefix="image-preprocess")
+_state = {"pillow": None}
+
+
+def _pillow():
+    """Pillow 是否可用，第一次调用时检查"""
+    if _state["pillow"] is None:
+        try:
+            import PIL.Image  # noqa: F401
+            _state["pillow"] = True
+        except ImportError:
+            print("警告: 未安装 Pillow，图片将原样上传 (pip install Pillow)")
+            _state["pillow"] = False
+    return _state["pillow"]
+
+
+def _reencode(data):
+    """按配置处理图片，返回 (图片字节, MIME 类型)；无需替换原图时返回 _UNCHANGED"""
+    from PIL import Image, ImageOps
+
+    with Image.open(io.BytesIO(data)) as img:
+        if getattr(img, "n_frames", 1) > 1:
+            return _UNCHANGED
+        oversized = max(img.size) > IMAGE_MAX_DIMENSION
+        strip_exif = IMAGE_STRIP_EXIF and "exif" in img.info
+        if not (oversized or strip_exif or len(data) > IMAGE_REENCODE_MIN_BYTES):
+            return _UNCHANGED
+        if oversized:
+            scale = IMAGE_MAX_DIMENSION / max(img.size)
+            size = (max(1, round(img.width * scale)), max(1, round(img.height * scale)))
+            if img.format == "JPEG":
+                # JPEG 解码时直接按 1/2、1/4、1/8 降采样(结果不小于目标尺寸)，比完整解码后再缩小快得多
+                img.draft(img.mode, size)
+            img.thumbnail(size, Image.Resampling.LANCZOS)
+        # 缩小后再按 EXIF 方向旋转；旋转后的副本中 EXIF 的方向标记已被移除
+        image = ImageOps.exif_transpose(img)
+    exif = None if IMAGE_STRIP_EXIF else image.info.get("exif")
+
+    transparent = image.mode in ("RGBA", "LA", "PA") or (image.mode == "P" and "transparency" in image.info)
+    fmt = IMAGE_FORMAT if IMAGE_FORMAT in _FORMATS else ("png" if transparent else "jpeg")
+    if fmt == "jpeg" and image.mode not in ("RGB", "L"):
+        image = image.convert("RGB")
+    elif fmt != "jpeg" and image.mode not in ("RGB", "RGBA", "L", "LA") + (("P",) if fmt == "png" else ()):
+        image = image.convert("RGBA" if transparent else "RGB")
+    pil_format, mime_type = _FORMATS[fmt]
+
+    out = io.BytesIO()
+    options = {"quality": IMAGE_QUALITY} if fmt != "png" else {"optimize": False}
+    if exif:
+        options["exif"] = exif
+    image.save(out, format=pil_format, **options)
+    result = out.getvalue()
+    if len(result) >= len(data) and not (oversized or strip_exif):
+        return _UNCHANGED
+    return result, mime_type
+
+
+def preprocess(data, mime_type):
+    """处理一张图片，返回 (图片字节, MIME 类型, 节省的字节数)；处理失败时返回原图"""
+    if not IMAGE_PREPROCESS or not _pillow():
+        return data, mime_type, 0
+    key = hashlib.sha256(data).hexdigest()
+    entry = processed_cache.get(key)
+    if entry is None:
+        try:
+            with metrics.phase("image_preprocess"):
+                entry = _reencode(data)
+        except Exception as e:
+            # 无法解码的格式(如 HEIC)或损坏的图片原样上传，由上游决定是否接受
+            processed_cache.incr("errors")
+            print(f"警告: 图片预处理失败，使用原图 - {str(e)}")
+            entry = _UNCHANGED
+        processed_cache.set(key, entry, size=len(entry[0]) if entry else 0)
+        processed_cache.incr("processed" if entry else "unchanged")
+    result, result_type = entry or (data, mime_type)
+    saved = len(data) - len(result)
+    processed_cache.incr("bytes_saved", saved)
+    metrics.IMAGE_BYTES.labels("original").inc(len(data))
+    metrics.IMAGE_BYTES.labels("sent").inc(len(result))
+    return result, result_type, saved
+
+
+def preprocess_all(images):
+    """并发处理多张图片: {键: (图片字节, MIME 类型)} -> {键: (图片字节, MIME 类型, 节省的字节数)}"""
+    if len(images) <= 1 or not IMAGE_PREPROCESS:
+        return {key: preprocess(data, mime_type) for key, (data, mime_type) in images.items()}
+    # 在请求的上下文中执行，处理耗时记入请求的 trace
+    futures = {key: _executor.submit(contextvars.copy_context().run, preprocess, data, mime_type)
+               for key, (data, mime_type) in images.items()}
+    return {key: future.result() for key, future in futures.items()}
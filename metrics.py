@@ -0,0 +1,162 @@
+"""
+Prometheus 指标
+
+多进程(Gunicorn)部署时，start.py 会设置 PROMETHEUS_MULTIPROC_DIR，各工作进程把指标写入该目录，
+/metrics 接口读取目录中所有进程的数据并汇总，因此无论请求落到哪个工作进程，看到的都是全局数据。
+
+阶段耗时 (llm_proxy_phase_seconds{phase=...}):
+- sdk_init:    导入 google-genai SDK (每个进程一次，见 startup.py)
+- parse:       读取并解析请求体
+- admission:   准入控制(包括限流排队时间)
+- convert:     OpenAI 消息转换为 Vertex AI Content (包含历史压缩和 image_fetch)
+- image_fetch: 下载远程图片
+- image_preprocess: 缩小、重新编码单张内联图片 (见 image_preprocess.py，缓存命中时不计)
+- model:       获取后端的 genai Client (见 upstream.py)
+- upstream:    非流式请求的上游调用
+- stream:      流式请求从开始到结束的总时长
+- embed:       非流式 embedding 请求等待结果(包括批处理窗口和上游调用)
+
+各阶段耗时、首 token 时间和 token 数同时记录到当前请求的 trace 中(见 tracing.py)。
+"""
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+from prometheus_client import (
+    CONTENT_TYPE_LATEST,
+    CollectorRegistry,
+    Counter,
+    Gauge,
+    Histogram,
+    REGISTRY,
+    generate_latest,
+)
+from prometheus_client import multiprocess
+
+import tracing
+from cache import all_stats
+
+_LATENCY_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600)
+_GAP_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+PHASE_SECONDS = Histogram(
+    "llm_proxy_phase_seconds", "各处理阶段耗时", ["phase"], buckets=_LATENCY_BUCKETS)
+TTFT_SECONDS = Histogram(
+    "llm_proxy_time_to_first_token_seconds", "流式请求首个 token 的等待时间", ["model"], buckets=_LATENCY_BUCKETS)
+INTER_TOKEN_SECONDS = Histogram(
+    "llm_proxy_inter_token_seconds", "流式响应相邻 chunk 的间隔", ["model"], buckets=_GAP_BUCKETS)
+REQUESTS = Counter(
+    "llm_proxy_requests_total", "请求数", ["model", "stream", "status"])
+UPSTREAM_RESPONSES = Counter(
+    "llm_proxy_upstream_responses_total", "上游调用结果", ["backend", "code"])
+TOKENS = Counter(
+    "llm_proxy_tokens_total", "token 数", ["model", "type"])
+CANCELLED_STREAMS = Counter(
+    "llm_proxy_cancelled_streams_total", "提前结束的流式响应 (client_disconnect: 客户端断开, deadline: 超过生成时限)",
+    ["model", "reason"])
+IMAGE_BYTES = Counter(
+    "llm_proxy_image_bytes_total", "内联图片字节数 (original: 预处理前, sent: 实际上传)", ["type"])
+IN_FLIGHT = Gauge(
+    "llm_proxy_requests_in_flight", "进行中的请求数", multiprocess_mode="livesum")
+CACHE_STATS = Gauge(
+    "llm_proxy_cache", "缓存统计 (条目数、字节数及累计命中/未命中等)", ["cache", "stat"],
+    multiprocess_mode="livesum")
+# 跨进程共享的缓存(见 shared_cache.py)各进程看到的是同一份数据，不能再按进程求和
+SHARED_CACHE_STATS = Gauge(
+    "llm_proxy_shared_cache", "跨进程共享缓存的统计 (所有工作进程合计)", ["cache", "stat"],
+    multiprocess_mode="livemax")
+
+# 缓存统计同步到指标的最小间隔(秒)
+_CACHE_SYNC_INTERVAL = 5
+_last_cache_sync = 0.0
+_sync_lock = threading.Lock()
+
+
+@contextmanager
+def phase(name):
+    """记录一个阶段的耗时"""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        end = time.perf_counter()
+        PHASE_SECONDS.labels(name).observe(end - start)
+        tracing.span(name, start, end)
+
+
+def record_usage(model_name, usage):
+    """记录 token 数"""
+    if not usage:
+        return
+    TOKENS.labels(model_name, "prompt").inc(usage.get("prompt_tokens", 0))
+    TOKENS.labels(model_name, "completion").inc(usage.get("completion_tokens", 0))
+    tracing.annotate(prompt_tokens=usage.get("prompt_tokens"), completion_tokens=usage.get("completion_tokens"))
+
+
+def record_cancelled(model_name, reason, completion_tokens):
+    """记录提前结束的流式响应，以及结束前已生成的 token 数"""
+    CANCELLED_STREAMS.labels(model_name, reason).inc()
+    TOKENS.labels(model_name, "cancelled").inc(completion_tokens)
+    tracing.annotate(cancelled=reason, completion_tokens=completion_tokens)
+
+
+class StreamTimer:
+    """记录流式响应的首 token 时间、chunk 间隔和总时长"""
+
+    def __init__(self, model_name):
+        self.model_name = model_name
+        self.start = time.perf_counter()
+        self.last = None
+        self.chunks = 0
+        # 流式响应的生成器可能在另一个上下文中结束，这里先取得请求的 trace
+        self.trace = tracing.current()
+
+    def chunk(self):
+        now = time.perf_counter()
+        self.chunks += 1
+        if self.last is None:
+            TTFT_SECONDS.labels(self.model_name).observe(now - self.start)
+            if self.trace is not None:
+                self.trace.span("ttft", self.start, now)
+        else:
+            INTER_TOKEN_SECONDS.labels(self.model_name).observe(now - self.last)
+        self.last = now
+
+    def finish(self):
+        end = time.perf_counter()
+        PHASE_SECONDS.labels("stream").observe(end - self.start)
+        if self.trace is not None:
+            self.trace.span("stream", self.start, end, chunks=self.chunks)
+
+
+def sync_cache_stats(force=False):
+    """把本进程的缓存统计同步到指标(限频)"""
+    global _last_cache_sync
+    now = time.monotonic()
+    with _sync_lock:
+        if not force and now - _last_cache_sync < _CACHE_SYNC_INTERVAL:
+            return
+        _last_cache_sync = now
+    for name, stats in all_stats().items():
+        gauge = SHARED_CACHE_STATS if stats.get("shared") else CACHE_STATS
+        for stat, value in stats.items():
+            if stat != "hit_rate" and isinstance(value, (int, float)) and not isinstance(value, bool):
+                gauge.labels(name, stat).set(value)
+
+
+def render():
+    """生成 /metrics 的响应内容，返回 (内容, Content-Type)"""
+    sync_cache_stats(force=True)
+    if os.getenv("PROMETHEUS_MULTIPROC_DIR"):
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+    else:
+        registry = REGISTRY
+    return generate_latest(registry), CONTENT_TYPE_LATEST
+
+
+def mark_process_dead(pid):
+    """工作进程退出时清理其 live* 类型的指标，由 gunicorn.conf.py 调用"""
+    if os.getenv("PROMETHEUS_MULTIPROC_DIR"):
+        multiprocess.mark_process_dead(pid)
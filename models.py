@@ -0,0 +1,117 @@
+"""
+模型注册表
+
+- 把客户端请求中的 model 字段(OpenAI 风格的模型名或别名)映射到实际调用的 Gemini 模型
+- 注册表中的模型可以配置路由规则: 不含图片且 prompt 较短的请求改用更便宜、更快的模型
+- 未注册的 gemini-* 模型名直接透传；其他未知模型名使用 DEFAULT_MODEL (MODEL_STRICT=True 时返回 404)
+- thinking_budget 记录在注册表中，调用上游时作为 thinking_config 传递
+
+MODEL_REGISTRY (JSON) 可以新增或覆盖注册表条目:
+    {"fast": {"model": "gemini-2.5-flash", "thinking_budget": 0},
+     "auto": {"model": "gemini-2.5-pro", "route": {"max_prompt_tokens": 2000, "model": "gemini-2.5-flash"}}}
+MODEL_ALIASES (JSON) 可以新增或覆盖别名: {"gpt-4o": "gemini-2.5-pro"}
+"""
+import json
+import os
+import time
+
+from tokens import estimate_prompt_tokens
+
+# 短 prompt 路由的默认阈值(估算的 token 数)
+ROUTE_SHORT_PROMPT_TOKENS = int(os.getenv("ROUTE_SHORT_PROMPT_TOKENS", 1000))
+
+# 模型名 -> {"model": 上游模型, "thinking_budget": 思考预算, "route": 路由规则}
+REGISTRY = {
+    "gemini-2.5-pro": {"model": "gemini-2.5-pro"},
+    "gemini-2.5-flash": {"model": "gemini-2.5-flash"},
+    "gemini-2.5-flash-lite": {"model": "gemini-2.5-flash-lite"},
+    # 短 prompt 使用 flash，其余使用 pro
+    "auto": {
+        "model": "gemini-2.5-pro",
+        "route": {"max_prompt_tokens": ROUTE_SHORT_PROMPT_TOKENS, "model": "gemini-2.5-flash"},
+    },
+}
+REGISTRY.update(json.loads(os.getenv("MODEL_REGISTRY", "{}")))
+
+# OpenAI 模型名 -> 注册表中的模型名
+ALIASES = {
+    "gpt-4o": "gemini-2.5-pro",
+    "gpt-4.1": "gemini-2.5-pro",
+    "gpt-4-turbo": "gemini-2.5-pro",
+    "gpt-4": "gemini-2.5-pro",
+    "gpt-4o-mini": "gemini-2.5-flash",
+    "gpt-4.1-mini": "gemini-2.5-flash",
+    "gpt-3.5-turbo": "gemini-2.5-flash",
+    "gpt-4.1-nano": "gemini-2.5-flash-lite",
+}
+ALIASES.update(json.loads(os.getenv("MODEL_ALIASES", "{}")))
+
+# 请求未指定模型或模型名未知时使用的模型
+DEFAULT_MODEL = os.getenv("DEFAULT_MODEL", "gemini-2.5-pro")
+MODEL_STRICT = os.getenv("MODEL_STRICT", "False").lower() == "true"
+
+# /v1/models 中的 created 字段
+_CREATED = int(time.time())
+
+
+class ModelNotFound(Exception):
+    """请求的模型不存在"""
+
+    code = 404
+
+
+def _has_images(messages):
+    for msg in messages:
+        content = msg.get("content")
+        if isinstance(content, list) and any(
+                isinstance(item, dict) and item.get("type") == "image_url" for item in content):
+            return True
+    return False
+
+
+def _lookup(name):
+    """按模型名或别名查找注册表条目"""
+    name = ALIASES.get(name, name)
+    entry = REGISTRY.get(name)
+    if entry is None and name.startswith("gemini-"):
+        entry = {"model": name}
+    return entry
+
+
+def resolve(data):
+    """根据请求选择上游模型，返回 {"model": 上游模型名, "thinking_budget": 思考预算或 None}"""
+    requested = data.get("model") or DEFAULT_MODEL
+    entry = _lookup(requested)
+    if entry is None:
+        if MODEL_STRICT:
+            raise ModelNotFound(f"模型 '{requested}' 不存在")
+        entry = _lookup(DEFAULT_MODEL) or {"model": DEFAULT_MODEL}
+
+    route = entry.get("route")
+    if route:
+        messages = data.get("messages", [])
+        max_tokens = route.get("max_prompt_tokens", ROUTE_SHORT_PROMPT_TOKENS)
+        if not _has_images(messages) and estimate_prompt_tokens(data) <= max_tokens:
+            entry = _lookup(route["model"]) or {"model": route["model"]}
+
+    return {"model": entry["model"], "thinking_budget": entry.get("thinking_budget")}
+
+
+def _model_card(name):
+    return {"id": name, "object": "model", "created": _CREATED, "owned_by": "google"}
+
+
+def list_models():
+    """/v1/models 的响应内容"""
+    names = list(REGISTRY) + [alias for alias in ALIASES if alias not in REGISTRY]
+    return {
+        "object": "list",
+        "data": [_model_card(name) for name in names],
+    }
+
+
+def get_model_info(name):
+    """/v1/models/{model} 的响应内容"""
+    if name not in REGISTRY and name not in ALIASES:
+        raise ModelNotFound(f"模型 '{name}' 不存在")
+    return _model_card(name)
@@ -0,0 +1,231 @@
+"""
+流式请求体解析 - 用于包含大量内联图片的大请求
+
+request.get_json() 会把整个请求体读入内存并解析成字符串，每张 base64 图片
+都会以 JSON 原文、Python 字符串、解码结果三份形式同时存在。这里按块读取请求体：
+- 普通 JSON 内容原样复制到一个很小的"骨架"中，最后用 json.loads 解析
+- image_url.url 的值为 data:image/...;base64, 时在读取过程中直接增量解码到临时缓冲区(超过阈值时落盘)，
+  骨架中只保留一个占位符，请求原文不会被完整保存；其他位置(如消息文本、工具参数)的 Data URI 原样保留
+"""
+import binascii
+import hashlib
+import json
+import os
+import re
+import tempfile
+import uuid
+
+from data_uri import get_decoded, store_decoded
+
+# 单个图片解码缓冲区超过该大小后写入磁盘临时文件
+SPOOL_MAX_BYTES = int(os.getenv("REQUEST_SPOOL_MAX_BYTES", 8 * 1024 * 1024))
+# 判断字符串是否为 base64 Data URI 时最多查看的前缀长度
+_MAX_HEADER_BYTES = 256
+
+_OUTSIDE, _PREFIX, _PLAIN, _BLOB = range(4)
+_SPECIAL = re.compile(rb'["\\]')
+_STRUCTURE = re.compile(rb'[{}\[\]:,]')
+
+
+class _BlobWriter:
+    """增量解码一个 base64 字符串"""
+
+    def __init__(self, mime_type):
+        self.mime_type = mime_type
+        self._hasher = hashlib.sha256()
+        self._pending = bytearray()
+        self._spool = tempfile.SpooledTemporaryFile(max_size=SPOOL_MAX_BYTES)
+
+    def write(self, segment):
+        segment = segment.translate(None, b" \t\r\n")
+        if not segment:
+            return
+        self._hasher.update(segment)
+        self._pending += segment
+        aligned = len(self._pending) // 4 * 4
+        if aligned:
+            self._spool.write(binascii.a2b_base64(self._pending[:aligned]))
+            del self._pending[:aligned]
+
+    def finish(self):
+        """结束解码，返回 (图片字节, MIME 类型)，相同内容优先复用解码缓存"""
+        key = self._hasher.hexdigest()
+        data = get_decoded(key)
+        if data is None:
+            if self._pending:
+                self._spool.write(binascii.a2b_base64(self._pending))
+            self._spool.seek(0)
+            data = self._spool.read()
+            store_decoded(key, data)
+        self._spool.close()
+        return data, self.mime_type
+
+
+class StreamingRequestParser:
+    """增量解析 JSON 请求体，把 image_url.url 中的 base64 图片替换为已解码的数据块
+
+    用法: 多次调用 feed(chunk)，最后调用 finish() 得到 (data, blobs)，
+    其中 data 中的图片 URL 为占位符，blobs 为 {占位符: (图片字节, MIME 类型)}。
+    """
+
+    def __init__(self):
+        self._skeleton = bytearray()
+        self._state = _OUTSIDE
+        self._escape = False
+        self._prefix = bytearray()
+        self._blob = None
+        self._nonce = uuid.uuid4().hex
+        self._blobs = {}
+        # 容器栈 [(类型 b"{" 或 b"[", 该容器在上一层对象中的键)]，用于判断字符串是否为 image_url.url 的值
+        self._stack = []
+        # 当前对象中最近读到的键，以及下一个字符串是否为键
+        self._key = None
+        self._expect_key = False
+        # 当前字符串是否为键，以及它在骨架中的起始位置
+        self._is_key = False
+        self._string_start = 0
+
+    def feed(self, chunk):
+        """读取一块请求体"""
+        pos = 0
+        end = len(chunk)
+        while pos < end:
+            if self._escape:
+                # 上一块以反斜杠结尾，当前字节属于转义序列
+                self._handle_escape(chunk[pos:pos + 1])
+                pos += 1
+                continue
+
+            if self._state == _OUTSIDE:
+                idx = chunk.find(b'"', pos)
+                if idx < 0:
+                    self._track_structure(chunk, pos, end)
+                    self._skeleton += chunk[pos:]
+                    return
+                self._track_structure(chunk, pos, idx)
+                self._skeleton += chunk[pos:idx + 1]
+                self._open_string()
+                pos = idx + 1
+                continue
+
+            match = _SPECIAL.search(chunk, pos)
+            idx = match.start() if match else end
+            if self._state == _PREFIX:
+                # 只取到足够判断的前缀长度
+                idx = min(idx, pos + _MAX_HEADER_BYTES - len(self._prefix))
+            segment = chunk[pos:idx]
+
+            if self._state == _PLAIN:
+                self._skeleton += segment
+            elif self._state == _BLOB:
+                self._blob.write(segment)
+            else:
+                self._prefix += segment
+                self._check_prefix()
+
+            pos = idx
+            if pos >= end or not match or match.start() != idx:
+                continue
+            if chunk[pos:pos + 1] == b'"':
+                self._close_string()
+            else:
+                self._escape = True
+            pos += 1
+
+    def _track_structure(self, chunk, start, end):
+        """跟踪字符串之外的 JSON 结构: 对象/数组的嵌套以及键值位置"""
+        for match in _STRUCTURE.finditer(chunk, start, end):
+            char = match.group()
+            if char in b"{[":
+                in_object = bool(self._stack) and self._stack[-1][0] == b"{"
+                self._stack.append((char, self._key if in_object else None))
+                self._key = None
+                self._expect_key = char == b"{"
+            elif char in b"}]":
+                if self._stack:
+                    self._stack.pop()
+                self._key = None
+                self._expect_key = False
+            elif char == b":":
+                self._expect_key = False
+            elif self._stack and self._stack[-1][0] == b"{":
+                self._expect_key = True
+
+    def _open_string(self):
+        """字符串开始: 只有 image_url 对象中 url 的值才可能是需要解码的图片"""
+        in_object = bool(self._stack) and self._stack[-1][0] == b"{"
+        self._is_key = in_object and self._expect_key
+        self._string_start = len(self._skeleton)
+        self._prefix = bytearray()
+        if not self._is_key and in_object and self._key == "url" and self._stack[-1][1] == "image_url":
+            self._state = _PREFIX
+        else:
+            self._state = _PLAIN
+
+    def _check_prefix(self):
+        """根据字符串前缀决定按普通字符串还是 base64 数据处理"""
+        prefix = bytes(self._prefix)
+        if not b"data:".startswith(prefix[:5]):
+            self._to_plain()
+            return
+        comma = prefix.find(b",")
+        if comma >= 0:
+            header = prefix[:comma]
+            if header.startswith(b"data:image/") and header.endswith(b";base64"):
+                mime_type = header[5:].split(b";")[0].decode("ascii", "replace")
+                self._blob = _BlobWriter(mime_type)
+                self._state = _BLOB
+                self._blob.write(prefix[comma + 1:])
+                self._prefix = bytearray()
+            else:
+                self._to_plain()
+        elif len(prefix) >= _MAX_HEADER_BYTES:
+            self._to_plain()
+
+    def _to_plain(self):
+        self._skeleton += self._prefix
+        self._prefix = bytearray()
+        self._state = _PLAIN
+
+    def _handle_escape(self, byte):
+        """处理字符串中的转义序列"""
+        self._escape = False
+        if self._state == _BLOB:
+            # base64 中只可能出现被转义的 "/"，以及应被忽略的换行等空白
+            if byte == b"/":
+                self._blob.write(b"/")
+            elif byte not in (b"n", b"r", b"t"):
+                raise ValueError("base64 Data URI 中包含无效的转义字符")
+            return
+        if self._state == _PREFIX:
+            if byte == b"/":
+                # 部分客户端会把 "data:image/png" 转义成 "data:image\/png"
+                self._prefix += b"/"
+                self._check_prefix()
+                return
+            self._to_plain()
+        self._skeleton += b"\\" + byte
+
+    def _close_string(self):
+        """字符串结束"""
+        if self._state == _BLOB:
+            placeholder = f"blob:{self._nonce}:{len(self._blobs)}"
+            self._blobs["\x00" + placeholder] = self._blob.finish()
+            self._blob = None
+            self._skeleton += b"\\u0000" + placeholder.encode("ascii")
+        elif self._state == _PREFIX:
+            self._skeleton += self._prefix
+            self._prefix = bytearray()
+        if self._is_key:
+            self._key = json.loads(b'"' + bytes(self._skeleton[self._string_start:]) + b'"')
+            self._expect_key = False
+        self._skeleton += b'"'
+        self._state = _OUTSIDE
+
+    def finish(self):
+        """结束解析，返回 (data, blobs)"""
+        if self._state != _OUTSIDE or self._escape:
+            raise ValueError("请求体不是完整的 JSON")
+        data = json.loads(bytes(self._skeleton))
+        self._skeleton = bytearray()
+        return data, self._blobs
@@ -0,0 +1,138 @@
+"""
+确定性请求(temperature=0)的响应缓存
+
+缓存键为模型、system_instruction、消息(图片按内容摘要)和生成配置的规范化摘要。
+缓存内容来自非流式响应；相同请求再次到来时直接返回，若请求 stream: true 则以 SSE 形式回放。
+
+后端可选:
+- memory: 进程内 LRU，按条目数限制容量并支持 TTL
+- redis:  任意 Redis 协议兼容的服务(本地 redis-server、KeyDB 等)，需要安装 redis 包
+"""
+import hashlib
+import json
+import os
+
+from cache import create_cache, digest
+
+RESPONSE_CACHE_ENABLED = os.getenv("RESPONSE_CACHE_ENABLED", "False").lower() == "true"
+RESPONSE_CACHE_BACKEND = os.getenv("RESPONSE_CACHE_BACKEND", "memory").lower()
+RESPONSE_CACHE_TTL = int(os.getenv("RESPONSE_CACHE_TTL", 3600))
+RESPONSE_CACHE_SIZE = int(os.getenv("RESPONSE_CACHE_SIZE", 1024))
+RESPONSE_CACHE_URL = os.getenv("RESPONSE_CACHE_URL", "redis://localhost:6379/0")
+
+# 参与缓存键计算的生成参数
+_KEY_PARAMS = ("temperature", "top_p", "max_output_tokens", "max_tokens", "stop", "seed", "safety_settings")
+
+
+class MemoryBackend:
+    """进程内缓存后端"""
+
+    def __init__(self, max_entries):
+        self._cache = create_cache("responses", max_entries=max_entries)
+
+    def get(self, key):
+        return self._cache.get(key)
+
+    def set(self, key, value, ttl):
+        self._cache.set(key, value, ttl=ttl)
+
+    def stats(self):
+        return self._cache.stats()
+
+
+class RedisBackend:
+    """Redis 协议兼容的缓存后端"""
+
+    def __init__(self, url):
+        try:
+            import redis
+        except ImportError:
+            raise RuntimeError("RESPONSE_CACHE_BACKEND=redis 需要安装 redis 包: pip install redis")
+        self._client = redis.Redis.from_url(url)
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        raw = self._client.get(f"llm-proxy:response:{key}")
+        if raw is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        return json.loads(raw)
+
+    def set(self, key, value, ttl):
+        self._client.set(f"llm-proxy:response:{key}", json.dumps(value, ensure_ascii=False), ex=ttl)
+
+    def stats(self):
+        return {"hits": self.hits, "misses": self.misses}
+
+
+def create_backend():
+    """根据配置创建缓存后端"""
+    if RESPONSE_CACHE_BACKEND == "redis":
+        return RedisBackend(RESPONSE_CACHE_URL)
+    return MemoryBackend(RESPONSE_CACHE_SIZE)
+
+
+_backend = create_backend() if RESPONSE_CACHE_ENABLED else None
+
+
+def is_cacheable(data):
+    """只缓存显式指定 temperature=0 的请求"""
+    return _backend is not None and data.get("temperature") == 0
+
+
+def part_key(part):
+    """单个 Part 的规范化表示，图片使用内容摘要"""
+    if part.inline_data:
+        return {"mime_type": part.inline_data.mime_type,
+                "sha256": hashlib.sha256(part.inline_data.data).hexdigest()}
+    if part.file_data:
+        return {"mime_type": part.file_data.mime_type, "uri": part.file_data.file_uri}
+    return {"text": part.text if hasattr(part, "text") else str(part)}
+
+
+def cache_key(chat_req, data):
+    """计算请求的缓存键"""
+    return digest({
+        "model": chat_req["model_name"],
+        "thinking_budget": chat_req.get("thinking_budget"),
+        "system_instruction": chat_req["system_instruction"],
+        "contents": [
+            {"role": content.role, "parts": [part_key(part) for part in content.parts]}
+            for content in chat_req["contents"]
+        ],
+        "params": {name: data.get(name) for name in _KEY_PARAMS if name in data},
+    })
+
+
+def get(key):
+    """读取缓存的响应 {"content": ..., "usage": ...}"""
+    if _backend is None or key is None:
+        return None
+    try:
+        return _backend.get(key)
+    except Exception as e:
+        print(f"警告: 读取响应缓存失败 - {str(e)}")
+        return None
+
+
+def put(key, response_data):
+    """缓存非流式响应"""
+    if _backend is None or key is None:
+        return
+    choice = response_data["choices"][0]
+    if choice.get("finish_reason") != "stop":
+        return
+    try:
+        _backend.set(key, {"content": choice["message"]["content"], "usage": response_data["usage"]},
+                     RESPONSE_CACHE_TTL)
+    except Exception as e:
+        print(f"警告: 写入响应缓存失败 - {str(e)}")
+
+
+def stats():
+    """返回响应缓存统计信息"""
+    if _backend is None:
+        return {"enabled": False}
+    return {"enabled": True, "backend": RESPONSE_CACHE_BACKEND, **_backend.stats()}
@@ -0,0 +1,320 @@
+"""
+上游调用的重试、对冲(hedging)与退避
+
+- 按错误类别(限流/不可用/内部错误)分别配置重试次数和退避时间
+- 带随机抖动的指数退避，上游返回 Retry-After / RetryInfo 时按其等待
+- 非流式请求可选对冲: 首个请求耗时超过近期延迟的指定分位数时，再并发发起一个相同请求，取先返回的结果
+- 所有等待都受请求的总截止时间约束
+- 流式请求只重试首个 chunk 返回之前的错误，已经开始输出后不再重试
+"""
+import asyncio
+import contextvars
+import json
+import os
+import random
+import sys
+import threading
+import time
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+import httpx
+from google.api_core import exceptions as api_exceptions
+
+import tracing
+
+RETRY_ENABLED = os.getenv("RETRY_ENABLED", "True").lower() == "true"
+RETRY_MAX_DELAY = float(os.getenv("RETRY_MAX_DELAY", 8))
+# 未指定时请求的总截止时间(秒)，流式响应的生成时间也受此限制
+UPSTREAM_DEADLINE = float(os.getenv("UPSTREAM_DEADLINE", 600))
+
+HEDGE_ENABLED = os.getenv("HEDGE_ENABLED", "False").lower() == "true"
+HEDGE_PERCENTILE = float(os.getenv("HEDGE_PERCENTILE", 0.95))
+# 延迟样本不足时使用的对冲等待时间(秒)
+HEDGE_MIN_DELAY = float(os.getenv("HEDGE_MIN_DELAY", 5))
+HEDGE_MIN_SAMPLES = 20
+
+# 错误类别 -> 重试策略，可通过 RETRY_POLICIES 环境变量(JSON)覆盖
+RETRY_POLICIES = {
+    "rate_limited": {"max_attempts": 4, "base_delay": 1.0},
+    "unavailable": {"max_attempts": 3, "base_delay": 0.5},
+    "internal": {"max_attempts": 2, "base_delay": 0.5},
+}
+for _name, _policy in json.loads(os.getenv("RETRY_POLICIES", "{}")).items():
+    RETRY_POLICIES.setdefault(_name, {}).update(_policy)
+
+_ERROR_CLASSES = [
+    (api_exceptions.TooManyRequests, "rate_limited"),
+    (api_exceptions.ResourceExhausted, "rate_limited"),
+    (api_exceptions.ServiceUnavailable, "unavailable"),
+    (api_exceptions.GatewayTimeout, "unavailable"),
+    (api_exceptions.DeadlineExceeded, "unavailable"),
+    (api_exceptions.InternalServerError, "internal"),
+    (api_exceptions.Aborted, "internal"),
+    # 连接被重置、超时等网络错误
+    (httpx.TransportError, "unavailable"),
+]
+# google-genai 的 APIError 按 HTTP 状态码分类
+_ERROR_CODES = {429: "rate_limited", 503: "unavailable", 504: "unavailable", 500: "internal"}
+
+_lock = threading.Lock()
+_counters = {
+    "calls": 0,
+    "retries": 0,
+    "hedges": 0,
+    "hedge_wins": 0,
+    "exhausted": 0,
+    "deadline_exceeded": 0,
+}
+_latencies = deque(maxlen=200)
+_hedge_executor = ThreadPoolExecutor(max_workers=int(os.getenv("HEDGE_MAX_WORKERS", 32)),
+                                     thread_name_prefix="hedge")
+
+
+def _incr(name, amount=1):
+    with _lock:
+        _counters[name] = _counters.get(name, 0) + amount
+
+
+def stats():
+    """返回重试相关的统计信息"""
+    with _lock:
+        return {**_counters, "hedge_delay": round(hedge_delay(), 3)}
+
+
+def classify_error(exc):
+    """返回错误类别，不可重试的错误返回 None"""
+    for exc_type, name in _ERROR_CLASSES:
+        if isinstance(exc, exc_type):
+            return name
+    # 只有导入过 google-genai 才可能出现它的错误，这里不主动导入
+    genai_errors = sys.modules.get("google.genai.errors")
+    if genai_errors is not None and isinstance(exc, genai_errors.APIError):
+        return _ERROR_CODES.get(exc.code)
+    return None
+
+
+def error_status(exc):
+    """返回应回给客户端的 HTTP 状态码"""
+    code = getattr(exc, "code", None)
+    if isinstance(code, int) and 400 <= code < 600:
+        return code
+    return 500
+
+
+def deadline_from_headers(headers):
+    """根据客户端请求头 X-Request-Timeout(秒) 计算截止时间"""
+    timeout = UPSTREAM_DEADLINE
+    value = headers.get("X-Request-Timeout")
+    if value:
+        try:
+            timeout = min(float(value), UPSTREAM_DEADLINE)
+        except ValueError:
+            pass
+    return time.monotonic() + timeout
+
+
+def _retry_after(exc):
+    """从错误中读取上游建议的等待时间(秒)"""
+    response = getattr(exc, "response", None)
+    headers = getattr(response, "headers", None)
+    if headers and headers.get("Retry-After"):
+        try:
+            return float(headers.get("Retry-After"))
+        except ValueError:
+            pass
+    details = getattr(exc, "details", None) or []
+    if isinstance(details, dict):
+        # google-genai: REST 错误响应体，RetryInfo 的 retryDelay 形如 "3.5s"
+        details = (details.get("error") or {}).get("details") or []
+    for detail in details:
+        if isinstance(detail, dict):
+            if str(detail.get("retryDelay", "")).endswith("s"):
+                try:
+                    return float(detail["retryDelay"][:-1])
+                except ValueError:
+                    pass
+            continue
+        retry_delay = getattr(detail, "retry_delay", None)
+        if retry_delay is not None:
+            return retry_delay.seconds + retry_delay.nanos / 1e9
+    return None
+
+
+def _next_delay(exc, attempt, deadline):
+    """计算下一次重试前的等待时间，不应重试时返回 None"""
+    if not RETRY_ENABLED:
+        return None
+    error_class = classify_error(exc)
+    if error_class is None:
+        return None
+    policy = RETRY_POLICIES[error_class]
+    if attempt + 1 >= policy.get("max_attempts", 1):
+        _incr("exhausted")
+        return None
+
+    # full jitter 指数退避
+    delay = random.uniform(0, min(RETRY_MAX_DELAY, policy.get("base_delay", 0.5) * 2 ** attempt))
+    retry_after = _retry_after(exc)
+    if retry_after is not None:
+        delay = max(delay, retry_after)
+    if time.monotonic() + delay >= deadline:
+        _incr("deadline_exceeded")
+        return None
+    _incr("retries")
+    _incr(f"retries_{error_class}")
+    tracing.event("retry", attempt=attempt + 1, error_class=error_class, error=str(exc), delay=round(delay, 3))
+    return delay
+
+
+def hedge_delay():
+    """对冲等待时间: 近期非流式请求延迟的指定分位数"""
+    if len(_latencies) < HEDGE_MIN_SAMPLES:
+        return HEDGE_MIN_DELAY
+    samples = sorted(_latencies)
+    return samples[min(len(samples) - 1, int(len(samples) * HEDGE_PERCENTILE))]
+
+
+def _hedged_call(fn, deadline):
+    """执行调用，超过对冲等待时间仍未返回时并发发起第二个请求"""
+    # 在调用线程的上下文中执行，上游调用记入请求的 trace
+    first = _hedge_executor.submit(contextvars.copy_context().run, fn)
+    done, _ = wait([first], timeout=min(hedge_delay(), max(0, deadline - time.monotonic())))
+    if done:
+        return first.result()
+
+    _incr("hedges")
+    tracing.event("hedge")
+    second = _hedge_executor.submit(contextvars.copy_context().run, fn)
+    pending = {first, second}
+    error = None
+    while pending:
+        done, pending = wait(pending, timeout=max(0, deadline - time.monotonic()), return_when=FIRST_COMPLETED)
+        if not done:
+            break
+        for future in done:
+            if future.exception() is None:
+                if future is second:
+                    _incr("hedge_wins")
+                return future.result()
+            error = error or future.exception()
+    if error is not None:
+        raise error
+    raise api_exceptions.DeadlineExceeded("上游请求超过截止时间")
+
+
+def call_with_retry(fn, deadline, hedge=False):
+    """调用 fn()，按错误类别重试；hedge=True 时启用对冲"""
+    _incr("calls")
+    attempt = 0
+    while True:
+        start = time.monotonic()
+        try:
+            if hedge and HEDGE_ENABLED:
+                result = _hedged_call(fn, deadline)
+            else:
+                result = fn()
+            if hedge:
+                # 只记录非流式请求的延迟，用于计算对冲等待时间
+                _latencies.append(time.monotonic() - start)
+            return result
+        except Exception as e:
+            delay = _next_delay(e, attempt, deadline)
+            if delay is None:
+                raise
+            time.sleep(delay)
+            attempt += 1
+
+
+def stream_with_retry(fn, deadline):
+    """调用 fn() 得到流式迭代器并预取首个 chunk，首个 chunk 之前的错误会被重试"""
+    def open_stream():
+        stream = iter(fn())
+        try:
+            first = next(stream)
+        except StopIteration:
+            return iter(())
+        return _prepend(first, stream)
+
+    return call_with_retry(open_stream, deadline)
+
+
+def _prepend(first, stream):
+    yield first
+    yield from stream
+
+
+async def _hedged_call_async(fn, deadline):
+    """对冲调用的异步版本，先返回的请求胜出，另一个请求会被取消"""
+    first = asyncio.ensure_future(fn())
+    done, _ = await asyncio.wait([first], timeout=min(hedge_delay(), max(0, deadline - time.monotonic())))
+    if done:
+        return first.result()
+
+    _incr("hedges")
+    tracing.event("hedge")
+    second = asyncio.ensure_future(fn())
+    pending = {first, second}
+    error = None
+    try:
+        while pending:
+            done, pending = await asyncio.wait(pending, timeout=max(0, deadline - time.monotonic()),
+                                               return_when=asyncio.FIRST_COMPLETED)
+            if not done:
+                break
+            for task in done:
+                if task.exception() is None:
+                    if task is second:
+                        _incr("hedge_wins")
+                    return task.result()
+                error = error or task.exception()
+    finally:
+        for task in pending:
+            task.cancel()
+    if error is not None:
+        raise error
+    raise api_exceptions.DeadlineExceeded("上游请求超过截止时间")
+
+
+async def call_with_retry_async(fn, deadline, hedge=False):
+    """call_with_retry 的异步版本，fn 为返回协程的函数"""
+    _incr("calls")
+    attempt = 0
+    while True:
+        start = time.monotonic()
+        try:
+            if hedge and HEDGE_ENABLED:
+                result = await _hedged_call_async(fn, deadline)
+            else:
+                result = await fn()
+            if hedge:
+                # 只记录非流式请求的延迟，用于计算对冲等待时间
+                _latencies.append(time.monotonic() - start)
+            return result
+        except Exception as e:
+            delay = _next_delay(e, attempt, deadline)
+            if delay is None:
+                raise
+            await asyncio.sleep(delay)
+            attempt += 1
+
+
+async def stream_with_retry_async(fn, deadline):
+    """stream_with_retry 的异步版本，fn 为返回(可等待的)异步迭代器的函数"""
+    async def open_stream():
+        stream = (await fn()).__aiter__()
+        try:
+            first = await stream.__anext__()
+        except StopAsyncIteration:
+            return _aprepend(None, stream)
+        return _aprepend(first, stream)
+
+    return await call_with_retry_async(open_stream, deadline)
+
+
+async def _aprepend(first, stream):
+    if first is None:
+        return
+    yield first
+    async for item in stream:
+        yield item
@@ -0,0 +1,469 @@
+"""
+跨工作进程共享的缓存 - 基于内存映射文件的环形存储
+
+Gunicorn 启动多个工作进程时，进程内的 LRU 缓存在每个进程中各有一份: 内存占用随进程数成倍增加，
+而同一张图片、同一段文本落到不同进程时还要各自重新计算。SHARED_CACHES 中列出的缓存改为保存在
+SHARED_CACHE_DIR 下的内存映射文件中，同一台机器上的所有工作进程共享，接口与 cache.LRUCache 相同。
+缓存目录只允许当前用户访问(0700)，属主或权限不符时拒绝使用。
+
+每个缓存一个文件:
+- 头部: 参数、写入位置、命中/未命中等统计以及自定义计数器
+- 索引: 开放寻址的哈希表(键的摘要、记录位置、过期时间)，每个键最多探测 _PROBES 个槽位
+- 数据区: 环形写入的记录(键摘要 + 长度 + 序列化的值)。写满后从头覆盖最早的记录，
+  被覆盖的记录在查找时发现位置已失效即视为淘汰；即将被覆盖的记录被命中时重新写入到最新位置，近似 LRU
+- 条目数达到 max_entries 时清理已失效的槽位，仍然超出时淘汰最早写入的条目(一次淘汰 1/8，摊薄扫描索引的开销)
+
+值只支持 None、bool、int、float、str、bytes 以及由它们组成的 list / tuple / dict，用简单的带类型标记的二进制格式
+序列化；读取时不会执行任何代码(不使用 pickle)。
+
+读写在进程内加线程锁、进程间加文件锁(flock)。映射按进程打开，gunicorn --preload 的主进程中打开的映射
+不会被工作进程继承使用；参数与现有文件不一致时重新初始化，重启后已有的缓存内容继续可用。
+文件在创建时预先分配全部空间(默认放在临时目录，设为 /dev/shm 下的目录时直接占用内存)，
+空间不足时 cache.create_cache 打印警告并改用进程内缓存。
+"""
+import fcntl
+import hashlib
+import mmap
+import os
+import stat
+import struct
+import tempfile
+import threading
+import time
+from contextlib import contextmanager
+
+from cache import _registry, digest
+
+# 默认按用户区分目录，避免与其他用户共用(或被其他用户预先创建)
+SHARED_CACHE_DIR = os.getenv("SHARED_CACHE_DIR", os.path.join(tempfile.gettempdir(), f"llm-proxy-cache-{os.getuid()}"))
+# 未设置字节数上限的缓存使用的数据区大小
+SHARED_CACHE_DEFAULT_BYTES = int(os.getenv("SHARED_CACHE_DEFAULT_BYTES", 16 * 1024 * 1024))
+
+_MAGIC = b"LPXCACHE"
+_VERSION = 2
+_HEADER_SIZE = 4096
+# magic, 版本, 槽位数, 数据区大小，之后是下面的计数字段
+_HEADER = struct.Struct("<8sIIQ")
+# 头部计数字段 -> 偏移
+# occupied 为索引中非空的槽位数(包括已失效但尚未清理的)
+_FIELDS = {"write_pos": 24, "hits": 32, "misses": 40, "sets": 48, "evictions": 56, "expirations": 64, "occupied": 72}
+_COUNTERS_OFFSET = 256
+_COUNTER = struct.Struct("<32sq")
+_MAX_COUNTERS = 64
+_RECORD = struct.Struct("<16sI")
+_PROBES = 8
+_SLOT_KEY = 16
+# 单条记录最多占数据区的比例
+_MAX_RECORD_FRACTION = 4
+
+
+_LENGTH = struct.Struct("<I")
+_INT = struct.Struct("<q")
+_FLOAT = struct.Struct("<d")
+_CONSTANTS = {None: b"N", True: b"T", False: b"F"}
+_TAG_CONSTANTS = {b"N": None, b"T": True, b"F": False}
+_SEQUENCES = {list: b"l", tuple: b"t"}
+
+
+def _dump(value, out):
+    """把值追加到 out，只支持 JSON 类基本类型以及 bytes / tuple"""
+    if value is None or value is True or value is False:
+        out += _CONSTANTS[value]
+    elif type(value) is int:
+        if -2 ** 63 <= value < 2 ** 63:
+            out += b"i" + _INT.pack(value)
+        else:
+            text = str(value).encode("ascii")
+            out += b"I" + _LENGTH.pack(len(text)) + text
+    elif type(value) is float:
+        out += b"f" + _FLOAT.pack(value)
+    elif type(value) is str:
+        data = value.encode("utf-8")
+        out += b"s" + _LENGTH.pack(len(data)) + data
+    elif type(value) in (bytes, bytearray):
+        out += b"b" + _LENGTH.pack(len(value)) + value
+    elif type(value) in _SEQUENCES:
+        out += _SEQUENCES[type(value)] + _LENGTH.pack(len(value))
+        for item in value:
+            _dump(item, out)
+    elif type(value) is dict:
+        out += b"d" + _LENGTH.pack(len(value))
+        for key, item in value.items():
+            _dump(key, out)
+            _dump(item, out)
+    else:
+        raise TypeError(f"共享缓存不支持的值类型: {type(value).__name__}")
+
+
+def _load(buf, pos):
+    """从 buf 的 pos 处读取一个值，返回 (值, 下一个位置)"""
+    tag = bytes(buf[pos:pos + 1])
+    pos += 1
+    if tag in _TAG_CONSTANTS:
+        return _TAG_CONSTANTS[tag], pos
+    if tag == b"i":
+        return _INT.unpack_from(buf, pos)[0], pos + _INT.size
+    if tag == b"f":
+        return _FLOAT.unpack_from(buf, pos)[0], pos + _FLOAT.size
+    length = _LENGTH.unpack_from(buf, pos)[0]
+    pos += _LENGTH.size
+    if tag in (b"s", b"b", b"I"):
+        data = bytes(buf[pos:pos + length])
+        if len(data) != length:
+            raise ValueError("共享缓存记录不完整")
+        pos += length
+        if tag == b"b":
+            return data, pos
+        if tag == b"s":
+            return data.decode("utf-8"), pos
+        return int(data), pos
+    if tag in (b"l", b"t"):
+        items = []
+        for _ in range(length):
+            item, pos = _load(buf, pos)
+            items.append(item)
+        return (items if tag == b"l" else tuple(items)), pos
+    if tag == b"d":
+        result = {}
+        for _ in range(length):
+            key, pos = _load(buf, pos)
+            result[key], pos = _load(buf, pos)
+        return result, pos
+    raise ValueError(f"共享缓存记录中的未知类型标记 {tag!r}")
+
+
+def dumps(value):
+    """序列化缓存值"""
+    out = bytearray()
+    _dump(value, out)
+    return bytes(out)
+
+
+def loads(payload):
+    """反序列化缓存值，数据不完整或格式错误时抛出 ValueError"""
+    try:
+        value, pos = _load(memoryview(payload), 0)
+    except (struct.error, RecursionError, UnicodeDecodeError) as e:
+        raise ValueError(f"共享缓存记录格式错误 - {str(e)}") from e
+    if pos != len(payload):
+        raise ValueError("共享缓存记录末尾有多余数据")
+    return value
+
+
+def _private_dir(path):
+    """创建(或检查)只有当前用户可以访问的缓存目录"""
+    os.makedirs(path, mode=0o700, exist_ok=True)
+    info = os.lstat(path)
+    if not stat.S_ISDIR(info.st_mode):
+        raise PermissionError(f"共享缓存目录 {path} 不是目录")
+    if info.st_uid != os.getuid():
+        raise PermissionError(f"共享缓存目录 {path} 的属主不是当前用户")
+    if stat.S_IMODE(info.st_mode) & 0o077:
+        raise PermissionError(f"共享缓存目录 {path} 允许其他用户访问，权限应为 0700")
+
+
+def _hash(key):
+    """键的 16 字节摘要；多数缓存的键本身就是摘要字符串，不再经过 JSON 序列化"""
+    data = key.encode("utf-8") if isinstance(key, str) else digest(key).encode("ascii")
+    return hashlib.blake2b(data, digest_size=16).digest()
+
+
+class SharedCache:
+    """跨进程共享的缓存，接口与 LRUCache 相同；值的类型见模块说明"""
+
+    def __init__(self, name, max_entries=128, max_bytes=None):
+        self.name = name
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.slots = max(64, max_entries * 2)
+        self.data_size = max_bytes or SHARED_CACHE_DEFAULT_BYTES
+        self.path = os.path.join(SHARED_CACHE_DIR, f"{name}.cache")
+        self._keys_offset = _HEADER_SIZE
+        self._offsets_offset = self._keys_offset + self.slots * _SLOT_KEY
+        self._expires_offset = self._offsets_offset + self.slots * 8
+        self._data_offset = self._expires_offset + self.slots * 8
+        self._file_size = self._data_offset + self.data_size
+        self._state = {"pid": None}
+        self._pid_lock = threading.Lock()
+        _registry[name] = self
+
+    # ---- 文件和锁 ----
+
+    def _open(self):
+        """按进程打开并映射缓存文件"""
+        pid = os.getpid()
+        if self._state["pid"] == pid:
+            return self._state
+        with self._pid_lock:
+            if self._state["pid"] != pid:
+                _private_dir(SHARED_CACHE_DIR)
+                fd = os.open(self.path, os.O_RDWR | os.O_CREAT | os.O_NOFOLLOW, 0o600)
+                try:
+                    fcntl.flock(fd, fcntl.LOCK_EX)
+                    try:
+                        self._initialize(fd)
+                    finally:
+                        fcntl.flock(fd, fcntl.LOCK_UN)
+                    buf = mmap.mmap(fd, self._file_size)
+                except BaseException:
+                    os.close(fd)
+                    raise
+                view = memoryview(buf)
+                self._state = {
+                    "pid": pid,
+                    "fd": fd,
+                    "mmap": buf,
+                    "offsets": view[self._offsets_offset:self._expires_offset].cast("Q"),
+                    "expires": view[self._expires_offset:self._data_offset].cast("d"),
+                    "lock": threading.Lock(),
+                }
+        return self._state
+
+    def _initialize(self, fd):
+        """文件不存在或参数不一致时重新初始化(调用方持有文件锁)"""
+        if os.fstat(fd).st_size == self._file_size:
+            header = _HEADER.unpack(os.pread(fd, _HEADER.size, 0))
+            if header == (_MAGIC, _VERSION, self.slots, self.data_size):
+                return
+        os.ftruncate(fd, 0)
+        os.ftruncate(fd, self._file_size)
+        # 预先分配空间，避免映射写入时因磁盘或 /dev/shm 空间不足收到 SIGBUS
+        os.posix_fallocate(fd, 0, self._file_size)
+        os.pwrite(fd, _HEADER.pack(_MAGIC, _VERSION, self.slots, self.data_size), 0)
+
+    @contextmanager
+    def _locked(self):
+        """同时持有进程内线程锁和文件锁"""
+        state = self._open()
+        with state["lock"]:
+            fcntl.flock(state["fd"], fcntl.LOCK_EX)
+            try:
+                yield state
+            finally:
+                fcntl.flock(state["fd"], fcntl.LOCK_UN)
+
+    # ---- 头部字段 ----
+
+    @staticmethod
+    def _field(state, name):
+        return struct.unpack_from("<Q", state["mmap"], _FIELDS[name])[0]
+
+    @staticmethod
+    def _bump(state, name, amount=1):
+        offset = _FIELDS[name]
+        struct.pack_into("<Q", state["mmap"], offset, struct.unpack_from("<Q", state["mmap"], offset)[0] + amount)
+
+    # ---- 索引 ----
+
+    def _probe(self, key_hash):
+        base = int.from_bytes(key_hash[:8], "little") % self.slots
+        return [(base + i) % self.slots for i in range(min(_PROBES, self.slots))]
+
+    def _slot_key(self, state, slot):
+        start = self._keys_offset + slot * _SLOT_KEY
+        return bytes(state["mmap"][start:start + _SLOT_KEY])
+
+    def _live(self, state, slot, write_pos, now):
+        """槽位指向的记录仍然有效时返回记录位置，否则返回 None"""
+        offset = state["offsets"][slot]
+        if not offset:
+            return None
+        position = offset - 1
+        if write_pos - position > self.data_size:
+            return None
+        expires = state["expires"][slot]
+        if expires and expires <= now:
+            return None
+        return position
+
+    def _find(self, state, key_hash):
+        for slot in self._probe(key_hash):
+            if state["offsets"][slot] and self._slot_key(state, slot) == key_hash:
+                return slot
+        return None
+
+    def _read(self, state, position, key_hash):
+        """读取记录，记录已被部分覆盖(键不一致)时返回 None"""
+        start = self._data_offset + position % self.data_size
+        record_key, length = _RECORD.unpack_from(state["mmap"], start)
+        if record_key != key_hash:
+            return None
+        start += _RECORD.size
+        return bytes(state["mmap"][start:start + length])
+
+    def _append(self, state, key_hash, payload):
+        """在数据区末尾写入一条记录，返回记录位置；记录不跨越数据区末尾"""
+        size = _RECORD.size + len(payload)
+        position = self._field(state, "write_pos")
+        if position % self.data_size + size > self.data_size:
+            position += self.data_size - position % self.data_size
+        # 先推进写入位置，使将被覆盖的旧记录立即失效
+        struct.pack_into("<Q", state["mmap"], _FIELDS["write_pos"], position + size)
+        start = self._data_offset + position % self.data_size
+        _RECORD.pack_into(state["mmap"], start, key_hash, len(payload))
+        state["mmap"][start + _RECORD.size:start + size] = payload
+        return position
+
+    # ---- LRUCache 接口 ----
+
+    def get(self, key, default=None):
+        """读取缓存，即将被覆盖的条目命中时重新写入到最新位置"""
+        if self.max_entries <= 0:
+            return default
+        key_hash = _hash(key)
+        with self._locked() as state:
+            slot = self._find(state, key_hash)
+            payload = None
+            if slot is not None:
+                now = time.time()
+                write_pos = self._field(state, "write_pos")
+                position = self._live(state, slot, write_pos, now)
+                if position is None:
+                    expires = state["expires"][slot]
+                    self._bump(state, "expirations" if expires and expires <= now else "evictions")
+                    state["offsets"][slot] = 0
+                    self._bump(state, "occupied", -1)
+                else:
+                    payload = self._read(state, position, key_hash)
+                    if payload is not None and write_pos - position > self.data_size * 3 // 4:
+                        state["offsets"][slot] = self._append(state, key_hash, payload) + 1
+            self._bump(state, "misses" if payload is None else "hits")
+        if payload is None:
+            return default
+        return loads(payload)
+
+    def set(self, key, value, size=0, ttl=None):
+        """写入缓存；size 只用于与 LRUCache 保持接口一致，实际按序列化后的大小计算"""
+        if self.max_entries <= 0:
+            return
+        payload = dumps(value)
+        if _RECORD.size + len(payload) > self.data_size // _MAX_RECORD_FRACTION:
+            return
+        key_hash = _hash(key)
+        with self._locked() as state:
+            now = time.time()
+            write_pos = self._field(state, "write_pos")
+            slot = self._find(state, key_hash)
+            if slot is None:
+                if self._field(state, "occupied") >= self.max_entries:
+                    self._trim(state, write_pos, now)
+                candidates = self._probe(key_hash)
+                slot = next((s for s in candidates if self._live(state, s, write_pos, now) is None), None)
+                if slot is None:
+                    # 探测范围内都是有效条目，淘汰其中最早写入的
+                    slot = min(candidates, key=lambda s: state["offsets"][s])
+                    self._bump(state, "evictions")
+            if not state["offsets"][slot]:
+                self._bump(state, "occupied")
+            start = self._keys_offset + slot * _SLOT_KEY
+            state["mmap"][start:start + _SLOT_KEY] = key_hash
+            state["expires"][slot] = now + ttl if ttl is not None else 0.0
+            state["offsets"][slot] = self._append(state, key_hash, payload) + 1
+            self._bump(state, "sets")
+
+    def _trim(self, state, write_pos, now):
+        """条目数达到 max_entries 时清理已失效的槽位，仍然超出时淘汰最早写入的条目"""
+        offsets = state["offsets"]
+        oldest = write_pos - self.data_size
+        live = []
+        for slot, (offset, expires) in enumerate(zip(offsets.tolist(), state["expires"].tolist())):
+            if not offset:
+                continue
+            if offset - 1 < oldest:
+                self._bump(state, "evictions")
+            elif expires and expires <= now:
+                self._bump(state, "expirations")
+            else:
+                live.append((offset, slot))
+                continue
+            offsets[slot] = 0
+        # 淘汰到上限的 7/8，避免之后每次写入都要扫描索引
+        keep = self.max_entries - max(1, self.max_entries // 8)
+        if len(live) > keep:
+            live.sort()
+            excess = len(live) - keep
+            for _, slot in live[:excess]:
+                offsets[slot] = 0
+            self._bump(state, "evictions", excess)
+            del live[:excess]
+        struct.pack_into("<Q", state["mmap"], _FIELDS["occupied"], len(live))
+
+    def delete(self, key):
+        """删除一个条目"""
+        key_hash = _hash(key)
+        with self._locked() as state:
+            slot = self._find(state, key_hash)
+            if slot is not None:
+                state["offsets"][slot] = 0
+                self._bump(state, "occupied", -1)
+
+    def incr(self, counter, amount=1):
+        """累加自定义计数器(所有进程共享)"""
+        name = counter.encode("utf-8")[:32]
+        with self._locked() as state:
+            buf = state["mmap"]
+            for i in range(_MAX_COUNTERS):
+                offset = _COUNTERS_OFFSET + i * _COUNTER.size
+                slot_name, value = _COUNTER.unpack_from(buf, offset)
+                if slot_name.rstrip(b"\0") == name or not slot_name.strip(b"\0"):
+                    _COUNTER.pack_into(buf, offset, name, value + amount)
+                    return
+
+    def clear(self):
+        """清空缓存"""
+        with self._locked() as state:
+            for slot in range(self.slots):
+                state["offsets"][slot] = 0
+            struct.pack_into("<Q", state["mmap"], _FIELDS["occupied"], 0)
+
+    def __contains__(self, key):
+        """判断条目是否存在且未过期，不计入命中/未命中统计"""
+        key_hash = _hash(key)
+        with self._locked() as state:
+            slot = self._find(state, key_hash)
+            return slot is not None and self._live(state, slot, self._field(state, "write_pos"), time.time()) is not None
+
+    def _scan(self, state):
+        """有效条目数(复制索引后在锁外计算)"""
+        write_pos = self._field(state, "write_pos")
+        offsets = state["offsets"].tolist()
+        expires = state["expires"].tolist()
+        return write_pos, offsets, expires
+
+    def _count(self, write_pos, offsets, expires):
+        now = time.time()
+        oldest = write_pos - self.data_size
+        return sum(1 for offset, expiry in zip(offsets, expires)
+                   if offset and offset - 1 >= oldest and not (expiry and expiry <= now))
+
+    def __len__(self):
+        with self._locked() as state:
+            snapshot = self._scan(state)
+        return self._count(*snapshot)
+
+    def stats(self):
+        """返回缓存统计信息(所有进程合计)；bytes 为数据区已写入的字节数，包括已失效但尚未被覆盖的记录"""
+        with self._locked() as state:
+            fields = {name: self._field(state, name) for name in _FIELDS}
+            snapshot = self._scan(state)
+            counters = {}
+            for i in range(_MAX_COUNTERS):
+                slot_name, value = _COUNTER.unpack_from(state["mmap"], _COUNTERS_OFFSET + i * _COUNTER.size)
+                if not slot_name.strip(b"\0"):
+                    break
+                counters[slot_name.rstrip(b"\0").decode("utf-8", "replace")] = value
+        hits, misses = fields["hits"], fields["misses"]
+        total = hits + misses
+        return {
+            "shared": True,
+            "entries": self._count(*snapshot),
+            "max_entries": self.max_entries,
+            "bytes": min(fields["write_pos"], self.data_size),
+            "max_bytes": self.data_size,
+            "hits": hits,
+            "misses": misses,
+            "evictions": fields["evictions"],
+            "expirations": fields["expirations"],
+            "hit_rate": round(hits / total, 4) if total else 0.0,
+            **counters,
+        }
@@ -0,0 +1,358 @@
+"""
+相同请求合并(single-flight)
+
+规范化后完全相同的请求在上游调用进行中再次到来时，不再发起新的上游调用，而是等待同一个结果：
+- 非流式: 所有等待者得到同一个响应(或同一个错误)
+- 流式: 缓存已收到的 chunk，每个订阅者从头按自己的速度读取；只有一个订阅者时直接读取上游，
+  有多个订阅者时由后台读取；所有订阅者都关闭(客户端断开)后停止读取并关闭上游流
+
+注意: Gunicorn 同步工作进程一次只处理一个请求，合并只在多线程(--threads)或异步(ASGI)模式下生效。
+"""
+import asyncio
+import contextvars
+import os
+import threading
+
+from sse import aclose_stream, close_stream
+
+COALESCE_ENABLED = os.getenv("COALESCE_ENABLED", "True").lower() == "true"
+
+_counters_lock = threading.Lock()
+_counters = {
+    "unary_leaders": 0,
+    "unary_saved": 0,
+    "stream_leaders": 0,
+    "stream_saved": 0,
+    "stream_cancelled": 0,
+}
+
+
+def _incr(name):
+    with _counters_lock:
+        _counters[name] += 1
+
+
+def stats():
+    """返回请求合并统计信息，*_saved 为节省的上游调用次数"""
+    with _counters_lock:
+        return {"enabled": COALESCE_ENABLED, **_counters,
+                "upstream_calls_saved": _counters["unary_saved"] + _counters["stream_saved"]}
+
+
+class _Call:
+    """一次进行中的非流式调用"""
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class _Broadcast:
+    """一次进行中的流式调用，保存已收到的 chunk 供所有订阅者读取
+
+    只有一个订阅者时由它在自己的线程中直接读取上游；第二个订阅者加入后才启动后台线程读取，
+    这样最慢的订阅者不会拖住其他订阅者。
+    """
+
+    def __init__(self, fn):
+        self.fn = fn
+        self.upstream = None
+        self.chunks = []
+        self.finished = False
+        self.error = None
+        self.cond = threading.Condition()
+        # 保证同一时刻只有一个线程读取上游
+        self.read_lock = threading.Lock()
+        self.subscribers = 0
+        self.cancelled = False
+        self.pumping = False
+        # 发起调用的请求的上下文，后台线程在其中读取上游，上游调用记入该请求的 trace
+        self.context = contextvars.copy_context()
+
+
+class _Subscription:
+    """一个订阅者读取的流，close() 时退订"""
+
+    def __init__(self, flight, key, broadcast):
+        self._flight = flight
+        self._key = key
+        self._broadcast = broadcast
+        self._index = 0
+        self._closed = False
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        broadcast = self._broadcast
+        while True:
+            with broadcast.cond:
+                while self._index >= len(broadcast.chunks) and not broadcast.finished and broadcast.pumping:
+                    broadcast.cond.wait()
+                if self._index < len(broadcast.chunks):
+                    chunk = broadcast.chunks[self._index]
+                    self._index += 1
+                    return chunk
+                if broadcast.finished:
+                    if broadcast.error is not None:
+                        raise broadcast.error
+                    raise StopIteration
+            # 没有后台线程时自己读取上游
+            self._flight._advance(self._key, broadcast)
+
+    def close(self):
+        if not self._closed:
+            self._closed = True
+            self._flight._unsubscribe(self._key, self._broadcast)
+
+
+class SingleFlight:
+    """线程版本的请求合并"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._calls = {}
+        self._streams = {}
+
+    def call(self, key, fn):
+        """相同 key 的调用只执行一次 fn()"""
+        if not COALESCE_ENABLED or key is None:
+            return fn()
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = _Call()
+        if not leader:
+            _incr("unary_saved")
+            call.done.wait()
+            if call.error is not None:
+                raise call.error
+            return call.result
+
+        _incr("unary_leaders")
+        try:
+            call.result = fn()
+            return call.result
+        except Exception as e:
+            call.error = e
+            raise
+        finally:
+            with self._lock:
+                self._calls.pop(key, None)
+            call.done.set()
+
+    def stream(self, key, fn):
+        """相同 key 的流式调用共享同一个上游流，fn() 返回 chunk 迭代器"""
+        if not COALESCE_ENABLED or key is None:
+            return fn()
+        with self._lock:
+            broadcast = self._streams.get(key)
+            leader = broadcast is None
+            if leader:
+                broadcast = self._streams[key] = _Broadcast(fn)
+            elif not broadcast.pumping:
+                # 第二个订阅者加入，改由后台线程读取上游
+                broadcast.pumping = True
+                threading.Thread(target=broadcast.context.run, args=(self._pump, key, broadcast), daemon=True).start()
+            broadcast.subscribers += 1
+        _incr("stream_leaders" if leader else "stream_saved")
+        return _Subscription(self, key, broadcast)
+
+    def _unsubscribe(self, key, broadcast):
+        """最后一个订阅者离开且上游流未结束时，停止读取上游"""
+        with self._lock:
+            broadcast.subscribers -= 1
+            if broadcast.subscribers > 0 or broadcast.finished:
+                return
+            broadcast.cancelled = True
+            # 之后到来的相同请求重新发起上游调用
+            if self._streams.get(key) is broadcast:
+                del self._streams[key]
+            pumping = broadcast.pumping
+        _incr("stream_cancelled")
+        if not pumping:
+            # 没有后台线程，由最后离开的订阅者关闭上游流
+            with broadcast.read_lock:
+                self._finish(key, broadcast)
+
+    def _advance(self, key, broadcast):
+        """读取上游的下一个 chunk，上游结束或出错时返回 False"""
+        with broadcast.read_lock:
+            if broadcast.finished:
+                return False
+            try:
+                if broadcast.upstream is None:
+                    broadcast.upstream = iter(broadcast.fn())
+                chunk = next(broadcast.upstream)
+            except StopIteration:
+                self._finish(key, broadcast)
+                return False
+            except Exception as e:
+                self._finish(key, broadcast, e)
+                return False
+            with broadcast.cond:
+                broadcast.chunks.append(chunk)
+                broadcast.cond.notify_all()
+            return True
+
+    def _pump(self, key, broadcast):
+        """后台读取上游流，直到结束或所有订阅者离开"""
+        while not broadcast.cancelled and self._advance(key, broadcast):
+            pass
+        with broadcast.read_lock:
+            self._finish(key, broadcast)
+
+    def _finish(self, key, broadcast, error=None):
+        """关闭上游流并唤醒所有订阅者，调用时须持有 read_lock"""
+        if broadcast.finished:
+            return
+        close_stream(broadcast.upstream)
+        with self._lock:
+            if self._streams.get(key) is broadcast:
+                del self._streams[key]
+        with broadcast.cond:
+            broadcast.error = error
+            broadcast.finished = True
+            broadcast.cond.notify_all()
+
+
+class _AsyncCall:
+    """一次进行中的异步非流式调用"""
+
+    def __init__(self, task):
+        self.task = task
+        self.waiters = 0
+
+
+class _AsyncBroadcast:
+    """_Broadcast 的异步版本"""
+
+    def __init__(self):
+        self.chunks = []
+        self.finished = False
+        self.error = None
+        self.changed = asyncio.Event()
+        self.subscribers = 0
+        self.task = None
+
+    def publish(self):
+        self.changed.set()
+        self.changed = asyncio.Event()
+
+    async def subscribe(self):
+        index = 0
+        while True:
+            if index < len(self.chunks):
+                chunk = self.chunks[index]
+                index += 1
+                yield chunk
+            elif self.finished:
+                if self.error is not None:
+                    raise self.error
+                return
+            else:
+                await self.changed.wait()
+
+
+class _AsyncSubscription:
+    """_Subscription 的异步版本，aclose() 时退订"""
+
+    def __init__(self, flight, key, broadcast):
+        self._flight = flight
+        self._key = key
+        self._broadcast = broadcast
+        self._chunks = broadcast.subscribe()
+        self._closed = False
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        return await self._chunks.__anext__()
+
+    async def aclose(self):
+        if not self._closed:
+            self._closed = True
+            self._flight._unsubscribe(self._key, self._broadcast)
+            await self._chunks.aclose()
+
+
+class AsyncSingleFlight:
+    """asyncio 版本的请求合并"""
+
+    def __init__(self):
+        self._calls = {}
+        self._streams = {}
+
+    async def call(self, key, fn):
+        """相同 key 的调用只执行一次 await fn()
+
+        fn() 在独立的任务中执行，某个等待者被取消(客户端断开)不会影响其他等待者；
+        所有等待者都离开后才取消该任务。
+        """
+        if not COALESCE_ENABLED or key is None:
+            return await fn()
+        call = self._calls.get(key)
+        if call is not None:
+            _incr("unary_saved")
+        else:
+            _incr("unary_leaders")
+            call = self._calls[key] = _AsyncCall(asyncio.ensure_future(fn()))
+            call.task.add_done_callback(lambda task: self._forget(key, call))
+        call.waiters += 1
+        try:
+            return await asyncio.shield(call.task)
+        finally:
+            call.waiters -= 1
+            if call.waiters == 0 and not call.task.done():
+                self._forget(key, call)
+                call.task.cancel()
+
+    def _forget(self, key, call):
+        if self._calls.get(key) is call:
+            del self._calls[key]
+
+    async def stream(self, key, fn):
+        """相同 key 的流式调用共享同一个上游流，await fn() 返回异步 chunk 迭代器"""
+        if not COALESCE_ENABLED or key is None:
+            return await fn()
+        broadcast = self._streams.get(key)
+        if broadcast is not None:
+            _incr("stream_saved")
+            broadcast.subscribers += 1
+            return _AsyncSubscription(self, key, broadcast)
+
+        _incr("stream_leaders")
+        broadcast = self._streams[key] = _AsyncBroadcast()
+        broadcast.subscribers += 1
+        broadcast.task = asyncio.ensure_future(self._pump(key, broadcast, fn))
+        return _AsyncSubscription(self, key, broadcast)
+
+    def _unsubscribe(self, key, broadcast):
+        """最后一个订阅者离开且上游流未结束时，取消读取上游的任务"""
+        broadcast.subscribers -= 1
+        if broadcast.subscribers > 0 or broadcast.finished:
+            return
+        if self._streams.get(key) is broadcast:
+            del self._streams[key]
+        broadcast.task.cancel()
+        _incr("stream_cancelled")
+
+    async def _pump(self, key, broadcast, fn):
+        """后台读取上游流，结束、出错或被取消时关闭上游流"""
+        upstream = None
+        try:
+            upstream = await fn()
+            async for chunk in upstream:
+                broadcast.chunks.append(chunk)
+                broadcast.publish()
+        except Exception as e:
+            broadcast.error = e
+        finally:
+            if self._streams.get(key) is broadcast:
+                del self._streams[key]
+            broadcast.finished = True
+            broadcast.publish()
+            await aclose_stream(upstream)
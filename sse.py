@@ -0,0 +1,251 @@
+"""
+SSE 帧序列化
+
+- 每个流预先生成 chat.completion.chunk 的帧模板，每个 chunk 只需拼接转义后的增量文本
+- 安装了 orjson 时使用 orjson 编码
+- 可选的合并窗口: 把短时间内到达的多个上游小 chunk 合并成一个 SSE 帧，减少写操作；
+  首个文本 chunk 总是立即发送，不影响首 token 时间
+- 客户端断开时关闭上游迭代器(close_stream / aclose_stream)，使上游流尽快停止
+- 同步模式下通过后台线程读取上游(read_until)，上游卡住时也能按时结束
+"""
+import asyncio
+import contextvars
+import json
+import os
+import queue
+import threading
+import time
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+# 合并窗口(毫秒)，0 表示不合并
+SSE_COALESCE_MS = float(os.getenv("SSE_COALESCE_MS", 0))
+# 缓冲的文本达到该字节数时立即发送
+SSE_COALESCE_BYTES = int(os.getenv("SSE_COALESCE_BYTES", 1024))
+
+
+def dumps(obj):
+    """序列化为 JSON 字符串"""
+    if orjson is not None:
+        return orjson.dumps(obj).decode("utf-8")
+    return json.dumps(obj)
+
+
+class StreamFrames:
+    """一个流的 SSE 帧模板"""
+
+    def __init__(self, response_id, created_time, model_name):
+        self.response_id = response_id
+        self.created_time = created_time
+        self.model_name = model_name
+        head = dumps({
+            "id": response_id,
+            "object": "chat.completion.chunk",
+            "created": created_time,
+            "model": model_name,
+        })[:-1]
+        self._prefix = f'data: {head},"choices":[{{"index":0,"delta":{{"content":'
+        self._suffix = '},"finish_reason":null}]}\n\n'
+
+    def chunk(self, delta, finish_reason=None, usage=None):
+        """完整构造一个 chunk 帧，用于首个/最后一个帧"""
+        chunk = {
+            "id": self.response_id,
+            "object": "chat.completion.chunk",
+            "created": self.created_time,
+            "model": self.model_name,
+            "choices": [{
+                "index": 0,
+                "delta": delta,
+                "finish_reason": finish_reason
+            }]
+        }
+        if usage is not None:
+            chunk["usage"] = usage
+        return f"data: {dumps(chunk)}\n\n"
+
+    def role(self):
+        """首个chunk包含角色信息"""
+        return self.chunk({"role": "assistant", "content": ""})
+
+    def content(self, text):
+        """内容帧，只需转义增量文本"""
+        return self._prefix + dumps(text) + self._suffix
+
+    def final(self, usage=None, finish_reason="stop"):
+        """结束标记"""
+        return self.chunk({}, finish_reason, usage)
+
+
+def close_stream(stream):
+    """关闭(同步)流式迭代器，停止读取上游"""
+    close = getattr(stream, "close", None)
+    if close is not None:
+        close()
+
+
+async def aclose_stream(stream):
+    """关闭异步流式迭代器，停止读取上游"""
+    aclose = getattr(stream, "aclose", None)
+    if aclose is not None:
+        await aclose()
+
+
+def read_until(stream, deadline):
+    """在后台线程读取同步流式迭代器，超过 deadline(time.monotonic) 时抛出 TimeoutError
+
+    上游卡住不再发送数据时，工作线程不会一直阻塞在读取上；读取线程在下一个 chunk 到达(或上游连接超时)后自行关闭上游流。
+    """
+    items = queue.Queue()
+    done = object()
+    stop = threading.Event()
+
+    def reader():
+        try:
+            for item in stream:
+                items.put(item)
+                if stop.is_set():
+                    break
+        except Exception as e:
+            items.put(e)
+        finally:
+            # 在读取线程中关闭，stream 正在执行时不能从其他线程关闭
+            close_stream(stream)
+        items.put(done)
+
+    # 在调用方的上下文中读取，上游调用(重试、切换后端、建立连接等)记入请求的 trace
+    threading.Thread(target=contextvars.copy_context().run, args=(reader,), daemon=True).start()
+    try:
+        while True:
+            try:
+                item = items.get(timeout=max(0, deadline - time.monotonic()))
+            except queue.Empty:
+                raise TimeoutError("超过生成时限") from None
+            if item is done:
+                return
+            if isinstance(item, Exception):
+                raise item
+            yield item
+    finally:
+        stop.set()
+
+
+def coalesce_texts(texts):
+    """在合并窗口内合并上游文本 chunk"""
+    if SSE_COALESCE_MS <= 0:
+        yield from texts
+        return
+
+    window = SSE_COALESCE_MS / 1000
+    # 在后台线程读取上游，以便在窗口到期时不必等待下一个 chunk 就能发送
+    items = queue.Queue()
+    done = object()
+    stop = threading.Event()
+
+    def reader():
+        try:
+            for text in texts:
+                items.put(text)
+                if stop.is_set():
+                    break
+        except Exception as e:
+            items.put(e)
+        finally:
+            # 在读取线程中关闭，texts 正在执行时不能从其他线程关闭
+            close_stream(texts)
+        items.put(done)
+
+    # 在调用方的上下文中读取，上游调用(重试、切换后端、建立连接等)记入请求的 trace
+    threading.Thread(target=contextvars.copy_context().run, args=(reader,), daemon=True).start()
+
+    buffer = []
+    size = 0
+    first = True
+    flush_at = None
+    try:
+        while True:
+            timeout = None if flush_at is None else max(0, flush_at - time.monotonic())
+            try:
+                item = items.get(timeout=timeout)
+            except queue.Empty:
+                item = None
+            if item is done or isinstance(item, Exception):
+                if buffer:
+                    yield "".join(buffer)
+                if item is not done:
+                    raise item
+                return
+            if item is not None:
+                if first:
+                    first = False
+                    yield item
+                    continue
+                buffer.append(item)
+                size += len(item.encode("utf-8"))
+                if flush_at is None:
+                    flush_at = time.monotonic() + window
+            if buffer and (item is None or size >= SSE_COALESCE_BYTES or time.monotonic() >= flush_at):
+                yield "".join(buffer)
+                buffer = []
+                size = 0
+                flush_at = None
+    finally:
+        # 客户端断开时通知读取线程在下一个 chunk 后停止
+        stop.set()
+
+
+async def coalesce_texts_async(texts):
+    """coalesce_texts 的异步版本"""
+    if SSE_COALESCE_MS <= 0:
+        try:
+            async for text in texts:
+                yield text
+        finally:
+            await aclose_stream(texts)
+        return
+
+    window = SSE_COALESCE_MS / 1000
+    iterator = texts.__aiter__()
+    buffer = []
+    size = 0
+    first = True
+    flush_at = None
+    pending = None
+    try:
+        while True:
+            if pending is None:
+                pending = asyncio.ensure_future(iterator.__anext__())
+            timeout = None if flush_at is None else max(0, flush_at - time.monotonic())
+            done, _ = await asyncio.wait({pending}, timeout=timeout)
+            item = None
+            if done:
+                try:
+                    item = pending.result()
+                except StopAsyncIteration:
+                    if buffer:
+                        yield "".join(buffer)
+                    return
+                finally:
+                    pending = None
+                if first:
+                    first = False
+                    yield item
+                    continue
+                buffer.append(item)
+                size += len(item.encode("utf-8"))
+                if flush_at is None:
+                    flush_at = time.monotonic() + window
+            if buffer and (item is None or size >= SSE_COALESCE_BYTES or time.monotonic() >= flush_at):
+                yield "".join(buffer)
+                buffer = []
+                size = 0
+                flush_at = None
+    finally:
+        # 客户端断开(任务被取消)时，正在读取上游的任务也要取消
+        if pending is not None:
+            pending.cancel()
+        else:
+            await aclose_stream(iterator)
@@ -1,14 +1,18 @@
 #!/usr/bin/env python3
 """
-统一启动脚本 - 支持开发和生产模式
+统一启动脚本 - 支持开发、生产和异步模式
 """
 import os
 import sys
+import shutil
 import subprocess
+import tempfile
 
 def start_development():
     """启动开发服务器"""
     from app_vertex import app
+    from startup import begin
+    begin()
     
     port = int(os.getenv('PORT', 8080))
     debug = os.getenv('DEBUG', 'True').lower() == 'true'
@@ -21,6 +25,25 @@ def start_development():
     
     app.run(host='0.0.0.0', port=port, debug=debug)
 
+def prepare_metrics_dir():
+    """为多进程 Prometheus 指标准备一个空目录，各工作进程的指标写入其中并在 /metrics 汇总"""
+    metrics_dir = os.getenv('PROMETHEUS_MULTIPROC_DIR')
+    if not metrics_dir:
+        metrics_dir = os.path.join(tempfile.gettempdir(), 'llm-proxy-metrics')
+        os.environ['PROMETHEUS_MULTIPROC_DIR'] = metrics_dir
+    shutil.rmtree(metrics_dir, ignore_errors=True)
+    os.makedirs(metrics_dir, exist_ok=True)
+    return metrics_dir
+
+# prod/async 模式下默认放到跨进程共享文件中的缓存(见 shared_cache.py)；
+# 共享缓存的文件按容量上限预先分配，图片和 embedding 缓存(默认上限数百 MB)需要时再通过 SHARED_CACHES 开启
+DEFAULT_SHARED_CACHES = 'history_summaries,responses'
+
+def prepare_shared_caches():
+    """多个工作进程共享对话摘要和响应缓存，一个进程算过的结果其他进程直接命中"""
+    os.environ.setdefault('SHARED_CACHES', DEFAULT_SHARED_CACHES)
+    return os.environ['SHARED_CACHES'] or '无'
+
 def start_production():
     """启动生产服务器"""
     port = int(os.getenv('PORT', 8080))
@@ -32,6 +55,8 @@ def start_production():
     print(f"🔧 生产模式: Gunicorn WSGI 服务器")
     print(f"👥 工作进程: {workers}")
     print(f"⏱️  超时时间: {timeout}秒")
+    print(f"📊 指标目录: {prepare_metrics_dir()}")
+    print(f"🗄️  共享缓存: {prepare_shared_caches()}")
     
     gunicorn_args = [
         'gunicorn',
@@ -53,6 +78,41 @@ def start_production():
         print(f"❌ 启动失败: {e}")
         sys.exit(1)
 
+def start_async():
+    """启动异步(ASGI)生产服务器"""
+    port = int(os.getenv('PORT', 8080))
+    workers = int(os.getenv('GUNICORN_WORKERS', 4))
+    timeout = int(os.getenv('GUNICORN_TIMEOUT', 6000))
+
+    print(f"🚀 Gemini Vertex AI代理服务启动中...")
+    print(f"📍 服务地址: http://localhost:{port}/v1/chat/completions")
+    print(f"🔧 异步模式: Gunicorn + Uvicorn ASGI 工作进程")
+    print(f"👥 工作进程: {workers}")
+    print(f"⏱️  超时时间: {timeout}秒")
+    print(f"📊 指标目录: {prepare_metrics_dir()}")
+    print(f"🗄️  共享缓存: {prepare_shared_caches()}")
+
+    gunicorn_args = [
+        'gunicorn',
+        '--bind', f'0.0.0.0:{port}',
+        '--workers', str(workers),
+        '--worker-class', 'uvicorn.workers.UvicornWorker',
+        '--timeout', str(timeout),
+        '--access-logfile', '-',
+        '--error-logfile', '-',
+        '--log-level', 'info',
+        '--preload',
+        'app_asgi:app'
+    ]
+
+    try:
+        subprocess.run(gunicorn_args, check=True)
+    except KeyboardInterrupt:
+        print("\n🛑 服务已停止")
+    except subprocess.CalledProcessError as e:
+        print(f"❌ 启动失败: {e}")
+        sys.exit(1)
+
 def main():
     """主函数"""
     # 检查命令行参数
@@ -64,18 +124,23 @@ def main():
     
     if mode in ['prod', 'production', 'p']:
         start_production()
+    elif mode in ['async', 'asgi', 'a']:
+        start_async()
     elif mode in ['dev', 'development', 'd']:
         start_development()
     else:
         print("使用方法:")
         print("  python start.py dev     # 开发模式 (Flask 开发服务器)")
         print("  python start.py prod    # 生产模式 (Gunicorn WSGI 服务器)")
+        print("  python start.py async   # 异步模式 (Gunicorn + Uvicorn ASGI 服务器)")
         print("")
         print("环境变量:")
         print("  FLASK_ENV=development   # 开发模式")
         print("  FLASK_ENV=production    # 生产模式")
+        print("  FLASK_ENV=async         # 异步模式")
         print("  PORT=8080              # 端口号")
         print("  DEBUG=True/False       # 调试模式")
+        print("  STARTUP_MODE=eager/lazy/warmup  # SDK 初始化时机")
 
 if __name__ == '__main__':
     main() 
\ No newline at end of file
@@ -0,0 +1,108 @@
+"""
+启动模式与就绪状态
+
+导入 google-genai SDK 约占启动时间的大半，STARTUP_MODE 决定何时导入:
+- eager:  导入 app_vertex 时导入 SDK (默认)。配合 gunicorn --preload 时只在主进程中导入一次
+- lazy:   第一个需要 SDK 的请求到来时才导入，进程启动后立即就绪
+- warmup: 工作进程启动后在后台导入 SDK、为各后端获取凭据并建立连接，完成前 /health/ready 返回 503
+
+on_start 注册的函数(如接管遗留的批处理任务)在每个工作进程开始接收请求前执行一次，
+不会在 gunicorn --preload 的主进程中执行。
+
+/health/live 只表示进程存活；/health 和 /health/ready 表示是否可以接收流量，
+响应中的 startup 字段包含各启动步骤的耗时(秒)。
+"""
+import os
+import threading
+import time
+
+STARTUP_MODE = os.getenv("STARTUP_MODE", "eager").lower()
+# 预热时等待每个后端连接建立的最长时间(秒)
+WARMUP_TIMEOUT = float(os.getenv("WARMUP_TIMEOUT", 30))
+
+# 启动步骤 -> 耗时(秒)
+timings = {}
+
+_results = {}
+_step_lock = threading.RLock()
+_warmup_fn = None
+_start_fns = []
+_state = {"pid": None, "ready": STARTUP_MODE != "warmup", "error": None}
+_state_lock = threading.Lock()
+
+
+def run_once(name, fn):
+    """执行一个初始化步骤并记录耗时；之后(包括其他线程)直接返回第一次的结果"""
+    if name in _results:
+        return _results[name]
+    with _step_lock:
+        if name not in _results:
+            start = time.perf_counter()
+            _results[name] = fn()
+            timings[name] = round(time.perf_counter() - start, 3)
+    return _results[name]
+
+
+def record(name, seconds):
+    """记录一个在别处计时的启动步骤"""
+    timings[name] = round(seconds, 3)
+
+
+def on_warmup(fn):
+    """注册预热函数，STARTUP_MODE=warmup 时在每个工作进程中执行"""
+    global _warmup_fn
+    _warmup_fn = fn
+
+
+def on_start(fn):
+    """注册在每个工作进程开始接收请求前执行的函数"""
+    _start_fns.append(fn)
+
+
+def begin():
+    """工作进程开始接收请求前调用；同一进程内多次调用只执行一次
+
+    gunicorn 以 --preload 启动时应用在主进程中导入，预热必须在 fork 之后的工作进程中进行，
+    因此按进程号判断是否已经开始。
+    """
+    pid = os.getpid()
+    with _state_lock:
+        if _state["pid"] == pid:
+            return
+        _state["pid"] = pid
+        for fn in _start_fns:
+            try:
+                fn()
+            except Exception as e:
+                print(f"警告: 启动步骤 {fn.__module__}.{fn.__name__} 失败 - {str(e)}")
+        if STARTUP_MODE != "warmup" or _warmup_fn is None:
+            _state["ready"] = True
+            return
+        _state["ready"] = False
+    threading.Thread(target=_warmup, name="warmup", daemon=True).start()
+
+
+def _warmup():
+    start = time.perf_counter()
+    try:
+        _warmup_fn()
+    except Exception as e:
+        # 预热失败不阻止接收流量，请求到来时会重新初始化并返回实际的错误
+        _state["error"] = str(e)
+        print(f"警告: 预热失败 - {str(e)}")
+    record("warmup", time.perf_counter() - start)
+    with _state_lock:
+        _state["ready"] = True
+
+
+def ready():
+    """是否可以接收流量"""
+    return _state["ready"]
+
+
+def stats():
+    """启动模式、就绪状态和各步骤耗时"""
+    result = {"mode": STARTUP_MODE, "ready": _state["ready"], "timings": dict(timings)}
+    if _state["error"]:
+        result["warmup_error"] = _state["error"]
+    return result
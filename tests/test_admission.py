@@ -0,0 +1,122 @@
+import threading
+from types import SimpleNamespace
+
+import pytest
+
+import admission
+
+
+class Clock:
+    def __init__(self):
+        self.now = 1_000_000.0
+
+    def time(self):
+        return self.now
+
+    def sleep(self, delay):
+        self.now += delay
+
+
+@pytest.fixture(autouse=True)
+def clock(tmp_path, monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(admission, "time", SimpleNamespace(time=clock.time, sleep=clock.sleep))
+    monkeypatch.setattr(admission, "RATE_LIMIT_ENABLED", True)
+    monkeypatch.setattr(admission, "RATE_LIMIT_DB", str(tmp_path / "ratelimit.db"))
+    monkeypatch.setattr(admission, "_local", threading.local())
+    for name in ("KEY_RPM", "KEY_TPM", "GLOBAL_RPM", "GLOBAL_TPM"):
+        monkeypatch.setattr(admission, name, 0)
+    monkeypatch.setattr(admission, "KEY_OVERRIDES", {})
+    monkeypatch.setattr(admission, "QUEUE_SIZE", 10)
+    monkeypatch.setattr(admission, "QUEUE_TIMEOUT", 5)
+    return clock
+
+
+def _headers(key="k1", **extra):
+    return {"Authorization": f"Bearer {key}", **extra}
+
+
+def _request(text="hi"):
+    return {"messages": [{"role": "user", "content": text}]}
+
+
+def test_api_key_from_headers():
+    assert admission.api_key_from_headers({"Authorization": "Bearer abc "}) == "abc"
+    assert admission.api_key_from_headers({"X-API-Key": "xyz"}) == "xyz"
+    assert admission.api_key_from_headers({}) == "anonymous"
+
+
+def test_key_rpm_bucket_refills_over_time(clock, monkeypatch):
+    monkeypatch.setattr(admission, "KEY_RPM", 2)
+    monkeypatch.setattr(admission, "QUEUE_SIZE", 0)
+    admission.admit(_request(), _headers())
+    admission.admit(_request(), _headers())
+    with pytest.raises(admission.RateLimited) as info:
+        admission.admit(_request(), _headers())
+    assert info.value.code == 429
+    assert info.value.retry_after == 30
+
+    # 其他 API Key 使用独立的令牌桶
+    admission.admit(_request(), _headers("k2"))
+
+    clock.now += 30
+    admission.admit(_request(), _headers())
+
+
+def test_global_limit_is_shared_by_all_keys(monkeypatch):
+    monkeypatch.setattr(admission, "GLOBAL_RPM", 1)
+    monkeypatch.setattr(admission, "QUEUE_SIZE", 0)
+    admission.admit(_request(), _headers("k1"))
+    with pytest.raises(admission.RateLimited):
+        admission.admit(_request(), _headers("k2"))
+
+
+def test_tpm_charges_estimated_prompt_tokens(monkeypatch):
+    monkeypatch.setattr(admission, "KEY_TPM", 100)
+    monkeypatch.setattr(admission, "QUEUE_SIZE", 0)
+    admission.admit(_request("x" * 240), _headers())
+    with pytest.raises(admission.RateLimited):
+        admission.admit(_request("x" * 240), _headers())
+    admission.admit(_request(""), _headers())
+
+
+def test_queued_request_is_admitted_when_tokens_refill(clock, monkeypatch):
+    monkeypatch.setattr(admission, "KEY_RPM", 12)
+    monkeypatch.setattr(admission, "QUEUE_TIMEOUT", 10)
+    for _ in range(12):
+        admission.admit(_request(), _headers())
+    start = clock.now
+    admission.admit(_request(), _headers())
+    # 每 5 秒补充一个令牌
+    assert 5 <= clock.now - start < 5 + admission._POLL_INTERVAL * 2
+    assert admission.stats()["queued"] >= 1
+    assert admission._db().execute("SELECT COUNT(*) FROM waiters").fetchone()[0] == 0
+
+
+def test_queue_timeout_rejects(clock, monkeypatch):
+    monkeypatch.setattr(admission, "KEY_RPM", 1)
+    admission.admit(_request(), _headers())
+    start = clock.now
+    with pytest.raises(admission.RateLimited) as info:
+        admission.admit(_request(), _headers())
+    assert "排队" in str(info.value)
+    assert clock.now - start <= admission.QUEUE_TIMEOUT
+    assert admission._db().execute("SELECT COUNT(*) FROM waiters").fetchone()[0] == 0
+
+
+def test_waiting_higher_priority_requests_go_first(clock, monkeypatch):
+    monkeypatch.setattr(admission, "KEY_RPM", 60)
+    limits_for = admission._limits_for("k1")
+    waiter = admission._enqueue(admission._PRIORITY_RANK["high"], clock.now + 10)
+    # 配额足够，但有高优先级请求在排队
+    assert admission._try_acquire(limits_for, 0, admission._PRIORITY_RANK["normal"]) == admission._POLL_INTERVAL
+    assert admission._try_acquire(limits_for, 0, admission._PRIORITY_RANK["high"]) == 0
+    admission._dequeue(waiter)
+    assert admission._try_acquire(limits_for, 0, admission._PRIORITY_RANK["normal"]) == 0
+
+
+def test_low_priority_gets_a_smaller_share_of_the_queue(monkeypatch):
+    monkeypatch.setattr(admission, "QUEUE_SIZE", 2)
+    assert admission._enqueue(admission._PRIORITY_RANK["low"], admission.time.time() + 10) is not None
+    assert admission._enqueue(admission._PRIORITY_RANK["low"], admission.time.time() + 10) is None
+    assert admission._enqueue(admission._PRIORITY_RANK["high"], admission.time.time() + 10) is not None
@@ -0,0 +1,166 @@
+import io
+import json
+import os
+import threading
+import time
+
+import pytest
+from google.genai import types
+from starlette.testclient import TestClient
+
+import app_asgi
+import batches
+
+
+@pytest.fixture(autouse=True)
+def batch_dir(tmp_path, monkeypatch):
+    monkeypatch.setattr(batches, "BATCH_DIR", str(tmp_path))
+    monkeypatch.setattr(batches, "_local", threading.local())
+    monkeypatch.setattr(batches, "BATCH_GCS_URI", "gs://bucket/prefix")
+    monkeypatch.setattr(batches, "BATCH_POLL_SECONDS", 0)
+
+
+class FakeBlob:
+    def __init__(self, name, text):
+        self.name = name
+        self._text = text
+
+    def download_as_text(self):
+        return self._text
+
+
+class FakeStorageClient:
+    def __init__(self, blobs):
+        self.blobs = blobs
+        self.listed = []
+
+    def list_blobs(self, bucket_name, prefix=None):
+        self.listed.append((bucket_name, prefix))
+        return self.blobs
+
+
+class FakeBatches:
+    """按顺序返回预设的 BatchJob 状态"""
+
+    def __init__(self, jobs):
+        self.jobs = list(jobs)
+
+    def get(self, name):
+        return self.jobs.pop(0) if len(self.jobs) > 1 else self.jobs[0]
+
+
+class FakeClient:
+    def __init__(self, jobs):
+        self.batches = FakeBatches(jobs)
+
+
+def _job(state):
+    return types.BatchJob(name="projects/p/locations/l/batchPredictionJobs/1", state=state,
+                          dest=types.BatchJobDestination(gcs_uri="gs://bucket/prefix/batch_1/output"))
+
+
+def _insert_batch(vertex_job):
+    input_file = batches.create_file(io.BytesIO(b'{"custom_id": "a", "body": {}}\n'), "in.jsonl", "batch")
+    batch = {"id": "batch_1", "status": "in_progress", "input_file_id": input_file["id"],
+             "request_counts": {"total": 2, "completed": 0, "failed": 0},
+             "_backend": "vertex", "_vertex_job": vertex_job, "_model": "gemini-2.5-flash"}
+    batches._db().execute("INSERT INTO batches (id, status, worker, created_at, data) VALUES (?, ?, ?, ?, ?)",
+                          (batch["id"], batch["status"], batches._worker_id(), int(time.time()), json.dumps(batch)))
+    return batch
+
+
+def test_run_vertex_collects_results_from_job_destination(monkeypatch):
+    from google.cloud import storage
+    import upstream
+
+    output = "\n".join([
+        json.dumps({"custom_id": "a", "response": {
+            "candidates": [{"content": {"role": "model", "parts": [{"text": "hello"}]}}]}}),
+        json.dumps({"custom_id": "b", "status": "RESOURCE_EXHAUSTED"}),
+    ])
+    storage_client = FakeStorageClient([FakeBlob("prefix/batch_1/output/predictions.jsonl", output),
+                                        FakeBlob("prefix/batch_1/output/README.txt", "ignored")])
+    monkeypatch.setattr(storage, "Client", lambda: storage_client)
+    client = FakeClient([_job(types.JobState.JOB_STATE_RUNNING), _job(types.JobState.JOB_STATE_SUCCEEDED)])
+    monkeypatch.setattr(upstream, "default_client", lambda: client)
+    monkeypatch.setitem(batches._handlers, "build",
+                        lambda response, model_name: {"id": "chatcmpl-1", "model": model_name, "text": response.text})
+
+    batches._run_vertex(_insert_batch("projects/p/locations/l/batchPredictionJobs/1"))
+
+    assert storage_client.listed == [("bucket", "prefix/batch_1/output")]
+    batch = batches.get_batch("batch_1")
+    assert batch["status"] == "completed"
+    assert batch["request_counts"] == {"total": 2, "completed": 1, "failed": 1}
+    with open(batches.file_content_path(batch["output_file_id"])) as f:
+        result = json.loads(f.readline())
+    assert result["custom_id"] == "a"
+    assert result["response"]["body"] == {"id": "chatcmpl-1", "model": "gemini-2.5-flash", "text": "hello"}
+    with open(batches.file_content_path(batch["error_file_id"])) as f:
+        assert json.loads(f.readline())["custom_id"] == "b"
+
+
+def test_run_vertex_failed_job_raises(monkeypatch):
+    from google.cloud import storage
+    import upstream
+
+    monkeypatch.setattr(storage, "Client", lambda: FakeStorageClient([]))
+    monkeypatch.setattr(upstream, "default_client", lambda: FakeClient([_job(types.JobState.JOB_STATE_FAILED)]))
+
+    with pytest.raises(RuntimeError, match="批量预测任务失败"):
+        batches._run_vertex(_insert_batch("projects/p/locations/l/batchPredictionJobs/1"))
+
+
+def test_resume_claims_batches_of_exited_workers(monkeypatch):
+    spawned = []
+    monkeypatch.setattr(batches, "_spawn", spawned.append)
+    dead_worker = f"{batches.socket.gethostname()}:999999999"
+    for batch_id, worker in (("batch_dead", dead_worker), ("batch_alive", batches._worker_id())):
+        batches._db().execute("INSERT INTO batches (id, status, worker, created_at, data) VALUES (?, ?, ?, ?, ?)",
+                              (batch_id, "in_progress", worker, int(time.time()), json.dumps({"id": batch_id})))
+
+    batches.resume()
+
+    assert spawned == ["batch_dead"]
+    row = batches._db().execute("SELECT worker FROM batches WHERE id = 'batch_dead'").fetchone()
+    assert row[0] == batches._worker_id()
+
+
+def test_cancel_after_the_last_progress_check_is_kept(monkeypatch):
+    batch = _insert_batch(None)
+
+    def complete(body):
+        # 取消请求在最后一次进度检查之后到来
+        batches.cancel_batch("batch_1")
+        return {"id": "chatcmpl-1"}
+
+    monkeypatch.setitem(batches._handlers, "complete", complete)
+    batches._run_local(batch)
+    assert batches.get_batch("batch_1")["status"] == "cancelled"
+
+
+def test_failed_upload_raises_the_original_error(tmp_path):
+    class Failing:
+        def read(self, size):
+            # 临时文件已经不存在时，删除失败不能掩盖原来的错误
+            for name in os.listdir(tmp_path / "files"):
+                os.remove(tmp_path / "files" / name)
+            raise ConnectionResetError("client disconnected")
+
+    with pytest.raises(ConnectionResetError):
+        batches.create_file(Failing(), "in.jsonl", "batch")
+    assert os.listdir(tmp_path / "files") == []
+
+
+def test_asgi_multipart_upload():
+    client = TestClient(app_asgi.app)
+    content = b'{"custom_id": "a", "body": {}}\n'
+    response = client.post("/v1/files", data={"purpose": "batch"},
+                           files={"file": ("in.jsonl", content, "application/jsonl")})
+    assert response.status_code == 200
+    uploaded = response.json()
+    assert (uploaded["filename"], uploaded["bytes"], uploaded["purpose"]) == ("in.jsonl", len(content), "batch")
+    assert client.get(f"/v1/files/{uploaded['id']}/content").content == content
+
+    response = client.post("/v1/files", data={"purpose": "batch"})
+    assert response.status_code == 400
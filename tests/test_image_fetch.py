@@ -0,0 +1,118 @@
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+import image_fetch
+from image_fetch import BlockedURL, check_url
+
+PNG = b"\x89PNG\r\n\x1a\n" + b"\x00" * 32
+
+
+class _Handler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.startswith("/redirect"):
+            self.send_response(302)
+            location = self.path[len("/redirect"):]
+            self.send_header("Location", location[1:] if location.startswith("/http") else location)
+            self.end_headers()
+            return
+        self.send_response(200)
+        self.send_header("Content-Length", str(len(PNG)))
+        self.end_headers()
+        self.wfile.write(PNG)
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def server():
+    httpd = ThreadingHTTPServer(("127.0.0.1", 0), _Handler)
+    threading.Thread(target=httpd.serve_forever, daemon=True).start()
+    yield httpd.server_address[1]
+    httpd.shutdown()
+    httpd.server_close()
+
+
+@pytest.fixture(autouse=True)
+def defaults(monkeypatch):
+    monkeypatch.setattr(image_fetch, "ALLOWED_HOSTS", [])
+    monkeypatch.setattr(image_fetch, "ALLOW_PRIVATE", False)
+
+
+@pytest.mark.parametrize("url", [
+    "file:///etc/passwd",
+    "ftp://example.com/a.png",
+    "http:///a.png",
+    "http://169.254.169.254/computeMetadata/v1/",
+    "http://127.0.0.1/a.png",
+    "http://localhost:8080/a.png",
+    "http://10.0.0.1/a.png",
+    "http://192.168.1.1/a.png",
+    "http://[::1]/a.png",
+    "http://[::ffff:127.0.0.1]/a.png",
+    "http://0.0.0.0/a.png",
+])
+def test_non_public_urls_are_rejected(url):
+    with pytest.raises(BlockedURL):
+        check_url(url)
+
+
+def test_allowed_hosts(monkeypatch):
+    monkeypatch.setattr(image_fetch, "ALLOWED_HOSTS", [".example.com", "8.8.8.8"])
+    check_url("https://8.8.8.8/a.png")
+    for url in ("https://evil.com/a.png", "https://example.com.evil.com/a.png", "https://8.8.4.4/a.png"):
+        with pytest.raises(BlockedURL):
+            check_url(url)
+
+
+def test_private_addresses_need_explicit_opt_in(server, monkeypatch):
+    url = f"http://127.0.0.1:{server}/a.png"
+    with pytest.raises(BlockedURL):
+        image_fetch._download(url)
+
+    monkeypatch.setattr(image_fetch, "ALLOW_PRIVATE", True)
+    assert image_fetch._download(url) == (PNG, "image/png")
+
+
+def test_every_redirect_hop_is_checked(server, monkeypatch):
+    monkeypatch.setattr(image_fetch, "ALLOW_PRIVATE", True)
+    monkeypatch.setattr(image_fetch, "ALLOWED_HOSTS", ["127.0.0.1"])
+    base = f"http://127.0.0.1:{server}"
+    assert image_fetch._download(f"{base}/redirect/a.png") == (PNG, "image/png")
+    with pytest.raises(BlockedURL):
+        image_fetch._download(f"{base}/redirect/http://localhost:{server}/a.png")
+
+    with pytest.raises(ValueError, match="重定向"):
+        image_fetch._download(f"{base}/redirect" * (image_fetch.MAX_REDIRECTS + 1) + "/a.png")
+
+
+def test_connected_address_is_checked_again(server, monkeypatch):
+    # 模拟检查之后 DNS 解析结果变为内网地址
+    monkeypatch.setattr(image_fetch, "check_url", lambda url: None)
+    with pytest.raises(BlockedURL):
+        image_fetch._download(f"http://127.0.0.1:{server}/a.png")
+
+
+def test_disk_cache_is_scanned_only_when_full(tmp_path, monkeypatch):
+    monkeypatch.setattr(image_fetch, "CACHE_DIR", str(tmp_path))
+    monkeypatch.setattr(image_fetch, "CACHE_DIR_MAX_BYTES", 1000)
+    monkeypatch.setattr(image_fetch, "_disk_usage", {"pid": None, "bytes": 0, "scanned_at": 0.0})
+    scans = []
+    walk = image_fetch.os.walk
+    monkeypatch.setattr(image_fetch.os, "walk", lambda path: scans.append(path) or walk(path))
+
+    for i in range(9):
+        image_fetch._disk_set(f"{i:02d}" * 32, b"x" * 100)
+    # 只在进程第一次写入时扫描
+    assert len(scans) == 1
+    assert image_fetch._disk_usage["bytes"] == 900
+
+    image_fetch._disk_set("aa" * 32, b"x" * 200)
+    assert len(scans) == 2
+    # 删除最旧的文件直到容量的 90% 以下
+    remaining = sorted(path.name for path in tmp_path.rglob("*") if path.is_file())
+    assert image_fetch._disk_usage["bytes"] == 900
+    assert "00" * 32 not in remaining and "08" * 32 in remaining and "aa" * 32 in remaining
+    assert image_fetch._disk_get("aa" * 32) == b"x" * 200
@@ -0,0 +1,80 @@
+import base64
+import json
+
+import pytest
+
+from request_stream import StreamingRequestParser
+
+PNG = b"\x89PNG\r\n\x1a\n" + bytes(range(256)) * 4
+PNG_URI = "data:image/png;base64," + base64.b64encode(PNG).decode("ascii")
+
+
+def _parse(body, chunk_size=None):
+    raw = json.dumps(body).encode("utf-8")
+    chunk_size = chunk_size or len(raw)
+    parser = StreamingRequestParser()
+    for start in range(0, len(raw), chunk_size):
+        parser.feed(raw[start:start + chunk_size])
+    return parser.finish()
+
+
+def _request(*parts):
+    return {"model": "gemini", "messages": [{"role": "user", "content": list(parts)}]}
+
+
+@pytest.mark.parametrize("chunk_size", [None, 1, 3, 7, 64])
+def test_image_url_is_extracted_as_blob(chunk_size):
+    body = _request({"type": "text", "text": "描述图片 \"引号\" \\ 反斜杠"},
+                    {"type": "image_url", "image_url": {"url": PNG_URI, "detail": "high"}})
+    data, blobs = _parse(body, chunk_size)
+
+    parts = data["messages"][0]["content"]
+    assert parts[0] == body["messages"][0]["content"][0]
+    placeholder = parts[1]["image_url"]["url"]
+    assert parts[1]["image_url"]["detail"] == "high"
+    assert blobs == {placeholder: (PNG, "image/png")}
+
+
+def test_escaped_slashes_in_base64_are_decoded():
+    raw = json.dumps(_request({"type": "image_url", "image_url": {"url": PNG_URI}})).replace("/", "\\/")
+    parser = StreamingRequestParser()
+    parser.feed(raw.encode("utf-8"))
+    data, blobs = parser.finish()
+    assert list(blobs.values()) == [(PNG, "image/png")]
+
+
+@pytest.mark.parametrize("chunk_size", [None, 5])
+def test_data_uri_outside_image_url_is_kept(chunk_size):
+    text = "请原样返回: " + PNG_URI
+    body = _request({"type": "text", "text": PNG_URI}, {"type": "text", "text": text})
+    body["tools"] = [{"type": "function", "function": {"name": "f", "parameters": {"url": PNG_URI}}}]
+    body["messages"].append({"role": "assistant", "content": None,
+                             "tool_calls": [{"id": "1", "function": {"name": "f", "arguments": {"url": PNG_URI}}}]})
+
+    data, blobs = _parse(body, chunk_size)
+    assert data == body
+    assert blobs == {}
+
+
+def test_non_image_data_uri_in_image_url_is_kept():
+    uri = "data:application/pdf;base64," + base64.b64encode(b"%PDF-1.4").decode("ascii")
+    body = _request({"type": "image_url", "image_url": {"url": uri}})
+    data, blobs = _parse(body)
+    assert data == body
+    assert blobs == {}
+
+
+def test_url_key_is_matched_after_escapes():
+    body = _request({"type": "image_url", "image_url": {"url": PNG_URI}})
+    raw = json.dumps(body).replace('"url"', '"\\u0075rl"').encode("utf-8")
+    parser = StreamingRequestParser()
+    parser.feed(raw)
+    data, blobs = parser.finish()
+    assert list(blobs.values()) == [(PNG, "image/png")]
+
+
+def test_incomplete_body_raises():
+    parser = StreamingRequestParser()
+    parser.feed(b'{"messages": [{"content": "abc')
+    with pytest.raises(ValueError):
+        parser.finish()
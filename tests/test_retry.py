@@ -0,0 +1,180 @@
+import asyncio
+import threading
+import time
+
+import httpx
+import pytest
+from google.api_core import exceptions as api_exceptions
+from google.genai import errors as genai_errors
+
+import retry
+
+
+@pytest.fixture(autouse=True)
+def no_sleep(monkeypatch):
+    sleeps = []
+    monkeypatch.setattr(retry, "RETRY_ENABLED", True)
+    monkeypatch.setattr(retry.time, "sleep", sleeps.append)
+    monkeypatch.setattr(retry.random, "uniform", lambda low, high: high)
+    return sleeps
+
+
+def _genai_error(code, details=None):
+    body = {"error": {"code": code, "message": "upstream", "status": "X", "details": details or []}}
+    return genai_errors.APIError(code, body)
+
+
+@pytest.mark.parametrize("exc, expected", [
+    (api_exceptions.TooManyRequests("slow down"), "rate_limited"),
+    (api_exceptions.ResourceExhausted("quota"), "rate_limited"),
+    (api_exceptions.ServiceUnavailable("down"), "unavailable"),
+    (api_exceptions.DeadlineExceeded("timeout"), "unavailable"),
+    (api_exceptions.InternalServerError("oops"), "internal"),
+    (httpx.ConnectError("reset"), "unavailable"),
+    (httpx.ReadTimeout("timeout"), "unavailable"),
+    (_genai_error(429), "rate_limited"),
+    (_genai_error(503), "unavailable"),
+    (_genai_error(500), "internal"),
+    (_genai_error(400), None),
+    (_genai_error(404), None),
+    (api_exceptions.InvalidArgument("bad request"), None),
+    (api_exceptions.PermissionDenied("forbidden"), None),
+    (ValueError("bug"), None),
+])
+def test_classify_error(exc, expected):
+    assert retry.classify_error(exc) == expected
+
+
+def test_error_status_uses_http_codes_only():
+    assert retry.error_status(_genai_error(429)) == 429
+    assert retry.error_status(api_exceptions.InvalidArgument("bad")) == 400
+    assert retry.error_status(ValueError("bug")) == 500
+
+
+def test_retry_after_header_and_retry_info():
+    request = httpx.Request("POST", "https://example.com")
+    response = httpx.Response(429, headers={"Retry-After": "7"}, request=request)
+    assert retry._retry_after(genai_errors.APIError(429, {}, response)) == 7.0
+    details = [{"@type": "type.googleapis.com/google.rpc.RetryInfo", "retryDelay": "3.5s"}]
+    assert retry._retry_after(_genai_error(429, details)) == 3.5
+    assert retry._retry_after(_genai_error(429)) is None
+
+
+def test_call_with_retry_retries_retryable_errors(no_sleep):
+    errors = [api_exceptions.ServiceUnavailable("down"), api_exceptions.ServiceUnavailable("down")]
+
+    def fn():
+        if errors:
+            raise errors.pop(0)
+        return "ok"
+
+    assert retry.call_with_retry(fn, time.monotonic() + 60) == "ok"
+    base = retry.RETRY_POLICIES["unavailable"]["base_delay"]
+    assert no_sleep == [base, base * 2]
+
+
+def test_call_with_retry_stops_after_max_attempts(no_sleep):
+    calls = []
+
+    def fn():
+        calls.append(1)
+        raise api_exceptions.InternalServerError("oops")
+
+    with pytest.raises(api_exceptions.InternalServerError):
+        retry.call_with_retry(fn, time.monotonic() + 60)
+    assert len(calls) == retry.RETRY_POLICIES["internal"]["max_attempts"]
+
+
+def test_non_retryable_errors_are_raised_immediately(no_sleep):
+    calls = []
+
+    def fn():
+        calls.append(1)
+        raise api_exceptions.InvalidArgument("bad request")
+
+    with pytest.raises(api_exceptions.InvalidArgument):
+        retry.call_with_retry(fn, time.monotonic() + 60)
+    assert calls == [1]
+    assert no_sleep == []
+
+
+def test_retry_is_skipped_when_it_would_pass_the_deadline(no_sleep):
+    calls = []
+
+    def fn():
+        calls.append(1)
+        raise _genai_error(429, [{"retryDelay": "30s"}])
+
+    with pytest.raises(genai_errors.APIError):
+        retry.call_with_retry(fn, time.monotonic() + 5)
+    assert calls == [1]
+
+
+def test_stream_retries_only_before_the_first_chunk(no_sleep):
+    attempts = []
+
+    def fn():
+        attempts.append(1)
+        if len(attempts) == 1:
+            raise api_exceptions.ServiceUnavailable("down")
+        yield "a"
+        raise api_exceptions.ServiceUnavailable("down")
+
+    stream = retry.stream_with_retry(fn, time.monotonic() + 60)
+    assert next(stream) == "a"
+    with pytest.raises(api_exceptions.ServiceUnavailable):
+        next(stream)
+    assert len(attempts) == 2
+
+
+def test_hedged_call_returns_the_faster_request(monkeypatch):
+    monkeypatch.setattr(retry, "HEDGE_ENABLED", True)
+    monkeypatch.setattr(retry, "hedge_delay", lambda: 0.05)
+    calls = []
+
+    def fn():
+        calls.append(1)
+        if len(calls) == 1:
+            threading.Event().wait(1)
+            return "slow"
+        return "fast"
+
+    assert retry.call_with_retry(fn, time.monotonic() + 60, hedge=True) == "fast"
+    assert len(calls) == 2
+
+
+def test_async_retry_and_hedge(monkeypatch):
+    async def no_wait(delay):
+        pass
+
+    async def main():
+        errors = [api_exceptions.TooManyRequests("slow down")]
+
+        async def flaky():
+            if errors:
+                raise errors.pop(0)
+            return "ok"
+
+        with monkeypatch.context() as patch:
+            patch.setattr(retry.asyncio, "sleep", no_wait)
+            assert await retry.call_with_retry_async(flaky, time.monotonic() + 60) == "ok"
+
+        monkeypatch.setattr(retry, "HEDGE_ENABLED", True)
+        monkeypatch.setattr(retry, "hedge_delay", lambda: 0.05)
+        cancelled = []
+
+        async def fn():
+            if not cancelled:
+                cancelled.append(False)
+                try:
+                    await asyncio.sleep(5)
+                except asyncio.CancelledError:
+                    cancelled[0] = True
+                    raise
+            return "fast"
+
+        assert await retry.call_with_retry_async(fn, time.monotonic() + 60, hedge=True) == "fast"
+        await asyncio.sleep(0)
+        assert cancelled == [True]
+
+    asyncio.run(main())
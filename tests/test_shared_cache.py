@@ -0,0 +1,121 @@
+import multiprocessing
+import os
+
+import pytest
+
+import cache
+import shared_cache
+from shared_cache import SharedCache, dumps, loads
+
+
+@pytest.fixture(autouse=True)
+def cache_dir(tmp_path, monkeypatch):
+    path = tmp_path / "shared"
+    monkeypatch.setattr(shared_cache, "SHARED_CACHE_DIR", str(path))
+    names = set(cache._registry)
+    yield path
+    for name in set(cache._registry) - names:
+        del cache._registry[name]
+
+
+def test_values_round_trip_without_pickle():
+    value = {"text": "你好", "tokens": 12, "usage": None, "ok": True, "score": 0.5,
+             "image": (b"\x89PNG\x00", "image/png"), "list": [1, [2, 3], {"k": -2 ** 70}]}
+    assert loads(dumps(value)) == value
+    assert loads(dumps(())) == ()
+
+    with pytest.raises(TypeError):
+        dumps(object())
+    with pytest.raises(ValueError):
+        loads(dumps("abc")[:-1])
+    with pytest.raises(ValueError):
+        loads(b"\x80\x04\x95")
+
+
+def test_get_set_delete_and_stats():
+    shared = SharedCache("test_basic", max_entries=8)
+    shared.set("a", {"content": "x"})
+    assert shared.get("a") == {"content": "x"}
+    assert "a" in shared
+    assert shared.get("missing", "default") == "default"
+    shared.delete("a")
+    assert shared.get("a") is None
+    stats = shared.stats()
+    assert stats["shared"] is True
+    assert (stats["hits"], stats["misses"], stats["entries"]) == (1, 2, 0)
+
+
+def test_max_entries_is_enforced():
+    shared = SharedCache("test_entries", max_entries=16, max_bytes=1024 * 1024)
+    for i in range(200):
+        shared.set(f"key-{i}", i)
+        assert len(shared) <= 16
+    # 最近写入的条目保留，最早的被淘汰
+    assert shared.get("key-199") == 199
+    assert shared.get("key-0") is None
+    assert shared.stats()["evictions"] > 0
+
+
+def test_ring_wraparound_evicts_oldest_records():
+    shared = SharedCache("test_ring", max_entries=1024, max_bytes=4096)
+    value = b"x" * 500
+    for i in range(40):
+        shared.set(i, value + bytes([i]))
+    stats = shared.stats()
+    assert stats["bytes"] == 4096
+    # 数据区只能容纳最近的几条记录
+    assert shared.get(39) == value + bytes([39])
+    assert shared.get(0) is None
+    assert 0 < len(shared) <= 4096 // 500
+    # 超过数据区 1/4 的值不写入
+    shared.set("big", b"y" * 2000)
+    assert shared.get("big") is None
+
+
+def test_hit_near_overwrite_moves_record_forward():
+    shared = SharedCache("test_refresh", max_entries=1024, max_bytes=4096)
+    shared.set("keep", b"k" * 500)
+    for i in range(5):
+        shared.set(i, b"v" * 500)
+        assert shared.get("keep") == b"k" * 500
+    for i in range(5, 12):
+        shared.set(i, b"v" * 500)
+        assert shared.get("keep") == b"k" * 500
+
+
+def test_expired_entries_are_not_returned(monkeypatch):
+    shared = SharedCache("test_ttl", max_entries=8)
+    now = [1000.0]
+    monkeypatch.setattr(shared_cache.time, "time", lambda: now[0])
+    shared.set("a", 1, ttl=10)
+    assert shared.get("a") == 1
+    now[0] += 11
+    assert shared.get("a") is None
+    assert shared.stats()["expirations"] == 1
+
+
+def _child_write(name):
+    SharedCache(name, max_entries=8).set("from-child", [os.getpid()])
+
+
+def test_entries_are_shared_across_processes():
+    shared = SharedCache("test_processes", max_entries=8)
+    shared.set("warm", 1)
+    process = multiprocessing.get_context("fork").Process(target=_child_write, args=("test_processes",))
+    process.start()
+    process.join(10)
+    assert process.exitcode == 0
+    assert shared.get("from-child") == [process.pid]
+
+
+def test_directory_must_be_private(cache_dir, monkeypatch):
+    os.makedirs(cache_dir, mode=0o755)
+    os.chmod(cache_dir, 0o777)
+    with pytest.raises(PermissionError):
+        SharedCache("test_private", max_entries=8).stats()
+
+    monkeypatch.setattr(cache, "SHARED_CACHES", {"test_fallback"})
+    assert isinstance(cache.create_cache("test_fallback", max_entries=8), cache.LRUCache)
+
+    os.chmod(cache_dir, 0o700)
+    assert isinstance(cache.create_cache("test_fallback", max_entries=8), SharedCache)
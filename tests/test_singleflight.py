@@ -0,0 +1,199 @@
+import asyncio
+import threading
+
+import pytest
+
+import singleflight
+import tracing
+
+
+@pytest.fixture(autouse=True)
+def enabled(monkeypatch):
+    monkeypatch.setattr(singleflight, "COALESCE_ENABLED", True)
+
+
+def test_async_leader_cancellation_does_not_reach_followers():
+    async def main():
+        flight = singleflight.AsyncSingleFlight()
+        release = asyncio.Event()
+        calls = []
+
+        async def fn():
+            calls.append(1)
+            await release.wait()
+            return "result"
+
+        leader = asyncio.ensure_future(flight.call("k", fn))
+        await asyncio.sleep(0)
+        follower = asyncio.ensure_future(flight.call("k", fn))
+        await asyncio.sleep(0)
+
+        leader.cancel()
+        await asyncio.sleep(0)
+        release.set()
+        assert await follower == "result"
+        assert leader.cancelled()
+        assert calls == [1]
+
+    asyncio.run(main())
+
+
+def test_async_call_is_cancelled_when_all_waiters_leave():
+    async def main():
+        flight = singleflight.AsyncSingleFlight()
+        cancelled = asyncio.Event()
+
+        async def fn():
+            try:
+                await asyncio.sleep(60)
+            except asyncio.CancelledError:
+                cancelled.set()
+                raise
+
+        first = asyncio.ensure_future(flight.call("k", fn))
+        second = asyncio.ensure_future(flight.call("k", fn))
+        await asyncio.sleep(0)
+        first.cancel()
+        second.cancel()
+        await asyncio.wait_for(cancelled.wait(), 1)
+        assert flight._calls == {}
+
+        async def fresh():
+            return "fresh"
+
+        assert await flight.call("k", fresh) == "fresh"
+
+    asyncio.run(main())
+
+
+def test_async_errors_reach_every_waiter():
+    async def main():
+        flight = singleflight.AsyncSingleFlight()
+
+        async def fn():
+            await asyncio.sleep(0)
+            raise ValueError("upstream")
+
+        results = await asyncio.gather(flight.call("k", fn), flight.call("k", fn), return_exceptions=True)
+        assert [type(r) for r in results] == [ValueError, ValueError]
+        assert flight._calls == {}
+
+    asyncio.run(main())
+
+
+def test_single_stream_subscriber_reads_without_a_pump_thread(monkeypatch):
+    flight = singleflight.SingleFlight()
+    readers = []
+
+    def fn():
+        for i in range(3):
+            readers.append(threading.current_thread())
+            yield i
+
+    def no_thread(*args, **kwargs):
+        raise AssertionError("不应启动后台线程")
+
+    monkeypatch.setattr(singleflight.threading, "Thread", no_thread)
+    assert list(flight.stream("k", fn)) == [0, 1, 2]
+    assert readers == [threading.current_thread()] * 3
+    assert flight._streams == {}
+
+
+def test_second_stream_subscriber_shares_upstream():
+    flight = singleflight.SingleFlight()
+    gate = threading.Event()
+    calls = []
+
+    def fn():
+        calls.append(1)
+        yield "a"
+        gate.wait(5)
+        yield "b"
+
+    first = flight.stream("k", fn)
+    assert next(first) == "a"
+    second = flight.stream("k", fn)
+    gate.set()
+    assert list(first) == ["b"]
+    assert list(second) == ["a", "b"]
+    assert calls == [1]
+
+
+def test_closing_only_stream_subscriber_closes_upstream():
+    flight = singleflight.SingleFlight()
+    closed = []
+
+    def fn():
+        try:
+            yield "a"
+            yield "b"
+        finally:
+            closed.append(True)
+
+    subscription = flight.stream("k", fn)
+    assert next(subscription) == "a"
+    subscription.close()
+    assert closed == [True]
+    assert flight._streams == {}
+
+
+def test_pump_thread_reads_in_the_leader_context():
+    flight = singleflight.SingleFlight()
+    gate = threading.Event()
+    seen = []
+
+    def fn():
+        yield "a"
+        gate.wait(5)
+        seen.append((threading.current_thread(), tracing.current()))
+        yield "b"
+
+    trace = tracing.start("POST", "/v1/chat/completions", {})
+    try:
+        first = flight.stream("k", fn)
+        assert next(first) == "a"
+        second = flight.stream("k", fn)
+    finally:
+        tracing.finish(trace, 200)
+    gate.set()
+    assert list(second) == ["a", "b"]
+    assert list(first) == ["b"]
+    # 第二个订阅者加入后由后台线程读取上游
+    assert seen[0][0] is not threading.current_thread()
+    assert seen[0][1] is trace
+
+
+def test_async_stream_closes_upstream_when_all_subscribers_leave():
+    async def main():
+        flight = singleflight.AsyncSingleFlight()
+        closed = asyncio.Event()
+
+        class Upstream:
+            """被取消时不会自行关闭的上游流"""
+
+            def __init__(self):
+                self.sent = False
+
+            def __aiter__(self):
+                return self
+
+            async def __anext__(self):
+                if not self.sent:
+                    self.sent = True
+                    return "a"
+                await asyncio.sleep(5)
+                raise StopAsyncIteration
+
+            async def aclose(self):
+                closed.set()
+
+        async def fn():
+            return Upstream()
+
+        subscription = await flight.stream("k", fn)
+        assert await subscription.__anext__() == "a"
+        await subscription.aclose()
+        await asyncio.wait_for(closed.wait(), 1)
+        assert flight._streams == {}
+
+    asyncio.run(main())
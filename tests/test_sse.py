@@ -0,0 +1,164 @@
+import asyncio
+import json
+import threading
+import time
+from types import SimpleNamespace
+
+import pytest
+
+import app_vertex
+import sse
+import tracing
+from sse import StreamFrames, coalesce_texts, coalesce_texts_async, read_until
+
+
+def _stalled(items, release, closed):
+    try:
+        yield from items
+        release.wait(5)
+    finally:
+        closed.set()
+
+
+def test_read_until_stops_at_deadline_while_upstream_stalls():
+    release, closed = threading.Event(), threading.Event()
+    chunks = read_until(_stalled(["a", "b"], release, closed), time.monotonic() + 0.2)
+    assert next(chunks) == "a"
+    assert next(chunks) == "b"
+    started = time.monotonic()
+    with pytest.raises(TimeoutError):
+        next(chunks)
+    assert time.monotonic() - started < 1
+    chunks.close()
+
+    # 读取线程在上游返回后自行关闭上游流
+    release.set()
+    assert closed.wait(1)
+
+
+def test_read_until_passes_through_errors():
+    def failing():
+        yield "a"
+        raise ValueError("upstream")
+
+    chunks = read_until(failing(), time.monotonic() + 5)
+    assert next(chunks) == "a"
+    with pytest.raises(ValueError):
+        next(chunks)
+
+
+@pytest.mark.parametrize("coalesce_ms", [0, 50])
+def test_upstream_is_read_in_the_request_trace_context(monkeypatch, coalesce_ms):
+    monkeypatch.setattr(sse, "SSE_COALESCE_MS", coalesce_ms)
+    seen = []
+
+    def upstream():
+        # 单一订阅者的合并流在第一次 next() 时才调用上游，此时已经在读取线程中
+        seen.append(tracing.current())
+        yield "a"
+
+    trace = tracing.start("POST", "/v1/chat/completions", {})
+    try:
+        assert list(coalesce_texts(read_until(upstream(), time.monotonic() + 5))) == ["a"]
+    finally:
+        tracing.finish(trace, 200)
+    assert seen == [trace]
+
+
+def test_sync_sse_stream_finishes_with_length_when_upstream_stalls():
+    release, closed = threading.Event(), threading.Event()
+    upstream = _stalled([SimpleNamespace(text="你好", usage_metadata=None)], release, closed)
+    chat_req = {"model_name": "gemini-test", "include_usage": False, "contents": [], "system_instruction": None}
+
+    started = time.monotonic()
+    frames = list(app_vertex.sse_stream(chat_req, upstream, time.monotonic() + 0.3))
+    assert time.monotonic() - started < 2
+    release.set()
+
+    assert frames[-1] == "data: [DONE]\n\n"
+    final = json.loads(frames[-2][len("data: "):])
+    assert final["choices"][0]["finish_reason"] == "length"
+    assert json.loads(frames[1][len("data: "):])["choices"][0]["delta"]["content"] == "你好"
+    assert closed.wait(1)
+
+
+def test_content_frames_match_full_chunks():
+    frames = StreamFrames("chatcmpl-1", 123, "gemini-test")
+    text = '引号 " 反斜杠 \\ 换行\n'
+    assert json.loads(frames.content(text)[len("data: "):]) == json.loads(frames.chunk({"content": text})[len("data: "):])
+    final = json.loads(frames.final({"total_tokens": 3}, "length")[len("data: "):])
+    assert final["choices"][0] == {"index": 0, "delta": {}, "finish_reason": "length"}
+    assert final["usage"] == {"total_tokens": 3}
+
+
+def _chunks(items, gate=None):
+    yield from items
+    if gate is not None:
+        gate.wait(5)
+
+
+def test_coalescing_disabled_passes_chunks_through(monkeypatch):
+    monkeypatch.setattr(sse, "SSE_COALESCE_MS", 0)
+    assert list(coalesce_texts(iter(["a", "b", "c"]))) == ["a", "b", "c"]
+
+
+def test_coalescing_sends_first_chunk_and_merges_the_rest(monkeypatch):
+    monkeypatch.setattr(sse, "SSE_COALESCE_MS", 50)
+    monkeypatch.setattr(sse, "SSE_COALESCE_BYTES", 1024)
+    texts = ["a", "b", "c", "d"]
+    assert list(coalesce_texts(_chunks(texts))) == ["a", "bcd"]
+
+
+def test_coalescing_flushes_on_size_and_window(monkeypatch):
+    monkeypatch.setattr(sse, "SSE_COALESCE_MS", 50)
+    monkeypatch.setattr(sse, "SSE_COALESCE_BYTES", 4)
+    assert list(coalesce_texts(_chunks(["a", "bb", "cc", "d"]))) == ["a", "bbcc", "d"]
+
+    # 上游停顿时窗口到期即发送，不等下一个 chunk
+    gate = threading.Event()
+    monkeypatch.setattr(sse, "SSE_COALESCE_BYTES", 1024)
+    merged = coalesce_texts(_chunks(["a", "b"], gate))
+    assert next(merged) == "a"
+    started = time.monotonic()
+    assert next(merged) == "b"
+    assert time.monotonic() - started < 1
+    gate.set()
+    assert list(merged) == []
+
+
+def test_coalescing_flushes_buffer_before_raising(monkeypatch):
+    monkeypatch.setattr(sse, "SSE_COALESCE_MS", 1000)
+
+    def failing():
+        yield "a"
+        yield "b"
+        raise ValueError("upstream")
+
+    merged = coalesce_texts(failing())
+    assert next(merged) == "a"
+    assert next(merged) == "b"
+    with pytest.raises(ValueError):
+        next(merged)
+
+
+def test_async_coalescing(monkeypatch):
+    monkeypatch.setattr(sse, "SSE_COALESCE_MS", 50)
+    monkeypatch.setattr(sse, "SSE_COALESCE_BYTES", 1024)
+
+    async def texts(gate):
+        for text in ["a", "b", "c"]:
+            yield text
+        await gate.wait()
+        yield "d"
+
+    async def main():
+        gate = asyncio.Event()
+        merged = coalesce_texts_async(texts(gate))
+        assert await merged.__anext__() == "a"
+        started = time.monotonic()
+        assert await merged.__anext__() == "bc"
+        assert time.monotonic() - started < 1
+        gate.set()
+        assert [text async for text in merged] == ["d"]
+
+    asyncio.run(main())
@@ -0,0 +1,27 @@
+import startup
+
+
+def test_begin_runs_start_functions_once_per_process(monkeypatch):
+    calls = []
+    monkeypatch.setattr(startup, "_start_fns", [lambda: calls.append("a")])
+    monkeypatch.setitem(startup._state, "pid", None)
+
+    startup.begin()
+    startup.begin()
+    assert calls == ["a"]
+
+    # fork 之后的工作进程(进程号不同)会再执行一次
+    monkeypatch.setitem(startup._state, "pid", -1)
+    startup.begin()
+    assert calls == ["a", "a"]
+
+
+def test_failing_start_function_does_not_block_startup(monkeypatch, capsys):
+    def broken():
+        raise RuntimeError("boom")
+
+    monkeypatch.setattr(startup, "_start_fns", [broken])
+    monkeypatch.setitem(startup._state, "pid", None)
+    startup.begin()
+    assert startup.ready()
+    assert "boom" in capsys.readouterr().out
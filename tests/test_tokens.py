@@ -0,0 +1,33 @@
+import os
+import subprocess
+import sys
+
+import tokens
+from tokens import count_message_tokens, count_text_tokens, estimate_usage, IMAGE_TOKENS
+
+
+def test_count_text_tokens_estimates_cjk_and_latin():
+    assert count_text_tokens("") == 0
+    assert count_text_tokens("abcd") == 1
+    assert count_text_tokens("abcde") == 2
+    assert count_text_tokens("你好世界") == 4
+    assert count_text_tokens("你好 abcd") == 2 + 2
+
+
+def test_count_message_tokens_counts_images():
+    content = [{"type": "text", "text": "abcdefgh"}, {"type": "image_url", "image_url": {"url": "gs://b/x.png"}}]
+    assert count_message_tokens(content) == 2 + IMAGE_TOKENS
+    assert count_message_tokens("abcdefgh") == 2
+
+
+def test_estimate_usage_includes_system_instruction():
+    usage = estimate_usage([], 5, system_instruction="abcdefgh")
+    assert usage == {"prompt_tokens": 2, "completion_tokens": 5, "total_tokens": 7}
+
+
+def test_counting_does_not_import_vertexai():
+    # 导入 vertexai SDK 需要 1 秒以上，不能出现在流式响应的路径上
+    code = "import sys, tokens; tokens.count_text_tokens('hello'); print('vertexai' in sys.modules)"
+    result = subprocess.run([sys.executable, "-c", code], capture_output=True, text=True, check=True,
+                            cwd=os.path.dirname(tokens.__file__))
+    assert result.stdout.strip() == "False"
@@ -0,0 +1,62 @@
+import json
+
+import pytest
+
+import app_vertex
+import benchmark
+import sse
+import tracing
+import upstream
+
+
+@pytest.fixture
+def fake_gemini(tmp_path, monkeypatch):
+    """本机的模拟 Gemini 服务(benchmark.FakeGemini)，代理通过真实的 HTTPS 连接访问它"""
+    fake = benchmark.FakeGemini(latency=0, chunks=3, chunk_chars=8, chunk_delay=0)
+    env = fake.start(str(tmp_path))
+    for name, value in env.items():
+        monkeypatch.setenv(name, value)
+    monkeypatch.setattr(upstream, "API_ENDPOINT", env["VERTEX_API_ENDPOINT"])
+    # 使用新的连接池，请求中会建立连接并完成 TLS 握手
+    monkeypatch.setattr(upstream, "_state", {"pid": None, "transport": None, "async_transport": None,
+                                                 "credentials": None, "clients": {}})
+    monkeypatch.setattr(app_vertex.response_cache, "is_cacheable", lambda data: False)
+    yield fake
+    fake.stop()
+
+
+@pytest.fixture
+def finished(monkeypatch):
+    traces = []
+    finish = tracing.finish
+
+    def record(trace, status_code):
+        traces.append(trace)
+        finish(trace, status_code)
+
+    monkeypatch.setattr(tracing, "finish", record)
+    return traces
+
+
+@pytest.mark.parametrize("coalesce_ms", [0, 20])
+def test_streamed_request_trace_has_backend_and_upstream_spans(fake_gemini, finished, monkeypatch, coalesce_ms):
+    monkeypatch.setattr(sse, "SSE_COALESCE_MS", coalesce_ms)
+    client = app_vertex.app.test_client()
+    response = client.post("/v1/chat/completions", json={
+        "model": "gemini-2.5-flash", "stream": True,
+        "messages": [{"role": "user", "content": f"你好 {coalesce_ms}"}]})
+    body = response.get_data(as_text=True)
+    response.close()
+
+    assert response.status_code == 200
+    assert body.rstrip().endswith("data: [DONE]")
+    assert len(finished) == 1
+    trace = finished[0]
+    assert trace.attributes["backend"] == f"{app_vertex.project_id}/{app_vertex.location}"
+    assert trace.attributes["completion_tokens"] > 0
+    spans = {name for name, _, _, _ in trace.spans}
+    assert {"upstream.connect", "upstream.tls", "upstream.response_headers"} <= spans
+    log = tracing.request_log(trace)
+    assert log["level"] == "info"
+    assert "upstream.response_headers" in log["phases_ms"]
+    json.dumps(log, default=str)
@@ -0,0 +1,49 @@
+from types import SimpleNamespace
+
+import pytest
+
+import benchmark
+import upstream
+
+
+@pytest.fixture
+def fake_gemini(tmp_path, monkeypatch):
+    fake = benchmark.FakeGemini(latency=0)
+    env = fake.start(str(tmp_path))
+    for name, value in env.items():
+        monkeypatch.setenv(name, value)
+    monkeypatch.setattr(upstream, "API_ENDPOINT", env["VERTEX_API_ENDPOINT"])
+    monkeypatch.setattr(upstream, "_state", {"pid": None, "transport": None, "async_transport": None,
+                                             "credentials": None, "clients": {}})
+    yield fake
+    fake.stop()
+
+
+@pytest.mark.parametrize("location, api_endpoint, expected", [
+    ("us-central1", None, "https://us-central1-aiplatform.googleapis.com/"),
+    ("global", None, "https://aiplatform.googleapis.com/"),
+    ("us-central1", "localhost:8443", "https://localhost:8443/"),
+    ("us-central1", "http://127.0.0.1:8080/", "http://127.0.0.1:8080/"),
+])
+def test_base_url(location, api_endpoint, expected):
+    assert upstream.base_url(location, api_endpoint) == expected
+
+
+def test_warmup_refreshes_shared_credentials_and_connects(fake_gemini):
+    backend = SimpleNamespace(project="p", location="us-central1")
+    upstream.refresh_credentials()
+    credentials = upstream._state["credentials"]
+    # 凭据文件中的 token 仍有效，不需要刷新
+    assert credentials.valid and credentials.token == "benchmark"
+
+    upstream.connect(backend, 5)
+    assert upstream._state["credentials"] is credentials
+    assert len(upstream._state["clients"]) == 1
+    assert len(upstream._state["transport"]._pool.connections) == 1
+
+    other = SimpleNamespace(project="p2", location="us-central1")
+    upstream.connect(other, 5)
+    assert len(upstream._state["clients"]) == 2
+    # 所有 Client 共享凭据和连接池
+    assert upstream._state["credentials"] is credentials
+    assert len(upstream._state["transport"]._pool.connections) == 1
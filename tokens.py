@@ -0,0 +1,109 @@
+"""
+Token 计数 - 优先使用上游返回的 usage_metadata，缺失时在本地估算
+
+本地按字符估算：中日韩字符约每字 1 个 token，其他字符约每 4 个字符 1 个 token。
+流式响应只在结束时(上游没有返回 usage_metadata 时)对完整文本估算一次，不按 chunk 计数。
+客户端每轮都会重发完整历史，因此按单条消息的摘要缓存计数结果，历史消息只计算一次。
+"""
+import os
+import re
+
+from cache import create_cache, digest
+
+# Gemini 对每张图片按固定 token 数计费
+IMAGE_TOKENS = 258
+
+_CJK = re.compile("[\u3040-\u30ff\u3400-\u4dbf\u4e00-\u9fff\uac00-\ud7af\uf900-\ufaff]")
+
+# 消息摘要 -> token 数
+content_token_cache = create_cache("content_tokens", max_entries=int(os.getenv("TOKEN_CACHE_SIZE", 4096)))
+
+def count_text_tokens(text):
+    """估算文本的 token 数"""
+    if not text:
+        return 0
+    cjk = len(_CJK.findall(text))
+    return cjk + (len(text) - cjk + 3) // 4
+
+
+def estimate_prompt_tokens(data):
+    """根据原始请求(聊天或 embedding)估算 prompt 的 token 数"""
+    total = 0
+    inputs = data.get("input")
+    for text in [inputs] if isinstance(inputs, str) else inputs if isinstance(inputs, list) else []:
+        if isinstance(text, str):
+            total += count_text_tokens(text)
+    for msg in data.get("messages", []):
+        total += count_message_tokens(msg.get("content", ""))
+    return total
+
+
+def count_message_tokens(content):
+    """计算一条 OpenAI 格式消息内容(字符串或 text/image_url 列表)的 token 数，结果按消息摘要缓存"""
+    texts = []
+    images = 0
+    if isinstance(content, str):
+        texts.append(content)
+    elif isinstance(content, list):
+        for item in content:
+            if not isinstance(item, dict):
+                continue
+            if item.get("type") == "text":
+                texts.append(item.get("text", ""))
+            elif item.get("type") == "image_url":
+                images += 1
+    # 与 count_content_tokens 使用相同的键，转换前后的同一条消息共享计数结果
+    key = digest(texts)
+    tokens = content_token_cache.get(key)
+    if tokens is None:
+        tokens = sum(count_text_tokens(text) for text in texts)
+        content_token_cache.set(key, tokens)
+    return tokens + images * IMAGE_TOKENS
+
+
+def count_content_tokens(contents):
+    """计算 Content 列表的 token 数，单条消息的结果会被缓存"""
+    total = 0
+    for content in contents:
+        texts = []
+        images = 0
+        for part in content.parts:
+            if part.inline_data or part.file_data:
+                images += 1
+            elif hasattr(part, 'text') and part.text:
+                texts.append(part.text)
+        key = digest(texts)
+        tokens = content_token_cache.get(key)
+        if tokens is None:
+            tokens = sum(count_text_tokens(text) for text in texts)
+            content_token_cache.set(key, tokens)
+        total += tokens + images * IMAGE_TOKENS
+    return total
+
+
+def usage_from_metadata(usage_metadata):
+    """将上游的 usage_metadata 转换为 OpenAI 格式，缺失时返回 None"""
+    if not usage_metadata or not usage_metadata.total_token_count:
+        return None
+    # 思考模型的思考 token 单独计数，按 OpenAI 的约定计入 completion_tokens
+    reasoning_tokens = getattr(usage_metadata, "thoughts_token_count", None) or 0
+    usage = {
+        "prompt_tokens": usage_metadata.prompt_token_count or 0,
+        "completion_tokens": (usage_metadata.candidates_token_count or 0) + reasoning_tokens,
+        "total_tokens": usage_metadata.total_token_count
+    }
+    if reasoning_tokens:
+        usage["completion_tokens_details"] = {"reasoning_tokens": reasoning_tokens}
+    return usage
+
+
+def estimate_usage(contents, completion_tokens, system_instruction=None):
+    """本地估算 usage 信息"""
+    prompt_tokens = count_content_tokens(contents)
+    if isinstance(system_instruction, str):
+        prompt_tokens += count_text_tokens(system_instruction)
+    return {
+        "prompt_tokens": prompt_tokens,
+        "completion_tokens": completion_tokens,
+        "total_tokens": prompt_tokens + completion_tokens
+    }
@@ -0,0 +1,405 @@
+"""
+请求追踪 - 结构化请求日志和 OpenTelemetry 兼容的 span
+
+每个 /v1/chat/completions 和 /v1/embeddings 请求都有一个请求 ID: 优先使用客户端的 X-Request-ID，否则随机生成。
+请求 ID 同时用作补全结果的 id (chatcmpl-<请求 ID>)，并在响应头 X-Request-ID 中返回；
+响应头 traceparent (W3C Trace Context) 给出 trace ID，客户端带 traceparent 请求时沿用其 trace ID。
+
+请求处理过程中各阶段(metrics.phase 记录的 parse、convert、image_fetch、upstream 等)、上游连接
+(upstream.connect: TCP 连接, upstream.tls: TLS 握手, upstream.send: 发送请求体, upstream.response_headers:
+等待响应头)、流式响应的首 token 时间(ttft)和总时长(stream)都记为 span，重试和图片处理错误记为事件。
+span 只记录 perf_counter 时间戳，开销很小；请求结束时决定是否保留:
+- 头部采样: 按 TRACE_SAMPLE_RATE 随机保留，客户端的 traceparent 标记为已采样时总是保留
+- 尾部采样: 耗时超过 TRACE_SLOW_MS、返回 5xx 或出现错误事件的请求总是保留
+
+保留的请求输出一行 JSON 请求日志(REQUEST_LOG)，并由后台线程批量导出(TRACE_EXPORTER):
+- file:   OTLP/JSON 格式追加到 TRACE_FILE，每批一行(与 OpenTelemetry Collector 的 file 导出格式一致)
+- otlp:   以 OTLP/HTTP JSON 发送到 TRACE_OTLP_ENDPOINT (Collector、Jaeger、Tempo 等)
+- stdout: 输出到标准输出
+导出队列已满时丢弃，不阻塞请求；/stats 的 tracing 中统计保留、丢弃和导出的数量。
+"""
+import atexit
+import contextvars
+import datetime
+import json
+import os
+import queue
+import random
+import re
+import secrets
+import threading
+import time
+import traceback
+
+TRACE_SAMPLE_RATE = float(os.getenv("TRACE_SAMPLE_RATE", 0.01))
+# 耗时超过该值(毫秒)的请求总是保留，0 表示不按耗时保留
+TRACE_SLOW_MS = float(os.getenv("TRACE_SLOW_MS", 5000))
+# 5xx 和出现错误事件的请求总是保留
+TRACE_KEEP_ERRORS = os.getenv("TRACE_KEEP_ERRORS", "True").lower() == "true"
+# 导出方式: none / file / otlp / stdout
+TRACE_EXPORTER = os.getenv("TRACE_EXPORTER", "none").lower()
+TRACE_FILE = os.getenv("TRACE_FILE", "traces.jsonl")
+TRACE_OTLP_ENDPOINT = os.getenv("TRACE_OTLP_ENDPOINT", "http://localhost:4318/v1/traces")
+TRACE_QUEUE_SIZE = int(os.getenv("TRACE_QUEUE_SIZE", 2048))
+# 导出批次的最大 trace 数和最长等待时间(秒)
+TRACE_BATCH_SIZE = int(os.getenv("TRACE_BATCH_SIZE", 256))
+TRACE_EXPORT_INTERVAL = float(os.getenv("TRACE_EXPORT_INTERVAL", 2))
+# 请求日志: sampled(只输出保留的请求) / all / off
+REQUEST_LOG = os.getenv("REQUEST_LOG", "sampled").lower()
+SERVICE_NAME = os.getenv("OTEL_SERVICE_NAME", "llm-proxy")
+
+# 客户端提供的请求 ID 只接受这些字符，避免写进日志和响应头时出问题
+_REQUEST_ID = re.compile(r"^[A-Za-z0-9._:-]{1,128}$")
+_TRACEPARENT = re.compile(r"^[0-9a-f]{2}-([0-9a-f]{32})-([0-9a-f]{16})-([0-9a-f]{2})$")
+# httpcore 的 trace 事件 -> span 名称
+_HTTP_SPANS = {
+    "connect_tcp": "upstream.connect",
+    "start_tls": "upstream.tls",
+    "send_request_body": "upstream.send",
+    "receive_response_headers": "upstream.response_headers",
+}
+_SPAN_KIND_INTERNAL, _SPAN_KIND_SERVER, _SPAN_KIND_CLIENT = 1, 2, 3
+_STATUS_ERROR = 2
+
+_current = contextvars.ContextVar("trace", default=None)
+_lock = threading.Lock()
+_counters = {
+    "requests": 0,
+    "kept_sampled": 0,
+    "kept_slow": 0,
+    "kept_error": 0,
+    "exported": 0,
+    "dropped": 0,
+    "export_errors": 0,
+}
+# 导出线程和队列按进程创建，fork 之后重新创建
+_exporter = {"pid": None, "queue": None, "thread": None}
+
+
+def _incr(name, amount=1):
+    with _lock:
+        _counters[name] = _counters.get(name, 0) + amount
+
+
+def stats():
+    """返回追踪相关的统计信息"""
+    with _lock:
+        return {**_counters, "sample_rate": TRACE_SAMPLE_RATE, "exporter": TRACE_EXPORTER}
+
+
+class Trace:
+    """一个请求的 trace: 根 span 以及请求处理过程中记录的子 span 和事件"""
+
+    def __init__(self, name, request_id, trace_id=None, parent_id=None, sampled=False):
+        self.name = name
+        self.request_id = request_id
+        self.trace_id = trace_id or secrets.token_hex(16)
+        self.span_id = secrets.token_hex(8)
+        self.parent_id = parent_id
+        self.sampled = sampled
+        # 以 perf_counter 计时，导出时换算为墙上时间
+        self.start = time.perf_counter()
+        self.start_ns = time.time_ns()
+        self.end = None
+        self.status_code = None
+        self.attributes = {}
+        # (名称, 开始, 结束, 属性)
+        self.spans = []
+        # (名称, 时间, 属性, 是否为错误)
+        self.events = []
+        self.error = False
+
+    def span(self, name, start, end=None, **attributes):
+        """记录一个子 span，start / end 为 perf_counter 时间"""
+        self.spans.append((name, start, time.perf_counter() if end is None else end, attributes))
+
+    def event(self, name, error=False, **attributes):
+        self.events.append((name, time.perf_counter(), attributes, error))
+        self.error = self.error or error
+
+    def annotate(self, **attributes):
+        self.attributes.update(attributes)
+
+    def fail(self, exc):
+        """记录请求失败的异常；4xx 错误(请求本身有误、被限流等)不算作错误，也不记录调用栈"""
+        code = getattr(exc, "code", None)
+        client_error = isinstance(code, int) and 400 <= code < 500
+        attributes = {"exception.type": type(exc).__name__, "exception.message": str(exc)}
+        if not client_error:
+            attributes["exception.stacktrace"] = "".join(traceback.format_exception(exc))
+        self.event("exception", error=not client_error, **attributes)
+
+    def headers(self):
+        """返回响应头"""
+        return {"X-Request-ID": self.request_id,
+                "traceparent": f"00-{self.trace_id}-{self.span_id}-{'01' if self.sampled else '00'}"}
+
+    def duration(self):
+        return ((self.end or time.perf_counter()) - self.start) * 1000
+
+    def _ns(self, perf):
+        return self.start_ns + int((perf - self.start) * 1e9)
+
+
+def start(method, route, headers):
+    """开始一个请求的 trace 并设为当前 trace"""
+    request_id = headers.get("X-Request-ID", "")
+    if not _REQUEST_ID.match(request_id):
+        request_id = secrets.token_hex(16)
+    trace_id = parent_id = None
+    sampled = False
+    match = _TRACEPARENT.match(headers.get("traceparent", "").strip().lower())
+    if match and match.group(1) != "0" * 32:
+        trace_id, parent_id = match.group(1), match.group(2)
+        sampled = int(match.group(3), 16) & 1 == 1
+    sampled = sampled or random.random() < TRACE_SAMPLE_RATE
+    trace = Trace(f"{method} {route}", request_id, trace_id, parent_id, sampled)
+    trace.annotate(**{"http.request.method": method, "http.route": route})
+    _current.set(trace)
+    _incr("requests")
+    return trace
+
+
+def current():
+    """返回当前请求的 trace，不在请求中时返回 None"""
+    return _current.get()
+
+
+def span(name, start, end=None, **attributes):
+    """为当前请求记录一个子 span"""
+    trace = _current.get()
+    if trace is not None:
+        trace.span(name, start, end, **attributes)
+
+
+def event(name, error=False, **attributes):
+    """为当前请求记录一个事件"""
+    trace = _current.get()
+    if trace is not None:
+        trace.event(name, error, **attributes)
+
+
+def annotate(**attributes):
+    """为当前请求添加属性"""
+    trace = _current.get()
+    if trace is not None:
+        trace.annotate(**attributes)
+
+
+def completion_id():
+    """补全结果的 id，请求中使用请求 ID"""
+    trace = _current.get()
+    return f"chatcmpl-{trace.request_id if trace is not None else secrets.token_hex(16)}"
+
+
+def finish(trace, status_code):
+    """请求结束: 决定是否保留，保留的 trace 输出请求日志并导出"""
+    if trace.end is not None:
+        return
+    trace.end = time.perf_counter()
+    trace.status_code = status_code
+    if _current.get() is trace:
+        _current.set(None)
+
+    keep = None
+    if trace.sampled:
+        keep = "kept_sampled"
+    elif TRACE_KEEP_ERRORS and (status_code >= 500 or trace.error):
+        keep = "kept_error"
+    elif TRACE_SLOW_MS > 0 and trace.duration() >= TRACE_SLOW_MS:
+        keep = "kept_slow"
+    if keep is not None:
+        _incr(keep)
+    if REQUEST_LOG == "all" or (REQUEST_LOG == "sampled" and keep is not None):
+        print(json.dumps(request_log(trace), ensure_ascii=False, default=str), flush=True)
+    if keep is not None and TRACE_EXPORTER != "none":
+        _enqueue(trace)
+
+
+def request_log(trace):
+    """一行结构化请求日志"""
+    level = "info"
+    if trace.status_code >= 500 or trace.error:
+        level = "error"
+    elif trace.status_code >= 400:
+        level = "warning"
+    phases = {}
+    for name, start, end, _ in trace.spans:
+        phases[name] = round(phases.get(name, 0) + (end - start) * 1000, 2)
+    entry = {
+        "time": datetime.datetime.fromtimestamp(trace.start_ns / 1e9, datetime.timezone.utc).isoformat(),
+        "level": level,
+        "request_id": trace.request_id,
+        "trace_id": trace.trace_id,
+        "route": trace.name,
+        "status": trace.status_code,
+        "duration_ms": round(trace.duration(), 2),
+        **{key: value for key, value in trace.attributes.items() if value is not None and not key.startswith("http.")},
+        "phases_ms": phases,
+    }
+    if trace.events:
+        entry["events"] = [{"name": name, **attributes} for name, _, attributes, _ in trace.events]
+    return entry
+
+
+def _attributes(attributes):
+    """转换为 OTLP/JSON 的属性列表"""
+    result = []
+    for key, value in attributes.items():
+        if value is None:
+            continue
+        if isinstance(value, bool):
+            item = {"boolValue": value}
+        elif isinstance(value, int):
+            item = {"intValue": str(value)}
+        elif isinstance(value, float):
+            item = {"doubleValue": value}
+        else:
+            item = {"stringValue": str(value)}
+        result.append({"key": key, "value": item})
+    return result
+
+
+def to_otlp(trace):
+    """转换为 OTLP/JSON 的 span 列表，子 span 的父 span 都是请求的根 span"""
+    root = {
+        "traceId": trace.trace_id,
+        "spanId": trace.span_id,
+        "name": trace.name,
+        "kind": _SPAN_KIND_SERVER,
+        "startTimeUnixNano": str(trace.start_ns),
+        "endTimeUnixNano": str(trace._ns(trace.end)),
+        "attributes": _attributes({**trace.attributes, "request_id": trace.request_id,
+                                   "http.response.status_code": trace.status_code}),
+        "events": [{"timeUnixNano": str(trace._ns(at)), "name": name, "attributes": _attributes(attributes)}
+                   for name, at, attributes, _ in trace.events],
+    }
+    if trace.parent_id:
+        root["parentSpanId"] = trace.parent_id
+    if trace.status_code >= 500 or trace.error:
+        root["status"] = {"code": _STATUS_ERROR}
+    spans = [root]
+    for name, start, end, attributes in trace.spans:
+        item = {
+            "traceId": trace.trace_id,
+            "spanId": secrets.token_hex(8),
+            "parentSpanId": trace.span_id,
+            "name": name,
+            "kind": _SPAN_KIND_CLIENT if name.startswith("upstream.") else _SPAN_KIND_INTERNAL,
+            "startTimeUnixNano": str(trace._ns(start)),
+            "endTimeUnixNano": str(trace._ns(end)),
+            "attributes": _attributes(attributes),
+        }
+        if "error" in attributes:
+            item["status"] = {"code": _STATUS_ERROR, "message": str(attributes["error"])}
+        spans.append(item)
+    return spans
+
+
+def _enqueue(trace):
+    pid = os.getpid()
+    if _exporter["pid"] != pid:
+        with _lock:
+            if _exporter["pid"] != pid:
+                _exporter["queue"] = queue.Queue(maxsize=TRACE_QUEUE_SIZE)
+                _exporter["thread"] = threading.Thread(target=_export_loop, args=(_exporter["queue"],),
+                                                       name="trace-exporter", daemon=True)
+                _exporter["thread"].start()
+                _exporter["pid"] = pid
+    try:
+        _exporter["queue"].put_nowait(trace)
+    except queue.Full:
+        _incr("dropped")
+
+
+def _export_loop(traces):
+    """后台导出线程: 凑够一批或等待 TRACE_EXPORT_INTERVAL 后导出"""
+    while True:
+        batch = [traces.get()]
+        deadline = time.monotonic() + TRACE_EXPORT_INTERVAL
+        while len(batch) < TRACE_BATCH_SIZE:
+            try:
+                batch.append(traces.get(timeout=max(0, deadline - time.monotonic())))
+            except queue.Empty:
+                break
+        try:
+            _export(batch)
+            _incr("exported", len(batch))
+        except Exception as e:
+            _incr("export_errors")
+            print(f"警告: 导出 trace 失败 - {str(e)}")
+        finally:
+            for _ in batch:
+                traces.task_done()
+
+
+def _export(batch):
+    payload = json.dumps({"resourceSpans": [{
+        "resource": {"attributes": _attributes({"service.name": SERVICE_NAME, "process.pid": os.getpid()})},
+        "scopeSpans": [{"scope": {"name": "llm-proxy"},
+                        "spans": [span for trace in batch for span in to_otlp(trace)]}],
+    }]}, ensure_ascii=False, default=str, separators=(",", ":"))
+    if TRACE_EXPORTER == "file":
+        # O_APPEND 的单次写入不会与其他工作进程的写入交错
+        fd = os.open(TRACE_FILE, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+        try:
+            os.write(fd, (payload + "\n").encode())
+        finally:
+            os.close(fd)
+    elif TRACE_EXPORTER == "otlp":
+        import requests
+
+        response = requests.post(TRACE_OTLP_ENDPOINT, data=payload.encode(),
+                                 headers={"Content-Type": "application/json"}, timeout=10)
+        response.raise_for_status()
+    elif TRACE_EXPORTER == "stdout":
+        print(payload, flush=True)
+
+
+def flush(timeout=5):
+    """等待导出队列清空(进程退出时调用)"""
+    if _exporter["pid"] != os.getpid():
+        return
+    deadline = time.monotonic() + timeout
+    traces = _exporter["queue"]
+    while traces.unfinished_tasks and time.monotonic() < deadline:
+        time.sleep(0.05)
+
+
+atexit.register(flush)
+
+
+class _HttpTrace:
+    """httpx 请求的 trace 扩展回调，把 httpcore 的连接、发送和等待响应头事件记为 span"""
+
+    def __init__(self, trace):
+        self.trace = trace
+        self.started = {}
+
+    def __call__(self, name, info):
+        prefix, _, stage = name.rpartition(".")
+        operation = prefix.rpartition(".")[2]
+        span_name = _HTTP_SPANS.get(operation)
+        if span_name is None:
+            return
+        if stage == "started":
+            self.started[operation] = time.perf_counter()
+        elif operation in self.started:
+            attributes = {"error": str(info.get("exception"))} if stage == "failed" else {}
+            self.trace.span(span_name, self.started.pop(operation), **attributes)
+
+    async def call_async(self, name, info):
+        self(name, info)
+
+
+def trace_request(request):
+    """httpx 的 request 事件钩子: 当前请求的上游调用记录连接和响应头耗时"""
+    trace = _current.get()
+    if trace is not None:
+        request.extensions["trace"] = _HttpTrace(trace)
+
+
+async def trace_request_async(request):
+    trace = _current.get()
+    if trace is not None:
+        request.extensions["trace"] = _HttpTrace(trace).call_async
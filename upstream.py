@@ -0,0 +1,347 @@
+"""
+上游调用 - 基于 google-genai 的 Client
+
+- 每个工作进程为每个后端 (project, location) 创建一个长期复用的 genai.Client；所有 Client 共享同一个
+  httpx 连接池(同步、异步各一个)，TLS 握手和客户端构造不再出现在请求路径上
+- 连接池大小、空闲连接保留时间和 HTTP/2 可配置，HTTP/2 需要安装 h2 包，未安装时使用 HTTP/1.1
+- 请求参数包括 system_instruction、生成参数、thinking_config(来自模型注册表的 thinking_budget)、
+  safety_settings(请求中的 safety_settings 字段，未指定时使用 SAFETY_SETTINGS)以及上下文缓存
+- google-genai 的流式响应在中途停止读取时不会关闭底层 HTTP 响应，连接会一直被占用；
+  这里记录每次流式调用打开的响应，流被关闭时一并关闭
+- 请求中的上游调用把建立连接、TLS 握手和等待响应头的耗时记入请求的 trace (见 tracing.py)
+- 所有 Client 共享本进程通过 google.auth 获取的同一份凭据，预热时可提前刷新 access token
+
+连接池在第一次使用时按进程创建，gunicorn --preload 的主进程中不会建立连接。
+"""
+import contextvars
+import json
+import os
+import ssl
+import threading
+
+import certifi
+import google.auth
+import google.auth.transport.requests
+import httpx
+from google import genai
+from google.genai import types
+
+import tracing
+
+UPSTREAM_HTTP2 = os.getenv("UPSTREAM_HTTP2", "True").lower() == "true"
+# 每个进程到上游的最大连接数和保留的空闲连接数
+UPSTREAM_POOL_SIZE = int(os.getenv("UPSTREAM_POOL_SIZE", 100))
+UPSTREAM_POOL_KEEPALIVE = int(os.getenv("UPSTREAM_POOL_KEEPALIVE", 20))
+# 空闲连接保留时间(秒)
+UPSTREAM_KEEPALIVE_EXPIRY = float(os.getenv("UPSTREAM_KEEPALIVE_EXPIRY", 120))
+# 指定后所有区域的请求都发往该地址 (如 Private Service Connect 端点，或 benchmark.py 的模拟服务)
+API_ENDPOINT = os.getenv("VERTEX_API_ENDPOINT") or None
+# 访问 Vertex AI 需要的 OAuth scope
+_SCOPES = ["https://www.googleapis.com/auth/cloud-platform"]
+# 默认的安全设置 (JSON): {"HARM_CATEGORY_HATE_SPEECH": "OFF", "HARM_CATEGORY_HARASSMENT": "BLOCK_ONLY_HIGH"}
+SAFETY_SETTINGS = json.loads(os.getenv("SAFETY_SETTINGS", "{}"))
+
+_lock = threading.Lock()
+# 本进程的连接池和 Client，fork 之后按进程号重新创建
+_state = {"pid": None, "transport": None, "async_transport": None, "credentials": None, "clients": {}}
+# 当前流式调用打开的 HTTP 响应
+_open_responses = contextvars.ContextVar("upstream_open_responses", default=None)
+
+
+def _http2():
+    if not UPSTREAM_HTTP2:
+        return False
+    try:
+        import h2  # noqa: F401
+    except ImportError:
+        print("警告: 未安装 h2 包，上游连接使用 HTTP/1.1 (pip install h2)")
+        return False
+    return True
+
+
+def _create_transports():
+    """创建本进程共享的同步/异步连接池"""
+    # 与 google-genai 默认的证书配置一致，同样支持 SSL_CERT_FILE / SSL_CERT_DIR
+    context = ssl.create_default_context(cafile=os.getenv("SSL_CERT_FILE", certifi.where()),
+                                         capath=os.getenv("SSL_CERT_DIR"))
+    limits = httpx.Limits(max_connections=UPSTREAM_POOL_SIZE,
+                          max_keepalive_connections=UPSTREAM_POOL_KEEPALIVE,
+                          keepalive_expiry=UPSTREAM_KEEPALIVE_EXPIRY)
+    http2 = _http2()
+    return (httpx.HTTPTransport(verify=context, http2=http2, limits=limits),
+            httpx.AsyncHTTPTransport(verify=context, http2=http2, limits=limits))
+
+
+def _track_response(response):
+    responses = _open_responses.get()
+    if responses is not None:
+        responses.append(response)
+
+
+async def _track_response_async(response):
+    _track_response(response)
+
+
+def base_url(location, api_endpoint=None):
+    """上游地址: 指定了 api_endpoint 时使用它，否则为该区域的 Vertex AI 地址"""
+    if api_endpoint:
+        return api_endpoint if "://" in api_endpoint else f"https://{api_endpoint}/"
+    if location == "global":
+        return "https://aiplatform.googleapis.com/"
+    return f"https://{location}-aiplatform.googleapis.com/"
+
+
+def _init_process():
+    """fork 之后按进程号重新创建连接池、凭据和 Client，调用方持有 _lock"""
+    pid = os.getpid()
+    if _state["pid"] != pid:
+        _state["pid"] = pid
+        _state["transport"], _state["async_transport"] = _create_transports()
+        _state["credentials"] = None
+        _state["clients"] = {}
+
+
+def _credentials():
+    """本进程共享的凭据 (Application Default Credentials)，调用方持有 _lock"""
+    _init_process()
+    if _state["credentials"] is None:
+        _state["credentials"], _ = google.auth.default(scopes=_SCOPES)
+    return _state["credentials"]
+
+
+def get_client(project, location, api_endpoint=None):
+    """返回该 (project, location) 的 genai.Client，同一进程内复用"""
+    key = (project, location, api_endpoint)
+    with _lock:
+        _init_process()
+        client = _state["clients"].get(key)
+        if client is None:
+            http_options = types.HttpOptions(
+                client_args={"transport": _state["transport"], "event_hooks": {
+                    "request": [tracing.trace_request], "response": [_track_response]}},
+                async_client_args={"transport": _state["async_transport"], "event_hooks": {
+                    "request": [tracing.trace_request_async], "response": [_track_response_async]}},
+            )
+            if api_endpoint:
+                http_options.base_url = base_url(location, api_endpoint)
+            client = genai.Client(vertexai=True, project=project, location=location,
+                                  credentials=_credentials(), http_options=http_options)
+            _state["clients"][key] = client
+        return client
+
+
+def client_for(backend):
+    """返回后端对应的 Client"""
+    return get_client(backend.project, backend.location, API_ENDPOINT)
+
+
+def default_client():
+    """返回 GOOGLE_CLOUD_PROJECT / GOOGLE_CLOUD_LOCATION 对应的 Client"""
+    return get_client(os.getenv("GOOGLE_CLOUD_PROJECT", "vertex-testing"),
+                      os.getenv("GOOGLE_CLOUD_LOCATION", "asia-east2"), API_ENDPOINT)
+
+
+def refresh_credentials():
+    """提前获取 access token，避免第一个请求等待凭据刷新"""
+    with _lock:
+        credentials = _credentials()
+    if not credentials.valid:
+        credentials.refresh(google.auth.transport.requests.Request())
+
+
+def connect(backend, timeout):
+    """为后端创建 Client，并与其上游地址建立连接(包括 TLS 握手)，连接保留在连接池中供后续请求使用"""
+    client_for(backend)
+    request = httpx.Request("HEAD", base_url(backend.location, API_ENDPOINT),
+                            extensions={"timeout": httpx.Timeout(timeout).as_dict()})
+    response = _state["transport"].handle_request(request)
+    # 读完(空的)响应体再关闭，未读完就关闭时连接不会放回连接池
+    response.read()
+    response.close()
+
+
+def safety_settings(data):
+    """请求中的 safety_settings ([{"category", "threshold"}] 或 {category: threshold})，未指定时使用默认值"""
+    settings = data.get("safety_settings") or SAFETY_SETTINGS
+    if isinstance(settings, dict):
+        settings = [{"category": category, "threshold": threshold} for category, threshold in settings.items()]
+    return [types.SafetySetting(**item) for item in settings] or None
+
+
+def generate_config(chat_req, cached_content=None):
+    """构造 GenerateContentConfig；使用上下文缓存时 system_instruction 已包含在缓存中"""
+    config = types.GenerateContentConfig(
+        **(chat_req["generation_config"] or {}),
+        safety_settings=chat_req.get("safety_settings"),
+        # 代理不执行函数调用，关闭 SDK 的自动函数调用
+        automatic_function_calling=types.AutomaticFunctionCallingConfig(disable=True),
+    )
+    if chat_req.get("thinking_budget") is not None:
+        config.thinking_config = types.ThinkingConfig(thinking_budget=chat_req["thinking_budget"])
+    if cached_content:
+        config.cached_content = cached_content
+    elif chat_req["system_instruction"]:
+        config.system_instruction = chat_req["system_instruction"]
+    return config
+
+
+def _request_args(chat_req, cached):
+    contents = chat_req["contents"]
+    if cached is not None:
+        # 使用上下文缓存时只发送缓存前缀之后的内容
+        contents = contents[cached["length"]:]
+    config = generate_config(chat_req, cached["name"] if cached is not None else None)
+    return {"model": chat_req["model_name"], "contents": contents, "config": config}
+
+
+def generate(client, chat_req, stream=False, cached=None):
+    """调用上游；stream=True 时先读取第一个 chunk(使错误在返回前抛出)，再返回可关闭的流"""
+    args = _request_args(chat_req, cached)
+    if not stream:
+        return client.models.generate_content(**args)
+    responses = []
+    token = _open_responses.set(responses)
+    try:
+        chunks = client.models.generate_content_stream(**args)
+        first = next(chunks, None)
+    except BaseException:
+        _close_responses(responses)
+        raise
+    finally:
+        _open_responses.reset(token)
+    return ClosingStream(first, chunks, responses)
+
+
+async def generate_async(client, chat_req, stream=False, cached=None):
+    """generate 的异步版本"""
+    args = _request_args(chat_req, cached)
+    if not stream:
+        return await client.aio.models.generate_content(**args)
+    responses = []
+    token = _open_responses.set(responses)
+    try:
+        chunks = (await client.aio.models.generate_content_stream(**args)).__aiter__()
+        try:
+            first = await chunks.__anext__()
+        except StopAsyncIteration:
+            first = None
+    except BaseException:
+        await _aclose_responses(responses)
+        raise
+    finally:
+        _open_responses.reset(token)
+    return AsyncClosingStream(first, chunks, responses)
+
+
+def _close_responses(responses):
+    for response in responses:
+        response.close()
+    responses.clear()
+
+
+async def _aclose_responses(responses):
+    for response in responses:
+        await response.aclose()
+    responses.clear()
+
+
+class ClosingStream:
+    """上游流式响应；读完或被关闭时关闭底层 HTTP 响应，把连接还给连接池
+
+    以类实现而不是生成器，保证尚未开始迭代时调用 close() 也能释放连接。
+    """
+
+    def __init__(self, first, chunks, responses):
+        self._first = first
+        self._chunks = chunks
+        self._responses = responses
+        self._done = first is None
+        if self._done:
+            self.close()
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        if self._first is not None:
+            first, self._first = self._first, None
+            return first
+        if self._done:
+            raise StopIteration
+        try:
+            return next(self._chunks)
+        except BaseException:
+            self.close()
+            raise
+
+    def close(self):
+        self._done = True
+        self._first = None
+        self._chunks.close()
+        _close_responses(self._responses)
+
+    def __del__(self):
+        if self._responses:
+            self.close()
+
+
+class AsyncClosingStream:
+    """ClosingStream 的异步版本"""
+
+    def __init__(self, first, chunks, responses):
+        self._first = first
+        self._chunks = chunks
+        self._responses = responses
+        self._done = first is None
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        if self._first is not None:
+            first, self._first = self._first, None
+            return first
+        if self._done:
+            await self.aclose()
+            raise StopAsyncIteration
+        try:
+            return await self._chunks.__anext__()
+        except BaseException:
+            await self.aclose()
+            raise
+
+    async def aclose(self):
+        self._done = True
+        self._first = None
+        await self._chunks.aclose()
+        await _aclose_responses(self._responses)
+
+
+def embed(client, model, texts, dimensions=None, task_type=None):
+    """一次调用计算多条文本的 embedding，返回 [(向量, token 数或 None)]"""
+    # 直接传字符串时 SDK 对每条文本都会尝试导入一次 PIL，未安装 Pillow 时每次都要搜索 sys.path
+    contents = [types.Content(parts=[types.Part(text=text)]) for text in texts]
+    response = client.models.embed_content(model=model, contents=contents, config=types.EmbedContentConfig(
+        output_dimensionality=dimensions, task_type=task_type))
+    return [(embedding.values, embedding.statistics.token_count if embedding.statistics else None)
+            for embedding in response.embeddings]
+
+
+def create_cache(client, chat_req, length, ttl):
+    """创建包含 system_instruction 和前 length 条消息的 CachedContent，返回资源名"""
+    cached = client.caches.create(model=chat_req["model_name"], config=types.CreateCachedContentConfig(
+        system_instruction=chat_req["system_instruction"] or None,
+        contents=chat_req["contents"][:length] or None,
+        ttl=f"{ttl}s",
+    ))
+    return cached.name
+
+
+def update_cache(client, name, ttl):
+    """延长 CachedContent 的有效期"""
+    client.caches.update(name=name, config=types.UpdateCachedContentConfig(ttl=f"{ttl}s"))
+
+
+def to_json(value):
+    """把 genai 的类型转换为 REST API 的 JSON 结构(批量预测的输入文件使用)"""
+    return value.model_dump(mode="json", by_alias=True, exclude_none=True)